@@ -46,6 +46,12 @@ amqp_opts = [
                 default=False,
                 deprecated_group='DEFAULT',
                 help='Auto-delete queues in AMQP.'),
+    cfg.IntOpt('amqp_stream_window',
+               default=64,
+               min=0,
+               help='Maximum number of items of a streamed reply the server '
+                    'sends ahead of the ones the caller consumed. 0 lets '
+                    'the server send them all without waiting.'),
 ]
 
 UNIQUE_ID = '_unique_id'
@@ -744,7 +744,7 @@ class Controller(pyngus.ConnectionEventHandler):
     work is done on the Eventloop thread, allowing the driver to run
     asynchronously from the messaging clients.
     """
-    def __init__(self, hosts, default_exchange, config):
+    def __init__(self, hosts, default_exchange, config, index=0):
         self.processor = None
         self._socket_connection = None
         self._node = platform.node() or "<UNKNOWN>"
@@ -767,6 +767,9 @@ class Controller(pyngus.ConnectionEventHandler):
         self._servers = {}
 
         self._container_name = config.oslo_messaging_amqp.container_name
+        if self._container_name and index:
+            # each connection of the driver needs its own container name
+            self._container_name = "%s/%d" % (self._container_name, index)
         self.idle_timeout = config.oslo_messaging_amqp.idle_timeout
         self.trace_protocol = config.oslo_messaging_amqp.trace
         self.ssl_ca_file = config.oslo_messaging_amqp.ssl_ca_file
@@ -24,7 +24,6 @@ the background thread via callables.
 
 import collections
 import errno
-import heapq
 import logging
 import math
 from monotonic import monotonic as now  # noqa
@@ -167,32 +166,53 @@ class _SocketConnection(object):
 
 class Scheduler(object):
     """Schedule callables to be run in the future.
+
+    The callables are kept in a hierarchical timer wheel with one second
+    ticks, the granularity of compute_timeout().  The first level has one
+    slot per second for the next WHEEL_SIZE seconds, each slot of the next
+    level covers all the slots of the level below it.  When the first level
+    wraps around, the current slot of the next level is cascaded down, so
+    each callable is moved at most once per level.  Scheduling and
+    canceling a callable are O(1).
     """
+    WHEEL_BITS = 6
+    WHEEL_SIZE = 1 << WHEEL_BITS
+    WHEEL_MASK = WHEEL_SIZE - 1
+    WHEEL_LEVELS = 4
+
     class Event(object):
-        # simply hold a reference to a callback that can be set to None if the
-        # alarm is canceled
-        def __init__(self, callback):
+        # hold a reference to a callback and to the wheel slot it is stored
+        # in, so that it can be removed if the alarm is canceled
+        __slots__ = ('callback', 'deadline', '_scheduler', '_slot')
+
+        def __init__(self, scheduler, callback, deadline):
             self.callback = callback
+            self.deadline = deadline
+            self._scheduler = scheduler
+            self._slot = None
 
         def cancel(self):
-            # quicker than rebalancing the tree
+            if self._slot is not None:
+                del self._slot[self]
+                self._slot = None
+                self._scheduler._count -= 1
             self.callback = None
 
     def __init__(self):
-        self._callbacks = {}
-        self._deadlines = []
+        # all the events due up to and including _tick have been run
+        self._tick = int(now())
+        self._count = 0
+        self._expired = collections.OrderedDict()
+        self._wheel = [[collections.OrderedDict()
+                        for i in range(self.WHEEL_SIZE)]
+                       for level in range(self.WHEEL_LEVELS)]
 
     def alarm(self, request, deadline):
         """Request a callable be executed at a specific time
         """
-        try:
-            callbacks = self._callbacks[deadline]
-        except KeyError:
-            callbacks = list()
-            self._callbacks[deadline] = callbacks
-            heapq.heappush(self._deadlines, deadline)
-        entry = Scheduler.Event(request)
-        callbacks.append(entry)
+        entry = Scheduler.Event(self, request, deadline)
+        self._insert(entry)
+        self._count += 1
         return entry
 
     def defer(self, request, delay):
@@ -200,18 +220,66 @@ class Scheduler(object):
         """
         return self.alarm(request, compute_timeout(delay))
 
+    def _insert(self, entry):
+        tick = int(math.ceil(entry.deadline))
+        delta = tick - self._tick
+        if delta <= 0:
+            slot = self._expired
+        elif delta < self.WHEEL_SIZE:
+            slot = self._wheel[0][tick & self.WHEEL_MASK]
+        else:
+            bits = 0
+            level = 0
+            while (delta >> bits) >= self.WHEEL_SIZE:
+                bits += self.WHEEL_BITS
+                level += 1
+                if level == self.WHEEL_LEVELS - 1:
+                    # beyond the wheel, park it in the farthest slot, it is
+                    # re-inserted when this slot is cascaded
+                    tick = min(tick, self._tick +
+                               (1 << (bits + self.WHEEL_BITS)) - 1)
+                    break
+            slot = self._wheel[level][(tick >> bits) & self.WHEEL_MASK]
+        slot[entry] = None
+        entry._slot = slot
+
+    def _next_tick(self):
+        """The next tick of the wheel that has events to run or a slot to
+        cascade, or None
+        """
+        if not self._count:
+            return None
+        next_tick = None
+        bits = 0
+        for level in range(self.WHEEL_LEVELS):
+            # a slot of this level is due when its first tick is reached
+            start = self._tick >> bits
+            wheel = self._wheel[level]
+            for unit in range(start + 1, start + self.WHEEL_SIZE + 1):
+                if wheel[unit & self.WHEEL_MASK]:
+                    tick = unit << bits
+                    if next_tick is None or tick < next_tick:
+                        next_tick = tick
+                    break
+            bits += self.WHEEL_BITS
+            # the slots of the next levels are not due before it wraps around
+            if (next_tick is not None and
+                    next_tick <= ((self._tick >> bits) + 1) << bits):
+                break
+        return next_tick
+
     @property
     def _next_deadline(self):
         """The timestamp of the next expiring event or None
         """
-        return self._deadlines[0] if self._deadlines else None
+        return self._tick if self._expired else self._next_tick()
 
     def _get_delay(self, max_delay=None):
         """Get the delay in milliseconds until the next callable needs to be
         run, or 'max_delay' if no outstanding callables or the delay to the
         next callable is > 'max_delay'.
         """
-        due = self._deadlines[0] if self._deadlines else None
+        due = self._next_deadline
         if due is None:
             return max_delay
         _now = now()
@@ -220,19 +288,50 @@ class Scheduler(object):
         else:
             return min(due - _now, max_delay) if max_delay else due - _now
 
+    def _cascade(self):
+        bits = 0
+        for level in range(1, self.WHEEL_LEVELS):
+            bits += self.WHEEL_BITS
+            if self._tick & ((1 << bits) - 1):
+                break
+            index = (self._tick >> bits) & self.WHEEL_MASK
+            slot = self._wheel[level][index]
+            self._wheel[level][index] = collections.OrderedDict()
+            for entry in slot:
+                self._insert(entry)
+
+    def _run(self, slot):
+        for entry in list(slot):
+            # skip the events canceled by the callables run before them
+            if entry._slot is slot:
+                entry._slot = None
+                self._count -= 1
+                entry.callback and entry.callback()
+
     def _process(self):
         """Invoke all expired callables."""
-        if self._deadlines:
-            _now = now()
-            try:
-                while self._deadlines[0] <= _now:
-                    deadline = heapq.heappop(self._deadlines)
-                    callbacks = self._callbacks[deadline]
-                    del self._callbacks[deadline]
-                    for cb in callbacks:
-                        cb.callback and cb.callback()
-            except IndexError:
-                pass
+        target = int(now())
+        self._run_expired()
+        while self._tick < target:
+            tick = self._next_tick()
+            if tick is None or tick > target:
+                self._tick = target
+                break
+            self._tick = tick
+            if not tick & self.WHEEL_MASK:
+                self._cascade()
+            index = tick & self.WHEEL_MASK
+            slot = self._wheel[0][index]
+            self._wheel[0][index] = collections.OrderedDict()
+            self._run(slot)
+            self._run_expired()
+
+    def _run_expired(self):
+        # including the ones scheduled by the callables that just ran
+        while self._expired:
+            slot = self._expired
+            self._expired = collections.OrderedDict()
+            self._run(slot)
 
 
 class Requests(object):
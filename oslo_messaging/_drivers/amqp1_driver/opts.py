@@ -21,6 +21,15 @@ amqp1_opts = [
                help='Name for the AMQP container. must be globally unique.'
                     ' Defaults to a generated UUID'),
 
+    cfg.IntOpt('connection_count',
+               default=1,
+               min=1,
+               help='Number of connections to the messaging service, each'
+                    ' with its own I/O thread and RPC reply link. Senders'
+                    ' and subscriptions are spread over them by address.'
+                    ' When container_name is set, the index of the'
+                    ' connection is appended to it.'),
+
     cfg.IntOpt('idle_timeout',
                default=0,  # disabled
                deprecated_group='amqp1',
@@ -242,5 +251,20 @@ amqp1_opts = [
                     "'rpc-call' - send RPC Calls pre-settled\n"
                     "'rpc-reply'- send RPC Replies pre-settled\n"
                     "'rpc-cast' - Send RPC Casts pre-settled\n"
-                    "'notify'   - Send Notifications pre-settled\n")
+                    "'notify'   - Send Notifications pre-settled\n"),
+
+    # Message encoding
+
+    cfg.StrOpt('message_encoding',
+               default='json',
+               choices=('json', 'native'),
+               help="How the body of the messages sent is encoded.\n"
+               "Permitted values:\n"
+               "'json'   - a JSON string, understood by all the releases\n"
+               "'native' - AMQP 1.0 typed maps and lists, encoded once by\n"
+               "the proton codec. Messages are smaller and readable by any\n"
+               "AMQP 1.0 peer, but the codec may use more CPU than JSON.\n"
+               "Only enable it once all the services are upgraded: RPC\n"
+               "replies always use the encoding of the request and\n"
+               "messages in both encodings are accepted.")
 ]
@@ -22,6 +22,7 @@ import uuid
 
 import cachetools
 from oslo_utils import timeutils
+import six
 from six import moves
 
 import oslo_messaging
@@ -39,18 +40,26 @@ LOG = logging.getLogger(__name__)
 class AMQPIncomingMessage(base.RpcIncomingMessage):
 
     def __init__(self, listener, ctxt, message, unique_id, msg_id, reply_q,
-                 obsolete_reply_queues):
+                 obsolete_reply_queues, stream=False):
         super(AMQPIncomingMessage, self).__init__(ctxt, message)
         self.listener = listener
 
         self.unique_id = unique_id
         self.msg_id = msg_id
         self.reply_q = reply_q
+        self.stream = bool(stream)
+        # NOTE: older callers ask for a stream without flow control
+        if isinstance(stream, dict):
+            self._stream_window = stream.get('window')
+            self._stream_timeout = stream.get('timeout')
+        else:
+            self._stream_window = self._stream_timeout = None
         self._obsolete_reply_queues = obsolete_reply_queues
         self.stopwatch = timeutils.StopWatch()
         self.stopwatch.start()
 
-    def _send_reply(self, conn, reply=None, failure=None):
+    def _send_reply(self, conn, reply=None, failure=None, ending=True,
+                    extra=None):
         if not self._obsolete_reply_queues.reply_q_valid(self.reply_q,
                                                          self.msg_id):
             return
@@ -59,8 +68,12 @@ class AMQPIncomingMessage(base.RpcIncomingMessage):
             failure = rpc_common.serialize_remote_exception(failure)
         # NOTE(sileht): ending can be removed in N*, see Listener.wait()
         # for more detail.
-        msg = {'result': reply, 'failure': failure, 'ending': True,
+        # NOTE: ending is also used by streamed replies, every item of the
+        # stream is sent with ending=False.
+        msg = {'result': reply, 'failure': failure, 'ending': ending,
                '_msg_id': self.msg_id}
+        if extra:
+            msg.update(extra)
         rpc_amqp._add_unique_id(msg)
         unique_id = msg[rpc_amqp.UNIQUE_ID]
 
@@ -74,15 +87,44 @@ class AMQPIncomingMessage(base.RpcIncomingMessage):
         conn.direct_send(self.reply_q, rpc_common.serialize_msg(msg))
 
     def reply(self, reply=None, failure=None):
+        self._reply(reply, failure)
+
+    def reply_stream(self, replies):
+        if not self.stream:
+            return super(AMQPIncomingMessage, self).reply_stream(replies)
+
+        credit = None
+        if self._stream_window and self.msg_id:
+            credit = StreamCredit(self.listener.driver, self._stream_window,
+                                  self._stream_timeout)
+        try:
+            for reply in replies:
+                # NOTE: stop generating the reply once the caller is gone,
+                # cancelled the stream or stopped consuming it
+                if credit is not None and not credit.take():
+                    replies.close()
+                    return
+                if not self._reply(reply, ending=False,
+                                   extra=credit and credit.address()):
+                    replies.close()
+                    return
+            self._reply()
+        finally:
+            if credit is not None:
+                credit.close()
+
+    def _reply(self, reply=None, failure=None, ending=True, extra=None):
+        # NOTE: returns False when the reply is not expected or can no longer
+        # be delivered to the caller
         if not self.msg_id:
             # NOTE(Alexei_987) not sending reply, if msg_id is empty
             #    because reply should not be expected by caller side
-            return
+            return False
 
         # NOTE(sileht): return without hold the a connection if possible
         if not self._obsolete_reply_queues.reply_q_valid(self.reply_q,
                                                          self.msg_id):
-            return
+            return False
 
         # NOTE(sileht): we read the configuration value from the driver
         # to be able to backport this change in previous version that
@@ -95,8 +137,8 @@ class AMQPIncomingMessage(base.RpcIncomingMessage):
             try:
                 with self.listener.driver._get_connection(
                         rpc_common.PURPOSE_SEND) as conn:
-                    self._send_reply(conn, reply, failure)
-                return
+                    self._send_reply(conn, reply, failure, ending, extra)
+                return True
             except rpc_amqp.AMQPDestinationNotFound:
                 if timer.check_return() > 0:
                     LOG.debug(("The reply %(msg_id)s cannot be sent  "
@@ -113,7 +155,7 @@ class AMQPIncomingMessage(base.RpcIncomingMessage):
                                      'msg_id': self.msg_id,
                                      'reply_q': self.reply_q,
                                      'duration': duration})
-                    return
+                    return False
 
     def acknowledge(self):
         self.message.acknowledge()
@@ -129,6 +171,59 @@ class AMQPIncomingMessage(base.RpcIncomingMessage):
         self.message.requeue()
 
 
+class StreamCredit(object):
+    """Number of items of a streamed reply a server may still send.
+
+    The server starts with the window of the caller and waits for more
+    credit once it is used up. The first item sent tells the caller the
+    reply queue of the server and the id to grant credit to, the caller
+    granting credit as it consumes the items, or cancelling the stream when
+    it is closed before the end.
+    """
+
+    def __init__(self, driver, window, timeout):
+        self.reply_q = driver._get_reply_q()
+        self.credit_id = uuid.uuid4().hex
+        self._waiter = driver._waiter
+        self._waiter.listen(self.credit_id)
+        self._credit = window
+        self._timeout = timeout
+        self._announced = False
+
+    def address(self):
+        """Return the fields telling the caller where to grant credit."""
+        if self._announced:
+            return None
+        self._announced = True
+        return {'_credit_q': self.reply_q, '_credit_id': self.credit_id}
+
+    def take(self):
+        """Use the credit of an item, wait for the caller to grant some if
+        needed. Return False if the caller cancelled the stream or did not
+        grant any credit within the timeout of its call.
+        """
+        while True:
+            try:
+                message = self._waiter.waiters.get(
+                    self.credit_id, self._timeout if not self._credit else 0)
+            except oslo_messaging.MessagingTimeout:
+                if not self._credit:
+                    LOG.warning(_LW("No credit granted for the stream "
+                                    "%s, abandoning it"), self.credit_id)
+                    return False
+                break
+            if message.get('cancel'):
+                LOG.debug("Stream %s cancelled by the caller",
+                          self.credit_id)
+                return False
+            self._credit += message['result']
+        self._credit -= 1
+        return True
+
+    def close(self):
+        self._waiter.unlisten(self.credit_id)
+
+
 class ObsoleteReplyQueuesCache(object):
     """Cache of reply queue id that doesn't exists anymore.
 
@@ -187,6 +282,7 @@ class AMQPListener(base.PollStyleListener):
 
     def __call__(self, message):
         ctxt = rpc_amqp.unpack_context(message)
+        stream = message.pop('_stream', False)
         unique_id = self.msg_id_cache.check_duplicate_message(message)
         if ctxt.msg_id:
             LOG.debug("received message msg_id: %(msg_id)s reply to "
@@ -200,7 +296,8 @@ class AMQPListener(base.PollStyleListener):
                                                  unique_id,
                                                  ctxt.msg_id,
                                                  ctxt.reply_q,
-                                                 self._obsolete_reply_queues))
+                                                 self._obsolete_reply_queues,
+                                                 stream))
 
     @base.batch_poll_helper
     def poll(self, timeout=None):
@@ -246,8 +343,13 @@ class ReplyWaiters(object):
         else:
             queue.put(message_data)
 
-    def add(self, msg_id):
-        self._queues[msg_id] = moves.queue.Queue()
+    def add(self, msg_id, shared_with=None):
+        if shared_with is not None:
+            # NOTE: replies to msg_id are delivered to the queue of the
+            # shared_with msg_id
+            self._queues[msg_id] = self._queues[shared_with]
+        else:
+            self._queues[msg_id] = moves.queue.Queue()
         queues_length = len(self._queues)
         if queues_length > self._wrn_threshold:
             LOG.warning(_LW('Number of call queues is %(queues_length)s, '
@@ -262,6 +364,95 @@ class ReplyWaiters(object):
     def remove(self, msg_id):
         del self._queues[msg_id]
 
+    def __contains__(self, msg_id):
+        return msg_id in self._queues
+
+
+class ReplyStream(six.Iterator):
+    """Iterator over the items of a streamed reply.
+
+    Every reply message received with ending=False carries a single item of
+    the stream. The final message, received with ending=True, carries either
+    the failure raised by the remote endpoint, nothing at all or, when the
+    server did not stream its reply, the whole result which is iterated over.
+
+    When the caller asked for a window, the server sends at most that many
+    items ahead of the ones consumed. The stream grants the server credit
+    for half a window of items each time they are consumed, see
+    StreamCredit.
+
+    The reply queue for the msg_id is released once the stream is exhausted,
+    fails, is closed or is garbage collected. Closing the stream before the
+    end cancels it, the server stops generating the reply.
+    """
+
+    _marker = object()
+
+    def __init__(self, waiter, msg_id, timeout, window=0, grant=None):
+        self._waiter = waiter
+        self._msg_id = msg_id
+        self._timeout = timeout
+        self._items = iter(())
+        self._ending = False
+        self._closed = False
+        self._grant = grant
+        self._batch = max(1, window // 2)
+        self._consumed = 0
+        self._credit_to = None
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        while True:
+            item = next(self._items, self._marker)
+            if item is not self._marker:
+                if self._credit_to is not None and not self._ending:
+                    self._consumed += 1
+                    if self._consumed >= self._batch:
+                        self._send_credit(self._consumed)
+                        self._consumed = 0
+                return item
+            if self._ending:
+                self.close()
+                raise StopIteration()
+            try:
+                self._items = self._next_items()
+            except Exception:
+                self.close()
+                raise
+
+    def _next_items(self):
+        message = self._waiter.waiters.get(self._msg_id, self._timeout)
+        if '_credit_q' in message and self._grant is not None:
+            self._credit_to = (message['_credit_q'], message['_credit_id'])
+        reply, self._ending = self._waiter._process_reply(message)
+        if isinstance(reply, Exception):
+            raise reply
+        if not self._ending:
+            return iter([reply])
+        # NOTE: the ending reply of a stream carries no result, the one of a
+        # request which was not streamed carries the whole result
+        return base.iter_reply(reply)
+
+    def _send_credit(self, credit=0, cancel=False):
+        reply_q, credit_id = self._credit_to
+        try:
+            self._grant(reply_q, credit_id, credit, cancel)
+        except Exception:
+            LOG.warning(_LW("Failed to grant credit to the stream %s"),
+                        credit_id, exc_info=True)
+
+    def close(self):
+        if not self._closed:
+            self._closed = True
+            self._waiter.unlisten(self._msg_id)
+            if self._credit_to is not None and not self._ending:
+                self._send_credit(cancel=True)
+
+    def __del__(self):
+        self.close()
+
 
 class ReplyWaiter(object):
     def __init__(self, reply_q, conn, allowed_remote_exmods):
@@ -297,10 +488,15 @@ class ReplyWaiter(object):
         incoming_msg_id = message.pop('_msg_id', None)
         if message.get('ending'):
             LOG.debug("received reply msg_id: %s", incoming_msg_id)
+        elif incoming_msg_id not in self.waiters:
+            # NOTE: an item of a stream closed by the caller, or credit
+            # granted to a stream which already ended
+            LOG.debug("dropping reply to msg_id: %s", incoming_msg_id)
+            return
         self.waiters.put(incoming_msg_id, message)
 
-    def listen(self, msg_id):
-        self.waiters.add(msg_id)
+    def listen(self, msg_id, shared_with=None):
+        self.waiters.add(msg_id, shared_with)
 
     def unlisten(self, msg_id):
         self.waiters.remove(msg_id)
@@ -348,9 +544,13 @@ class ReplyWaiter(object):
                 final_reply = reply
         return final_reply
 
+    def stream(self, msg_id, timeout, window=0, grant=None):
+        return ReplyStream(self, msg_id, timeout, window, grant)
+
 
 class AMQPDriverBase(base.BaseDriver):
     missing_destination_retry_timeout = 0
+    stream_window = 0
 
     def __init__(self, conf, url, connection_pool,
                  default_exchange=None, allowed_remote_exmods=None):
@@ -390,16 +590,56 @@ class AMQPDriverBase(base.BaseDriver):
 
         return self._reply_q
 
+    def _publish(self, target, msg, log_msg, notify=False, timeout=None,
+                 retry=None, priority=None):
+        with self._get_connection(rpc_common.PURPOSE_SEND) as conn:
+            if notify:
+                exchange = self._get_exchange(target)
+                log_msg += "NOTIFY exchange '%(exchange)s'" \
+                           " topic '%(topic)s'" % {
+                               'exchange': exchange,
+                               'topic': target.topic}
+                LOG.debug(log_msg)
+                conn.notify_send(exchange, target.topic, msg, retry=retry)
+            elif target.fanout:
+                log_msg += "FANOUT topic '%(topic)s'" % {
+                    'topic': target.topic}
+                LOG.debug(log_msg)
+                conn.fanout_send(target.topic, msg, retry=retry)
+            else:
+                topic = target.topic
+                exchange = self._get_exchange(target)
+                if target.server:
+                    topic = '%s.%s' % (target.topic, target.server)
+                log_msg += "exchange '%(exchange)s'" \
+                           " topic '%(topic)s'" % {
+                               'exchange': exchange,
+                               'topic': topic}
+                LOG.debug(log_msg)
+                conn.topic_send(exchange_name=exchange, topic=topic,
+                                msg=msg, timeout=timeout, retry=retry,
+                                priority=priority)
+
     def _send(self, target, ctxt, message,
               wait_for_reply=None, timeout=None,
-              envelope=True, notify=False, retry=None):
+              envelope=True, notify=False, retry=None, stream=False,
+              hedge_delay=None):
+
+        if hedge_delay is not None:
+            # NOTE: keep a pristine copy, the message is updated in place below
+            hedge_message = dict(message)
 
         msg = message
+        # NOTE: notifications carry their own, unrelated, priority
+        priority = None if notify else message.get('priority')
 
         if wait_for_reply:
             msg_id = uuid.uuid4().hex
             msg.update({'_msg_id': msg_id})
             msg.update({'_reply_q': self._get_reply_q()})
+            if stream:
+                msg.update({'_stream': {'window': self.stream_window,
+                                        'timeout': timeout}})
 
         rpc_amqp._add_unique_id(msg)
         unique_id = msg[rpc_amqp.UNIQUE_ID]
@@ -415,48 +655,87 @@ class AMQPDriverBase(base.BaseDriver):
         else:
             log_msg = "CAST unique_id: %s " % unique_id
 
+        # NOTE: the stream returned to the caller stops listening for the
+        # replies once it is consumed
+        streaming = False
         try:
-            with self._get_connection(rpc_common.PURPOSE_SEND) as conn:
-                if notify:
-                    exchange = self._get_exchange(target)
-                    log_msg += "NOTIFY exchange '%(exchange)s'" \
-                               " topic '%(topic)s'" % {
-                                   'exchange': exchange,
-                                   'topic': target.topic}
-                    LOG.debug(log_msg)
-                    conn.notify_send(exchange, target.topic, msg, retry=retry)
-                elif target.fanout:
-                    log_msg += "FANOUT topic '%(topic)s'" % {
-                        'topic': target.topic}
-                    LOG.debug(log_msg)
-                    conn.fanout_send(target.topic, msg, retry=retry)
-                else:
-                    topic = target.topic
-                    exchange = self._get_exchange(target)
-                    if target.server:
-                        topic = '%s.%s' % (target.topic, target.server)
-                    log_msg += "exchange '%(exchange)s'" \
-                               " topic '%(topic)s'" % {
-                                   'exchange': exchange,
-                                   'topic': topic}
-                    LOG.debug(log_msg)
-                    conn.topic_send(exchange_name=exchange, topic=topic,
-                                    msg=msg, timeout=timeout, retry=retry)
+            self._publish(target, msg, log_msg, notify=notify,
+                          timeout=timeout, retry=retry, priority=priority)
 
             if wait_for_reply:
-                result = self._waiter.wait(msg_id, timeout)
+                if stream:
+                    streaming = True
+                    return self._waiter.stream(msg_id, timeout,
+                                               self.stream_window,
+                                               self._grant_credit)
+                if hedge_delay is not None:
+                    result = self._wait_hedged(target, ctxt, hedge_message,
+                                               msg_id, hedge_delay, timeout,
+                                               retry)
+                else:
+                    result = self._waiter.wait(msg_id, timeout)
                 if isinstance(result, Exception):
                     raise result
                 return result
         finally:
-            if wait_for_reply:
+            if wait_for_reply and not streaming:
                 self._waiter.unlisten(msg_id)
 
+    def _grant_credit(self, reply_q, credit_id, credit=0, cancel=False):
+        msg = {'_msg_id': credit_id, 'result': credit, 'failure': None,
+               'ending': False, 'cancel': cancel}
+        with self._get_connection(rpc_common.PURPOSE_SEND) as conn:
+            conn.direct_send(reply_q, rpc_common.serialize_msg(msg))
+
+    def _wait_hedged(self, target, ctxt, message, msg_id, hedge_delay,
+                     timeout, retry):
+        timer = rpc_common.DecayingTimer(duration=timeout)
+        timer.start()
+        try:
+            return self._waiter.wait(msg_id, hedge_delay)
+        except oslo_messaging.MessagingTimeout:
+            remaining = timer.check_return()
+            if remaining is not None and remaining <= 0:
+                raise
+
+        # NOTE: the replies to both requests are delivered to the queue of
+        # the original msg_id, whichever comes first is returned. Once both
+        # msg_ids are unlistened the late reply is dropped by ReplyWaiters.
+        hedge_msg_id = uuid.uuid4().hex
+        message.update({'_msg_id': hedge_msg_id})
+        message.update({'_reply_q': self._get_reply_q()})
+        rpc_amqp._add_unique_id(message)
+        rpc_amqp.pack_context(message, ctxt)
+        msg = rpc_common.serialize_msg(message)
+
+        self._waiter.listen(hedge_msg_id, shared_with=msg_id)
+        try:
+            log_msg = ("CALL msg_id: %(msg_id)s hedging %(hedged)s after "
+                       "%(delay).3fs " % {'msg_id': hedge_msg_id,
+                                          'hedged': msg_id,
+                                          'delay': hedge_delay})
+            remaining = timer.check_return()
+            self._publish(target, msg, log_msg, timeout=remaining,
+                          retry=retry, priority=message.get('priority'))
+            return self._waiter.wait(msg_id, timer.check_return())
+        finally:
+            self._waiter.unlisten(hedge_msg_id)
+
     def send(self, target, ctxt, message, wait_for_reply=None, timeout=None,
              retry=None):
         return self._send(target, ctxt, message, wait_for_reply, timeout,
                           retry=retry)
 
+    def send_stream(self, target, ctxt, message, timeout=None, retry=None):
+        return self._send(target, ctxt, message, wait_for_reply=True,
+                          timeout=timeout, retry=retry, stream=True)
+
+    def send_hedged(self, target, ctxt, message, hedge_delay, timeout=None,
+                    retry=None):
+        return self._send(target, ctxt, message, wait_for_reply=True,
+                          timeout=timeout, retry=retry,
+                          hedge_delay=hedge_delay)
+
     def send_notification(self, target, ctxt, message, version, retry=None):
         return self._send(target, ctxt, message,
                           envelope=(version == 2.0), notify=True, retry=retry)
@@ -468,11 +747,13 @@ class AMQPDriverBase(base.BaseDriver):
 
         conn.declare_topic_consumer(exchange_name=self._get_exchange(target),
                                     topic=target.topic,
-                                    callback=listener)
+                                    callback=listener,
+                                    prioritized=True)
         conn.declare_topic_consumer(exchange_name=self._get_exchange(target),
                                     topic='%s.%s' % (target.topic,
                                                      target.server),
-                                    callback=listener)
+                                    callback=listener,
+                                    prioritized=True)
         conn.declare_fanout_consumer(target.topic, listener)
 
         return base.PollStyleListenerAdapter(listener, batch_size,
@@ -486,7 +767,7 @@ class AMQPDriverBase(base.BaseDriver):
         # queues can be really big when the consumer have disapear during a
         # long period, and when it come back, kombu/pyamqp will fetch all
         # messages it can. So we override the default qos prefetch value
-        conn.connection.rabbit_qos_prefetch_count = batch_size
+        conn.connection.set_prefetch_count(batch_size)
 
         listener = AMQPListener(self, conn)
         for target, priority in targets_and_priorities:
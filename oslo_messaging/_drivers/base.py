@@ -30,7 +30,14 @@ base_opts = [
     cfg.IntOpt('conn_pool_min_size', default=2,
                help='The pool size limit for connections expiration policy'),
     cfg.IntOpt('conn_pool_ttl', default=1200,
-               help='The time-to-live in sec of idle connections in the pool')
+               help='The time-to-live in sec of idle connections in the pool'),
+    cfg.BoolOpt('conn_pool_warmup', default=False,
+                help='Open conn_pool_min_size connections in the background '
+                     'when the driver is loaded rather than on first use.'),
+    cfg.IntOpt('conn_pool_validate_after', default=0, min=0,
+               help='Check that connections idle in the pool for at least '
+                    'this many seconds are still usable before handing them '
+                    'out. 0 disables the check.'),
 ]
 
 
@@ -72,6 +79,20 @@ def batch_poll_helper(func):
     return wrapper
 
 
+def iter_reply(reply):
+    """Iterate over the items of a reply to a streamed call which was not
+    streamed.
+
+    A list (or tuple) reply is made of its items and a None reply of no
+    item. Any other reply, including strings and dicts, is a single item.
+    """
+    if reply is None:
+        return iter(())
+    if isinstance(reply, (list, tuple)):
+        return iter(reply)
+    return iter([reply])
+
+
 class TransportDriverError(exceptions.MessagingException):
     """Base class for transport driver specific exceptions."""
 
@@ -166,6 +187,27 @@ class RpcIncomingMessage(IncomingMessage):
         :raises: Does not raise an exception
         """
 
+    def reply_stream(self, replies):
+        """Called by the server when the endpoint method returned a generator.
+        Each item produced by *replies* should be sent back to the calling
+        client as a separate reply message as soon as it is available, so
+        that neither side has to hold the complete result in memory.  The
+        stream is terminated by a final reply that carries no result.
+
+        Drivers that cannot stream replies, or requests that did not ask for
+        a streamed reply (see :py:meth:`BaseDriver.send_stream`), fall back
+        to this default implementation which collects all the items and sends
+        them as a single list reply.
+
+        Any exception raised while iterating *replies* must be propagated to
+        the caller so that the server can report it to the client with
+        :py:meth:`reply`.
+
+        :param replies: the items to send back to the client
+        :type replies: iterator
+        """
+        self.reply(list(replies))
+
 
 @six.add_metaclass(abc.ABCMeta)
 class PollStyleListener(object):
@@ -432,6 +474,78 @@ class BaseDriver(object):
             remote server when executing the RPC call.
         """
 
+    def send_stream(self, target, ctxt, message, timeout=None, retry=None):
+        """Send an RPC request to the given target and return an iterator over
+        the items of its reply.  This method is used by the RPC client when
+        the caller wants to consume a large result incrementally.
+
+        Addressing, *retry* and error handling follow the same rules as
+        :py:meth:`BaseDriver.send` with *wait_for_reply* set.  The returned
+        iterator blocks for at most *timeout* seconds waiting for each item,
+        so a slow producer does not cause the stream to time out as long as
+        it keeps making progress.  The driver must stop listening for the
+        reply once the stream is exhausted or the iterator is discarded.
+
+        Drivers that do not support streamed replies may rely on this default
+        implementation, which waits for the complete reply and iterates over
+        it.
+
+        :param target: The message's destination address
+        :type target: Target
+        :param ctxt: Context metadata provided by sending application which
+            must transfered along with the message.
+        :type ctxt: dict
+        :param message: message provided by the caller
+        :type message: dict
+        :param timeout: Maximum time in seconds to block waiting for each
+            item of the reply
+        :type timeout: float
+        :param retry: maximum message send attempts permitted
+        :type retry: int
+        :returns: An iterator over the reply items
+        :raises: :py:exc:`MessagingException`, any exception thrown by the
+            remote server when executing the RPC call.
+        """
+        reply = self.send(target, ctxt, message, wait_for_reply=True,
+                          timeout=timeout, retry=retry)
+        return iter_reply(reply)
+
+    def send_hedged(self, target, ctxt, message, hedge_delay, timeout=None,
+                    retry=None):
+        """Send an RPC request to the given target and wait for its reply,
+        sending a duplicate of the request if no reply arrived after
+        *hedge_delay* seconds.  This method is used by the RPC client to cut
+        the tail latency of idempotent calls.
+
+        The first reply received for either request is returned, the reply to
+        the other one must be discarded.  Addressing, *timeout*, *retry* and
+        error handling follow the same rules as :py:meth:`BaseDriver.send`
+        with *wait_for_reply* set, *timeout* applying to the call as a whole.
+
+        Drivers that cannot correlate the replies of two requests may rely on
+        this default implementation, which sends a single request.
+
+        :param target: The message's destination address
+        :type target: Target
+        :param ctxt: Context metadata provided by sending application which
+            must transfered along with the message.
+        :type ctxt: dict
+        :param message: message provided by the caller
+        :type message: dict
+        :param hedge_delay: Time in seconds to wait for a reply before sending
+            the duplicate request
+        :type hedge_delay: float
+        :param timeout: Maximum time in seconds to block waiting for a reply
+        :type timeout: float
+        :param retry: maximum message send attempts permitted
+        :type retry: int
+        :returns: A reply message or None if no reply expected
+        :raises: :py:exc:`MessagingException`, any exception thrown by the
+            remote server when executing the RPC call.
+        """
+        return self.send(target, ctxt, message, wait_for_reply=True,
+                         timeout=timeout, retry=retry)
+
     @abc.abstractmethod
     def send_notification(self, target, ctxt, message, version, retry):
         """Send a notification message to the given target. This method is used
@@ -458,16 +458,26 @@ class ConfigOptsProxy(collections.Mapping):
 
     Values from the query part of the transport url (if they are both present
     and valid) override corresponding values from the configuration.
+
+    The values converted from the url are cached, they do not change with
+    the configuration. The other ones are read from the configuration each
+    time, through its own cache which overrides and reloads do invalidate.
     """
 
     def __init__(self, conf, url):
         self._conf = conf
         self._url = url
+        self._groups = {}
 
     def __getattr__(self, name):
+        group = self._groups.get(name)
+        if group is not None:
+            return group
         value = getattr(self._conf, name)
         if isinstance(value, self._conf.GroupAttr):
-            return self.GroupAttrProxy(self._conf, name, value, self._url)
+            group = self.GroupAttrProxy(self._conf, name, value, self._url)
+            self._groups[name] = group
+            return group
         return value
 
     def __getitem__(self, name):
@@ -492,8 +502,15 @@ class ConfigOptsProxy(collections.Mapping):
             self._group_name = group_name
             self._group = group
             self._url = url
+            self._url_values = {}
 
         def __getattr__(self, opt_name):
+            value = self._url_values.get(opt_name, self._VOID_MARKER)
+            if value is self._VOID_MARKER:
+                value = self._resolve(opt_name)
+            return value
+
+        def _resolve(self, opt_name):
             # Make sure that the group has this specific option
             opt_value_conf = getattr(self._group, opt_name)
             # If the option is also present in the url and has a valid
@@ -502,7 +519,9 @@ class ConfigOptsProxy(collections.Mapping):
             if opt_value_url is self._VOID_MARKER:
                 return opt_value_conf
             opt_info = self._conf._get_opt_info(opt_name, self._group_name)
-            return opt_info['opt'].type(opt_value_url)
+            value = self._url_values[opt_name] = opt_info['opt'].type(
+                opt_value_url)
+            return value
 
         def __getitem__(self, opt_name):
             return self.__getattr__(opt_name)
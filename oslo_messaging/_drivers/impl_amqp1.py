@@ -31,6 +31,7 @@ from oslo_messaging.target import Target
 from oslo_serialization import jsonutils
 from oslo_utils import importutils
 from oslo_utils import timeutils
+import six
 
 from oslo_messaging._drivers.amqp1_driver.eventloop import compute_timeout
 from oslo_messaging._drivers.amqp1_driver import opts
@@ -46,7 +47,38 @@ controller = importutils.try_import(
 LOG = logging.getLogger(__name__)
 
 
-def marshal_response(reply, failure):
+_NATIVE_TYPES = (six.text_type, six.binary_type, float, bool,
+                 type(None)) + six.integer_types
+
+
+def _to_native(value):
+    # The proton codec encodes python dicts, lists and scalars as their AMQP
+    # counterparts. Convert anything else as jsonutils.dumps() would, and
+    # send py2 strs as AMQP strings rather than binaries.
+    if isinstance(value, dict):
+        return dict((_to_native(k) if isinstance(k, six.string_types)
+                     else jsonutils.dumps(k), _to_native(v))
+                    for k, v in value.items())
+    if isinstance(value, (list, tuple)):
+        return [_to_native(v) for v in value]
+    if six.PY2 and isinstance(value, str):
+        return value.decode('utf-8')
+    if isinstance(value, _NATIVE_TYPES):
+        return value
+    primitive = jsonutils.to_primitive(value, convert_instances=True)
+    if primitive is value:
+        raise TypeError("%r cannot be encoded as an AMQP type" % value)
+    return _to_native(primitive)
+
+
+def _decode_body(body):
+    # natively encoded messages carry an AMQP map, the others a JSON string
+    if isinstance(body, dict):
+        return body
+    return jsonutils.loads(body)
+
+
+def marshal_response(reply, failure, native=False):
     # TODO(grs): do replies have a context?
     # NOTE(flaper87): Set inferred to True since rabbitmq-amqp-1.0 doesn't
     # have support for vbin8.
@@ -56,24 +88,29 @@ def marshal_response(reply, failure):
         data = {"failure": failure}
     else:
         data = {"response": reply}
-    msg.body = jsonutils.dumps(data)
+    msg.body = _to_native(data) if native else jsonutils.dumps(data)
     return msg
 
 
 def unmarshal_response(message, allowed):
     # TODO(kgiusti) This may fail to unpack and raise an exception. Need to
     # communicate this to the caller!
-    data = jsonutils.loads(message.body)
+    data = _decode_body(message.body)
     failure = data.get('failure')
     if failure is not None:
         raise common.deserialize_remote_exception(failure, allowed)
     return data.get("response")
 
 
-def marshal_request(request, context, envelope):
+def marshal_request(request, context, envelope, native=False):
     # NOTE(flaper87): Set inferred to True since rabbitmq-amqp-1.0 doesn't
     # have support for vbin8.
     msg = proton.Message(inferred=True)
+    if native:
+        # the body is encoded once, by the proton codec: the envelope
+        # protecting the request with an extra layer of JSON is not needed
+        msg.body = _to_native({"request": request, "context": context})
+        return msg
     if envelope:
         request = common.serialize_msg(request)
     data = {
@@ -85,7 +122,7 @@ def marshal_request(request, context, envelope):
 
 
 def unmarshal_request(message):
-    data = jsonutils.loads(message.body)
+    data = _decode_body(message.body)
     msg = common.deserialize_msg(data.get("request"))
     return (msg, data.get("context"))
 
@@ -97,11 +134,13 @@ class ProtonIncomingMessage(base.RpcIncomingMessage):
         self._reply_to = message.reply_to
         self._correlation_id = message.id
         self._disposition = disposition
+        # reply with the encoding of the request, understood by its sender
+        self._native = isinstance(message.body, dict)
 
     def reply(self, reply=None, failure=None):
         """Schedule an RPCReplyTask to send the reply."""
         if self._reply_to:
-            response = marshal_response(reply, failure)
+            response = marshal_response(reply, failure, native=self._native)
             response.correlation_id = self._correlation_id
             driver = self.listener.driver
             deadline = compute_timeout(driver._default_reply_timeout)
@@ -111,7 +150,7 @@ class ProtonIncomingMessage(base.RpcIncomingMessage):
                                        deadline,
                                        retry=0,
                                        wait_for_ack=ack)
-            driver._ctrl.add_task(task)
+            self.listener.ctrl.add_task(task)
             rc = task.wait()
             if rc:
                 # something failed.  Not much we can do at this point but log
@@ -123,13 +162,13 @@ class ProtonIncomingMessage(base.RpcIncomingMessage):
         """Schedule a MessageDispositionTask to send the settlement."""
         task = controller.MessageDispositionTask(self._disposition,
                                                  released=False)
-        self.listener.driver._ctrl.add_task(task)
+        self.listener.ctrl.add_task(task)
 
     def requeue(self):
         """Schedule a MessageDispositionTask to release the message"""
         task = controller.MessageDispositionTask(self._disposition,
                                                  released=True)
-        self.listener.driver._ctrl.add_task(task)
+        self.listener.ctrl.add_task(task)
 
 
 class Queue(object):
@@ -162,9 +201,11 @@ class Queue(object):
 
 
 class ProtonListener(base.PollStyleListener):
-    def __init__(self, driver):
+    def __init__(self, driver, ctrl):
         super(ProtonListener, self).__init__(driver.prefetch_size)
         self.driver = driver
+        # the messages must be settled by the controller they came from
+        self.ctrl = ctrl
         self.incoming = Queue()
         self.id = uuid.uuid4().hex
 
@@ -205,9 +246,10 @@ class ProtonDriver(base.BaseDriver):
         self._conf = conf
         self._default_exchange = default_exchange
 
-        # lazy connection setup - don't create the controller until
+        # lazy connection setup - don't create the controllers until
         # after the first messaging request:
-        self._ctrl = None
+        self._ctrls = []
+        self._connection_count = conf.oslo_messaging_amqp.connection_count
         self._pid = None
         self._lock = threading.Lock()
 
@@ -229,9 +271,12 @@ class ProtonDriver(base.BaseDriver):
             LOG.warning(_LW("Ignoring unrecognized pre_settle value(s): %s"),
                         " ".join(bad_opts))
 
+        # encode the messages sent with AMQP types rather than JSON?
+        self._native_encoding = opt_name.message_encoding == 'native'
+
     def _ensure_connect_called(func):
-        """Causes a new controller to be created when the messaging service is
-        first used by the current process. It is safe to push tasks to it
+        """Causes new controllers to be created when the messaging service is
+        first used by the current process. It is safe to push tasks to them
         whether connected or not, but those tasks won't be processed until
         connection completes.
         """
@@ -244,24 +289,30 @@ class ProtonDriver(base.BaseDriver):
                 self._pid = os.getpid()
 
                 if old_pid != self._pid:
-                    if self._ctrl is not None:
-                        # fork was called after the Controller was created, and
-                        # we are now executing as the child process.  Do not
-                        # touch the existing Controller - it is owned by the
-                        # parent.  Best we can do here is simply drop it and
-                        # hope we get lucky.
+                    if self._ctrls:
+                        # fork was called after the Controllers were created,
+                        # and we are now executing as the child process.  Do
+                        # not touch the existing Controllers - they are owned
+                        # by the parent.  Best we can do here is simply drop
+                        # them and hope we get lucky.
                         LOG.warning(_LW("Process forked after connection "
                                         "established!"))
-                        self._ctrl = None
-                    # Create a Controller that connects to the messaging
+                        self._ctrls = []
+                    # Create the Controllers that connect to the messaging
                     # service:
-                    self._ctrl = controller.Controller(self._hosts,
-                                                       self._default_exchange,
-                                                       self._conf)
-                    self._ctrl.connect()
+                    for index in range(self._connection_count):
+                        ctrl = controller.Controller(self._hosts,
+                                                     self._default_exchange,
+                                                     self._conf, index=index)
+                        ctrl.connect()
+                        self._ctrls.append(ctrl)
             return func(self, *args, **kws)
         return wrap
 
+    def _ctrl_for(self, *address):
+        """Return the controller in charge of the links to address."""
+        return self._ctrls[hash(address) % len(self._ctrls)]
+
     @_ensure_connect_called
     def send(self, target, ctxt, message,
              wait_for_reply=False, timeout=None, envelope=False,
@@ -287,7 +338,8 @@ class ProtonDriver(base.BaseDriver):
                       N means N retries
         :type retry: int
 """
-        request = marshal_request(message, ctxt, envelope)
+        request = marshal_request(message, ctxt, envelope,
+                                  native=self._native_encoding)
         expire = 0
         if timeout:
             expire = compute_timeout(timeout)  # when the caller times out
@@ -307,7 +359,10 @@ class ProtonDriver(base.BaseDriver):
             ack = not self._pre_settle_cast
             task = controller.SendTask("RPC Cast", request, target, expire,
                                        retry, wait_for_ack=ack)
-        self._ctrl.add_task(task)
+        # the reply of a call comes back on the reply link of the controller
+        # the request was sent from
+        self._ctrl_for(target.exchange, target.topic, target.server,
+                       target.fanout).add_task(task)
 
         reply = task.wait()
         if isinstance(reply, Exception):
@@ -338,7 +393,8 @@ class ProtonDriver(base.BaseDriver):
                       N means N retries
         :type retry: int
         """
-        request = marshal_request(message, ctxt, (version == 2.0))
+        request = marshal_request(message, ctxt, (version == 2.0),
+                                  native=self._native_encoding)
         # no timeout is applied to notifications, however if the backend is
         # queueless this could lead to a hang - provide a default to prevent
         # this
@@ -348,7 +404,7 @@ class ProtonDriver(base.BaseDriver):
         task = controller.SendTask("Notify", request, target,
                                    deadline, retry, wait_for_ack=ack,
                                    notification=True)
-        self._ctrl.add_task(task)
+        self._ctrl_for(target.exchange, target.topic).add_task(task)
         rc = task.wait()
         if isinstance(rc, Exception):
             raise rc
@@ -357,9 +413,10 @@ class ProtonDriver(base.BaseDriver):
     def listen(self, target, batch_size, batch_timeout):
         """Construct a Listener for the given target."""
         LOG.debug("Listen to %s", target)
-        listener = ProtonListener(self)
+        ctrl = self._ctrl_for(target.exchange, target.topic, target.server)
+        listener = ProtonListener(self, ctrl)
         task = controller.SubscribeTask(target, listener)
-        self._ctrl.add_task(task)
+        ctrl.add_task(task)
         task.wait()
         return base.PollStyleListenerAdapter(listener, batch_size,
                                              batch_timeout)
@@ -375,7 +432,10 @@ class ProtonDriver(base.BaseDriver):
         if pool:
             raise NotImplementedError('"pool" not implemented by '
                                       'this transport driver')
-        listener = ProtonListener(self)
+        addresses = [(target.exchange, target.topic, priority)
+                     for target, priority in targets_and_priorities]
+        ctrl = self._ctrl_for(*addresses)
+        listener = ProtonListener(self, ctrl)
         # this is how the destination target is created by the notifier,
         # see MessagingDriver.notify in oslo_messaging/notify/messaging.py
         for target, priority in targets_and_priorities:
@@ -383,16 +443,16 @@ class ProtonDriver(base.BaseDriver):
             # Sooo... the exchange is simply discarded? (see above comment)
             task = controller.SubscribeTask(Target(topic=topic),
                                             listener, notifications=True)
-            self._ctrl.add_task(task)
+            ctrl.add_task(task)
             task.wait()
         return base.PollStyleListenerAdapter(listener, batch_size,
                                              batch_timeout)
 
     def cleanup(self):
         """Release all resources."""
-        if self._ctrl:
-            self._ctrl.shutdown()
-            self._ctrl = None
+        for ctrl in self._ctrls:
+            ctrl.shutdown()
+        self._ctrls = []
         LOG.info(_LI("AMQP 1.0 messaging driver shutdown"))
 
     def require_features(self, requeue=True):
@@ -11,19 +11,29 @@
 # WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
 # License for the specific language governing permissions and limitations
 # under the License.
+import collections
+import itertools
 import threading
+import time
+import uuid
 
+from oslo_messaging._drivers import amqpdriver
 from oslo_messaging._drivers import base
 from oslo_messaging._drivers import common as driver_common
 from oslo_messaging._drivers import pool as driver_pool
 from oslo_messaging._i18n import _LE
 from oslo_messaging._i18n import _LW
 from oslo_serialization import jsonutils
+from oslo_utils import encodeutils
+from oslo_utils import excutils
+from oslo_utils import timeutils
 
 import kafka
 from kafka.common import KafkaError
+from kafka import protocol as kafka_protocol
 from oslo_config import cfg
 from oslo_log import log as logging
+from six import moves
 
 
 LOG = logging.getLogger(__name__)
@@ -31,6 +41,8 @@ LOG = logging.getLogger(__name__)
 PURPOSE_SEND = 'send'
 PURPOSE_LISTEN = 'listen'
 
+REPLY_TOPIC = 'oslo_messaging_reply'
+
 kafka_opts = [
     cfg.StrOpt('kafka_default_host', default='localhost',
                deprecated_for_removal=True,
@@ -55,9 +67,82 @@ kafka_opts = [
                help='The pool size limit for connections expiration policy'),
 
     cfg.IntOpt('conn_pool_ttl', default=1200,
-               help='The time-to-live in sec of idle connections in the pool')
+               help='The time-to-live in sec of idle connections in the pool'),
+
+    cfg.StrOpt('producer_acks', default='1', choices=('0', '1', 'all'),
+               help='Acknowledgements the brokers send for each produce '
+                    'request: none, once the leader wrote the messages or '
+                    'once all the in-sync replicas did'),
+
+    cfg.StrOpt('compression_codec', default='none',
+               choices=('none', 'gzip', 'snappy'),
+               help='Codec compressing the messages sent to Kafka'),
+
+    cfg.BoolOpt('producer_async', default=False,
+                help='Send notifications from a background thread, in '
+                     'batches, instead of waiting for Kafka to acknowledge '
+                     'each of them'),
+
+    cfg.IntOpt('producer_batch_size', default=16, min=1,
+               help='Maximum number of messages of a topic sent in a single '
+                    'request by the asynchronous producer'),
+
+    cfg.IntOpt('producer_linger_ms', default=0, min=0,
+               help='Milliseconds the asynchronous producer waits for more '
+                    'messages to fill a batch before sending it'),
+
+    cfg.IntOpt('producer_buffer_size', default=10000, min=1,
+               help='Maximum number of messages waiting to be sent by the '
+                    'asynchronous producer, sending more blocks until some '
+                    'are sent'),
+
+    cfg.BoolOpt('enable_auto_commit', default=False,
+                help='Commit the offsets of the fetched messages '
+                     'periodically, whether they were processed or not. '
+                     'Otherwise the offsets are committed once the messages '
+                     'are acknowledged, so they are delivered at least once '
+                     'and can be requeued'),
+
+    cfg.IntOpt('consumer_commit_batch_size', default=100, min=1,
+               help='Number of acknowledged messages after which their '
+                    'offsets are committed'),
+
+    cfg.IntOpt('consumer_commit_interval_ms', default=1000, min=0,
+               help='Milliseconds after which the offsets of the '
+                    'acknowledged messages are committed, whatever their '
+                    'number, also the interval of the auto commit'),
+
+    cfg.IntOpt('consumer_max_lanes', default=0, min=0,
+               help='Maximum number of lanes handing the notifications of '
+                    'distinct partitions to the listener in parallel, those '
+                    'of a partition being processed one batch after the '
+                    'other in order. 0 hands the notifications over as they '
+                    'are fetched, without any ordering'),
+
+    cfg.IntOpt('consumer_lane_buffer_size', default=100, min=1,
+               help='Maximum number of fetched notifications waiting in a '
+                    'lane, fetching blocks while a lane is full'),
+
+    cfg.IntOpt('rpc_server_announce_interval', default=10, min=1,
+               help='Seconds between the announcements an RPC server sends '
+                    'to the other servers of its topic. The requests sent '
+                    'to the topic are shared out between the servers '
+                    'announced, a server missing three announcements is '
+                    'considered gone'),
 ]
 
+_ACKS = {
+    '0': kafka.SimpleProducer.ACK_NOT_REQUIRED,
+    '1': kafka.SimpleProducer.ACK_AFTER_LOCAL_WRITE,
+    'all': kafka.SimpleProducer.ACK_AFTER_CLUSTER_COMMIT,
+}
+
+_CODECS = {
+    'none': kafka_protocol.CODEC_NONE,
+    'gzip': kafka_protocol.CODEC_GZIP,
+    'snappy': kafka_protocol.CODEC_SNAPPY,
+}
+
 CONF = cfg.CONF
 
 
@@ -71,6 +156,38 @@ def pack_context_with_message(ctxt, msg):
     return {'message': msg, 'context': context_d}
 
 
+def unpack_message(kafka_message, listener):
+    """Convert a message fetched from Kafka into an incoming message."""
+    message = kafka_message.value
+    LOG.debug('poll got message : %s', message)
+    message = jsonutils.loads(message)
+    return OsloKafkaMessage(ctxt=message['context'],
+                            message=message['message'],
+                            listener=listener, kafka_message=kafka_message,
+                            server=message.get('server'),
+                            msg_id=message.get('msg_id'),
+                            reply_topic=message.get('reply_topic'),
+                            reply_key=message.get('reply_key'))
+
+
+def rpc_topic(exchange, topic, kind=None):
+    """Return the Kafka topic carrying the RPC requests of a target
+
+    :param exchange: Exchange of the target
+    :type exchange: string
+    :param topic: Topic of the target
+    :type topic: string
+    :param kind: None for the requests addressed to a server, 'fanout' for
+        the fanout requests, 'shared' for the requests any server may
+        process and 'members' for the announcements of the servers
+    :type kind: string
+    """
+    name = '%s_%s' % (exchange, topic)
+    if kind:
+        name += '_' + kind
+    return name
+
+
 def target_to_topic(target, priority=None):
     """Convert target into topic string
 
@@ -84,6 +201,198 @@ def target_to_topic(target, priority=None):
     return target.topic + '.' + priority
 
 
+class AsyncProducer(object):
+    """Send messages from a background thread, in batches.
+
+    Messages are buffered in a bounded queue, sending blocks while it is
+    full. The thread gathers up to ``batch_size`` messages, waiting at most
+    ``linger`` seconds for more once it got the first one, and sends the
+    messages of each topic in a single request. The outcome of each request
+    is handed to _on_delivery(), which picks the messages to send again
+    behind the ones queued since.
+
+    :param producer: producer sending the batches
+    :type producer: kafka.SimpleProducer
+    """
+
+    _STOP = object()
+
+    def __init__(self, producer, batch_size, linger, buffer_size,
+                 retry_backoff=0.1, stop_timeout=30):
+        self._producer = producer
+        self._batch_size = batch_size
+        self._linger = linger
+        self._retry_backoff = retry_backoff
+        self._stop_timeout = stop_timeout
+        self._queue = moves.queue.Queue(maxsize=buffer_size)
+        self._stopping = threading.Event()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def send(self, topic, message, retry=None):
+        """Queue a message to send, None retry means to retry forever."""
+        # NOTE: [topic, message, retry, attempts]
+        self._queue.put([topic, message, retry, 0])
+
+    def stop(self):
+        """Send the queued messages and stop the thread.
+
+        The messages which cannot be sent at once are dropped, and stopping
+        gives up after stop_timeout seconds.
+        """
+        watch = timeutils.StopWatch(duration=self._stop_timeout).start()
+        self._stopping.set()
+        try:
+            self._queue.put(self._STOP, timeout=self._stop_timeout)
+        except moves.queue.Full:
+            pass
+        self._thread.join(watch.leftover())
+        if self._thread.is_alive():
+            LOG.warning(_LW("Kafka producer stopped with %d messages not "
+                            "sent yet"), self._queue.qsize())
+
+    def _next_batch(self, timeout):
+        """Return the next messages queued and whether the producer is
+        stopping. Wait at most timeout seconds for the first one, None means
+        to wait until one comes, and linger seconds for the others.
+        """
+        batch = []
+        stopping = self._stopping.is_set()
+        linger = None
+        while len(batch) < self._batch_size:
+            try:
+                if stopping:
+                    item = self._queue.get_nowait()
+                elif linger is None:
+                    item = self._queue.get(timeout=timeout)
+                else:
+                    item = self._queue.get(timeout=linger.leftover())
+            except moves.queue.Empty:
+                break
+            if item is self._STOP:
+                stopping = True
+                continue
+            batch.append(item)
+            if linger is None:
+                linger = timeutils.StopWatch(duration=self._linger).start()
+        return batch, stopping
+
+    def _run(self):
+        retries = collections.deque()
+        while True:
+            batch, stopping = self._next_batch(
+                self._retry_backoff if retries else None)
+            # NOTE: the messages to send again wait behind the new ones, so
+            # that a failing topic does not hold back the others
+            while retries and len(batch) < self._batch_size:
+                batch.append(retries.popleft())
+            if not batch:
+                if stopping:
+                    return
+                continue
+            failed = self._send_batch(batch)
+            if stopping and failed:
+                LOG.error(_LE("Dropped %d messages not sent before the "
+                              "producer stopped"), len(failed))
+            else:
+                retries.extend(failed)
+
+    def _send_batch(self, batch):
+        """Send a batch, return the messages to send again."""
+        by_topic = collections.OrderedDict()
+        for item in batch:
+            by_topic.setdefault(item[0], []).append(item)
+        retries = []
+        for topic, items in by_topic.items():
+            try:
+                self._producer.send_messages(topic,
+                                             *[item[1] for item in items])
+            except Exception as e:
+                retries.extend(self._on_delivery(topic, items, e))
+            else:
+                self._on_delivery(topic, items)
+        return retries
+
+    def _on_delivery(self, topic, items, exc=None):
+        """Delivery callback, return the messages to send again."""
+        if exc is None:
+            return []
+        LOG.warning(_LW("Failed to publish %(count)d messages of topic "
+                        "%(topic)s: %(exc)s"),
+                    {'count': len(items), 'topic': topic, 'exc': exc})
+        retries = []
+        for item in items:
+            item[3] += 1
+            if item[2] is None or item[3] < item[2]:
+                retries.append(item)
+        if len(retries) < len(items):
+            LOG.error(_LE("Failed to send %(count)d messages of topic "
+                          "%(topic)s with max retry times"),
+                      {'count': len(items) - len(retries), 'topic': topic})
+        return retries
+
+
+class OffsetTracker(object):
+    """Track the offsets safe to commit, partition by partition.
+
+    Messages may be acknowledged in any order, the committed offset of a
+    partition only moves past a message once it and every message fetched
+    before it from the same partition are acknowledged. A restarted consumer
+    gets again the messages which were not processed, along with the
+    processed ones fetched after the oldest of them.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._acked = {}
+        self._done = {}
+        self.acks = 0
+
+    def delivered(self, topic, partition, offset):
+        """Record a message fetched, in the order of its partition."""
+        with self._lock:
+            self._pending.setdefault(
+                (topic, partition), collections.deque()).append(offset)
+
+    def acked(self, topic, partition, offset):
+        """Record a message processed."""
+        topic_partition = (topic, partition)
+        with self._lock:
+            pending = self._pending.get(topic_partition)
+            if not pending:
+                return
+            acked = self._acked.setdefault(topic_partition, set())
+            acked.add(offset)
+            self.acks += 1
+            while pending and pending[0] in acked:
+                offset = pending.popleft()
+                acked.discard(offset)
+                self._done[topic_partition] = offset
+
+    def pop_done(self):
+        """Return the last offset to commit of each partition."""
+        with self._lock:
+            done, self._done = self._done, {}
+            self.acks = 0
+        return done
+
+    def restore(self, done):
+        """Take back offsets returned by pop_done() but not committed."""
+        with self._lock:
+            for topic_partition, offset in done.items():
+                self._done.setdefault(topic_partition, offset)
+
+    def forget(self, topic_partitions):
+        """Stop tracking partitions no longer consumed."""
+        with self._lock:
+            for topic_partition in topic_partitions:
+                self._pending.pop(topic_partition, None)
+                self._acked.pop(topic_partition, None)
+                self._done.pop(topic_partition, None)
+
+
 class Connection(object):
 
     def __init__(self, conf, url, purpose):
@@ -93,16 +402,27 @@ class Connection(object):
         self.conf = conf
         self.kafka_client = None
         self.producer = None
+        self.keyed_producer = None
         self.consumer = None
         self.fetch_messages_max_bytes = driver_conf.kafka_max_fetch_bytes
+        self.producer_acks = _ACKS[driver_conf.producer_acks]
+        self.compression_codec = _CODECS[driver_conf.compression_codec]
+        self.producer_async = driver_conf.producer_async
+        self.producer_batch_size = driver_conf.producer_batch_size
+        self.producer_linger = driver_conf.producer_linger_ms / 1000.0
+        self.producer_buffer_size = driver_conf.producer_buffer_size
+        self.async_producer = None
         self.consumer_timeout = float(driver_conf.kafka_consumer_timeout)
+        self.enable_auto_commit = driver_conf.enable_auto_commit
+        self.commit_batch_size = driver_conf.consumer_commit_batch_size
+        self.commit_interval_ms = driver_conf.consumer_commit_interval_ms
+        self.group = None
+        self.offset_tracker = None
+        self._fetched = None
+        self._fetch_wait_ms = None
+        self._commit_watch = timeutils.StopWatch().start()
         self.url = url
         self._parse_url()
-        # TODO(Support for manual/auto_commit functionality)
-        # When auto_commit is False, consumer can manually notify
-        # the completion of the subscription.
-        # Currently we don't support for non auto commit option
-        self.auto_commit = True
         self._consume_loop_stopped = False
 
     def _parse_url(self):
@@ -130,15 +450,29 @@ class Connection(object):
         """
         message = pack_context_with_message(ctxt, msg)
         self._ensure_connection()
-        self._send_and_retry(message, topic, retry)
+        if self.async_producer is not None:
+            self.async_producer.send(topic, jsonutils.dumps(message), retry)
+        else:
+            self._send_and_retry(message, topic, retry)
+
+    def topic_send(self, topic, msg, key=None, retry=None):
+        """Send a RPC request or reply to Kafka broker.
+
+        :param topic: String of the topic
+        :param msg: message for publishing
+        :param key: messages sharing a key go to the same partition
+        :param retry: the number of retry
+        """
+        self._ensure_connection()
+        self._send_and_retry(msg, topic, retry, key=key)
 
-    def _send_and_retry(self, message, topic, retry):
+    def _send_and_retry(self, message, topic, retry, key=None):
         current_retry = 0
         if not isinstance(message, str):
             message = jsonutils.dumps(message)
         while message is not None:
             try:
-                self._send(message, topic)
+                self._send(message, topic, key)
                 message = None
             except Exception:
                 LOG.warning(_LW("Failed to publish a message of topic %s"),
@@ -149,45 +483,100 @@ class Connection(object):
                                       "with max retry times"))
                     message = None
 
-    def _send(self, message, topic):
-        self.producer.send_messages(topic, message)
+    def _send(self, message, topic, key=None):
+        if key is None:
+            self.producer.send_messages(topic, message)
+            return
+        if self.keyed_producer is None:
+            # NOTE: the default partitioner of kafka-python relies on hash(),
+            # which differs between processes
+            self.keyed_producer = kafka.KeyedProducer(
+                self.kafka_client, partitioner=kafka.Murmur2Partitioner,
+                req_acks=self.producer_acks, codec=self.compression_codec)
+        self.keyed_producer.send_messages(topic, encodeutils.safe_encode(key),
+                                          message)
 
     def consume(self, timeout=None):
-        """Receive up to 'max_fetch_messages' messages.
+        """Receive the messages of the next fetch.
 
         :param timeout: poll timeout in seconds
         """
-        duration = (self.consumer_timeout if timeout is None else timeout)
-        timer = driver_common.DecayingTimer(duration=duration)
-        timer.start()
-
-        def _raise_timeout():
+        messages = list(self.poll(timeout=timeout))
+        if not messages and not self._consume_loop_stopped:
             LOG.debug('Timed out waiting for Kafka response')
             raise driver_common.Timeout()
-
-        poll_timeout = (self.consumer_timeout if timeout is None
-                        else min(timeout, self.consumer_timeout))
-
-        while True:
-            if self._consume_loop_stopped:
-                return
+        return messages
+
+    def poll(self, max_records=None, timeout=None):
+        """Yield the fetched messages as they are decoded.
+
+        Up to max_records messages are yielded, those of a single fetch when
+        it is None. The messages of a fetch not yielded yet are kept for the
+        next poll. When none is left, fetches are issued until one returns
+        messages or timeout expires, the broker holding each fetch until
+        messages arrive.
+
+        :param max_records: maximum number of messages to yield
+        :type max_records: int
+        :param timeout: time to wait for messages in seconds, defaults to
+            kafka_consumer_timeout
+        :type timeout: float
+        """
+        if timeout is None:
+            timeout = self.consumer_timeout
+        watch = timeutils.StopWatch(duration=timeout).start()
+        # NOTE: the broker holds each fetch of this poll for the same time,
+        # the last one may end up to that long after the timeout
+        wait_ms = int(min(timeout, self.consumer_timeout) * 1000)
+        count = 0
+        fetched = False
+        while (not self._consume_loop_stopped and
+                (max_records is None or count < max_records)):
+            self._maybe_commit()
             try:
-                next_timeout = poll_timeout * 1000.0
-                # TODO(use configure() method instead)
-                # Currently KafkaConsumer does not support for
-                # the case of updating only fetch_max_wait_ms parameter
-                self.consumer._config['fetch_max_wait_ms'] = next_timeout
-                messages = list(self.consumer.fetch_messages())
+                if self._fetched is None:
+                    if count or (fetched and watch.expired()):
+                        return
+                    self._fetched = self._fetch(wait_ms)
+                    fetched = True
+                message = next(self._fetched)
+            except StopIteration:
+                self._fetched = None
+                continue
             except Exception as e:
                 LOG.exception(_LE("Failed to consume messages: %s"), e)
-                messages = None
-
-            if not messages:
-                poll_timeout = timer.check_return(
-                    _raise_timeout, maximum=self.consumer_timeout)
-                continue
-
-            return messages
+                self._fetched = None
+                # wait out the timeout rather than retrying a failing fetch
+                time.sleep(watch.leftover())
+                return
+            self._delivered(message)
+            count += 1
+            yield message
+
+    def _fetch(self, wait_ms):
+        if wait_ms != self._fetch_wait_ms:
+            # NOTE: kafka-python 0.9 only takes the fetch wait when the
+            # consumer is configured, and KafkaConsumer.configure() resets
+            # the whole consumer, update the wait of the next fetches alone
+            self.consumer._config['fetch_wait_max_ms'] = wait_ms
+            self._fetch_wait_ms = wait_ms
+        return iter(self.consumer.fetch_messages())
+
+    def _delivered(self, message):
+        if self.offset_tracker is not None:
+            self.offset_tracker.delivered(
+                message.topic, message.partition, message.offset)
+        elif self.enable_auto_commit and self.group is not None:
+            self.consumer.task_done(message)
+
+    def _maybe_commit(self, force=False):
+        tracker = self.offset_tracker
+        if tracker is None or not tracker.acks:
+            return
+        elapsed = self._commit_watch.elapsed() * 1000.0
+        if (force or tracker.acks >= self.commit_batch_size or
+                elapsed >= self.commit_interval_ms):
+            self.commit()
 
     def stop_consuming(self):
         self._consume_loop_stopped = True
@@ -195,15 +584,25 @@ class Connection(object):
     def reset(self):
         """Reset a connection so it can be used again."""
         if self.consumer:
+            self._maybe_commit(force=True)
             self.consumer.close()
         self.consumer = None
+        self.offset_tracker = None
+        self._fetched = None
+        self._fetch_wait_ms = None
 
     def close(self):
+        if self.consumer:
+            self._maybe_commit(force=True)
+        if self.async_producer:
+            self.async_producer.stop()
+        self.async_producer = None
         if self.kafka_client:
             self.kafka_client.close()
         self.kafka_client = None
         if self.producer:
             self.producer.stop()
+        self.keyed_producer = None
         self.consumer = None
 
     def commit(self):
@@ -212,10 +611,24 @@ class Connection(object):
         the other subscribers which belong to the same group
         from re-subscribing the same messages.
 
-        Currently self.auto_commit option is always True,
-        so we don't need to call this function.
+        Unless enable_auto_commit is set, only the offsets of the
+        acknowledged messages are committed, see OffsetTracker.
         """
-        self.consumer.commit()
+        if self.offset_tracker is None:
+            self.consumer.commit()
+            return
+        done = self.offset_tracker.pop_done()
+        self._commit_watch.restart()
+        if not done or self.group is None:
+            return
+        # NOTE: KafkaConsumer.task_done() expects the offsets of a partition
+        # one after the other, set the last contiguous one directly instead
+        self.consumer._offsets.task_done.update(done)
+        try:
+            self.consumer.commit()
+        except KafkaError as e:
+            LOG.warning(_LW("Failed to commit Kafka offsets: %s"), e)
+            self.offset_tracker.restore(done)
 
     def _ensure_connection(self):
         if self.kafka_client:
@@ -223,40 +636,94 @@ class Connection(object):
         try:
             self.kafka_client = kafka.KafkaClient(
                 self.hostaddrs)
-            self.producer = kafka.SimpleProducer(self.kafka_client)
+            self.producer = kafka.SimpleProducer(
+                self.kafka_client, req_acks=self.producer_acks,
+                codec=self.compression_codec)
+            if self.producer_async:
+                self.async_producer = AsyncProducer(
+                    self.producer, self.producer_batch_size,
+                    self.producer_linger, self.producer_buffer_size)
         except KafkaError as e:
             LOG.exception(_LE("Kafka Connection is not available: %s"), e)
             self.kafka_client = None
 
+    def partition_ids(self, topic):
+        """Return the partitions of a topic, creating it if needed."""
+        self._ensure_connection()
+        self.kafka_client.ensure_topic_exists(topic)
+        return self.kafka_client.get_partition_ids_for_topic(topic)
+
+    def partition_for(self, topic, key):
+        """Return the partition the messages of a key are sent to.
+
+        :param topic: String of the topic
+        :param key: key of the messages, see topic_send()
+        """
+        partitions = self.partition_ids(topic)
+        return kafka.Murmur2Partitioner(partitions).partition(
+            encodeutils.safe_encode(key))
+
     def declare_topic_consumer(self, topics, group=None):
+        """Consume some topics, or some (topic, partition) pairs."""
         self._ensure_connection()
         for topic in topics:
+            if isinstance(topic, tuple):
+                topic = topic[0]
             self.kafka_client.ensure_topic_exists(topic)
         self.consumer = kafka.KafkaConsumer(
             *topics, group_id=group,
             bootstrap_servers=self.hostaddrs,
-            fetch_message_max_bytes=self.fetch_messages_max_bytes)
+            fetch_message_max_bytes=self.fetch_messages_max_bytes,
+            fetch_wait_max_ms=int(self.consumer_timeout * 1000),
+            auto_commit_enable=self.enable_auto_commit and group is not None,
+            auto_commit_interval_ms=self.commit_interval_ms)
+        self.group = group
+        self._fetched = None
+        self._fetch_wait_ms = int(self.consumer_timeout * 1000)
+        if not self.enable_auto_commit:
+            self.offset_tracker = OffsetTracker()
         self._consume_loop_stopped = False
 
 
 class OsloKafkaMessage(base.RpcIncomingMessage):
 
-    def __init__(self, ctxt, message):
+    def __init__(self, ctxt, message, listener, kafka_message, server=None,
+                 msg_id=None, reply_topic=None, reply_key=None):
         super(OsloKafkaMessage, self).__init__(ctxt, message)
+        self.listener = listener
+        self.kafka_message = kafka_message
+        self.server = server
+        self.msg_id = msg_id
+        self.reply_topic = reply_topic
+        self.reply_key = reply_key
+
+    def acknowledge(self):
+        self.listener.acknowledge(self)
 
     def requeue(self):
-        LOG.warning(_LW("requeue is not supported"))
+        self.listener.requeue(self)
 
     def reply(self, reply=None, failure=None):
-        LOG.warning(_LW("reply is not supported"))
+        if not self.msg_id:
+            # NOTE: not sending reply, the caller does not expect one
+            return
+        self.listener.reply(self, reply, failure)
 
 
 class KafkaListener(base.PollStyleListener):
+    """Listener of notifications or, given the driver, of RPC requests.
+
+    The RPC requests addressed to another server are skipped.
+    """
 
-    def __init__(self, conn):
+    reply_retry = 3
+
+    def __init__(self, conn, driver=None, server=None):
         super(KafkaListener, self).__init__()
         self._stopped = threading.Event()
         self.conn = conn
+        self.driver = driver
+        self.server = server
         self.incoming_queue = []
 
     @base.batch_poll_helper
@@ -264,31 +731,457 @@ class KafkaListener(base.PollStyleListener):
         while not self._stopped.is_set():
             if self.incoming_queue:
                 return self.incoming_queue.pop(0)
-            try:
-                messages = self.conn.consume(timeout=timeout)
-                for msg in messages:
-                    message = msg.value
-                    LOG.debug('poll got message : %s', message)
-                    message = jsonutils.loads(message)
-                    self.incoming_queue.append(OsloKafkaMessage(
-                        ctxt=message['context'], message=message['message']))
-            except driver_common.Timeout:
+            message = None
+            for msg in self.conn.poll(max_records=1, timeout=timeout):
+                message = unpack_message(msg, self)
+            if message is None:
                 return None
+            if message.server is None or message.server == self.server:
+                return message
+            message.acknowledge()
+
+    def reply(self, message, reply=None, failure=None):
+        if failure:
+            failure = driver_common.serialize_remote_exception(failure)
+        msg = {'msg_id': message.msg_id, 'reply_key': message.reply_key,
+               'result': reply, 'failure': failure}
+        LOG.debug("sending reply msg_id: %(msg_id)s reply topic: "
+                  "%(reply_topic)s", {'msg_id': message.msg_id,
+                                      'reply_topic': message.reply_topic})
+        with self.driver._get_connection(purpose=PURPOSE_SEND) as conn:
+            conn.topic_send(message.reply_topic, msg, key=message.reply_key,
+                            retry=self.reply_retry)
+
+    def acknowledge(self, message):
+        tracker = self.conn.offset_tracker
+        if tracker is not None:
+            msg = message.kafka_message
+            tracker.acked(msg.topic, msg.partition, msg.offset)
+
+    def requeue(self, message):
+        if self.conn.offset_tracker is None:
+            LOG.warning(_LW("requeue is not supported"))
+            return
+        # NOTE: the offset stays uncommitted until the message is
+        # acknowledged, deliver it again from here
+        self.incoming_queue.append(message)
+
+    def stop(self):
+        self._stopped.set()
+        self.conn.stop_consuming()
+
+    def cleanup(self):
+        self.conn.close()
+
+    def commit(self):
+        self.conn.commit()
+
+
+class TopicMembers(object):
+    """The servers of a topic, as known from their announcements.
+
+    Each server announces itself every interval seconds and when it stops,
+    a server not heard of for three intervals is considered gone. The
+    partitions of the requests sent to the topic are dealt out to the
+    servers sorted by name.
+    """
+
+    def __init__(self, server, interval):
+        self.server = server
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._members = {}
+
+    def update(self, server, leaving=False):
+        """Record an announcement, return whether the server is new."""
+        if server == self.server:
+            return False
+        with self._lock:
+            if leaving:
+                self._members.pop(server, None)
+                return False
+            new = server not in self._members
+            self._members[server] = timeutils.StopWatch(
+                duration=3 * self.interval).start()
+            return new
+
+    def partitions(self, partition_ids):
+        """Return the partitions owned by this server."""
+        with self._lock:
+            for server, watch in list(self._members.items()):
+                if watch.expired():
+                    del self._members[server]
+            members = sorted(set(self._members) | set([self.server]))
+        index = members.index(self.server)
+        return [partition
+                for i, partition in enumerate(sorted(partition_ids))
+                if i % len(members) == index]
+
+
+class KafkaRPCListener(KafkaListener):
+    """Listener of the RPC requests of a server.
+
+    conn fetches the requests addressed to the server, the fanout ones and
+    the announcements of the servers of the topic, in a consumer group of
+    the server's own. shared_conn fetches the requests sent to the topic,
+    in the consumer group of the topic: the servers share its partitions
+    out, see TopicMembers. A thread fetches from each connection into a
+    bounded queue.
+
+    When the servers of the topic change, the requests the server fetched
+    from the partitions it loses but did not acknowledge yet may be
+    processed again by their new owner.
+    """
+
+    buffer_size = 100
+
+    def __init__(self, conn, shared_conn, driver, exchange, target,
+                 announce_interval):
+        super(KafkaRPCListener, self).__init__(conn, driver, target.server)
+        self.shared_conn = shared_conn
+        self._shared_topic = rpc_topic(exchange, target.topic, 'shared')
+        self._shared_group = rpc_topic(exchange, target.topic)
+        self._members_topic = rpc_topic(exchange, target.topic, 'members')
+        self.members = TopicMembers(target.server, announce_interval)
+        self._incoming = moves.queue.Queue(self.buffer_size)
+        self._threads = [threading.Thread(target=self._fetch_requests),
+                         threading.Thread(target=self._fetch_shared_requests)]
+        for thread in self._threads:
+            thread.daemon = True
+            thread.start()
+
+    @base.batch_poll_helper
+    def poll(self, timeout=None):
+        with timeutils.StopWatch(timeout) as watch:
+            while True:
+                if self.incoming_queue:
+                    return self.incoming_queue.pop(0)
+                stopped = self._stopped.is_set()
+                wait = self.conn.consumer_timeout
+                if timeout is not None:
+                    wait = min(wait, watch.leftover())
+                try:
+                    return self._incoming.get(not stopped, wait)
+                except moves.queue.Empty:
+                    if stopped or (timeout is not None and watch.expired()):
+                        return None
+
+    def _put(self, message):
+        while not self._stopped.is_set():
+            try:
+                self._incoming.put(message,
+                                   timeout=self.conn.consumer_timeout)
+                return
+            except moves.queue.Full:
+                pass
+
+    @excutils.forever_retry_uncaught_exceptions
+    def _fetch_requests(self):
+        while not self._stopped.is_set():
+            for msg in self.conn.poll():
+                if encodeutils.safe_decode(msg.topic) == self._members_topic:
+                    self._acked(self.conn, msg)
+                    announcement = jsonutils.loads(msg.value)
+                    if self.members.update(announcement['member'],
+                                           announcement['leaving']):
+                        # NOTE: let the new server know about this one
+                        self._announce()
+                    continue
+                message = unpack_message(msg, self)
+                if message.server is None or message.server == self.server:
+                    self._put(message)
+                else:
+                    message.acknowledge()
+
+    @excutils.forever_retry_uncaught_exceptions
+    def _fetch_shared_requests(self):
+        announce = None
+        assigned = None
+        while not self._stopped.is_set():
+            if announce is None or announce.expired():
+                self._announce()
+                announce = timeutils.StopWatch(
+                    duration=self.members.interval).start()
+            partitions = self.members.partitions(
+                self.shared_conn.partition_ids(self._shared_topic))
+            if partitions != assigned:
+                # NOTE: kafka-python 0.9 reloads the committed offsets of
+                # every partition when they change, start from scratch
+                self.shared_conn.reset()
+                if partitions:
+                    self.shared_conn.declare_topic_consumer(
+                        [(self._shared_topic, partition)
+                         for partition in partitions], self._shared_group)
+                assigned = partitions
+            if not partitions:
+                self._stopped.wait(self.shared_conn.consumer_timeout)
+                continue
+            for msg in self.shared_conn.poll():
+                self._put(unpack_message(msg, self))
+
+    def _announce(self, leaving=False):
+        with self.driver._get_connection(purpose=PURPOSE_SEND) as conn:
+            conn.topic_send(self._members_topic,
+                            {'member': self.server, 'leaving': leaving},
+                            retry=self.reply_retry)
+
+    def _conn_for(self, message):
+        topic = encodeutils.safe_decode(message.kafka_message.topic)
+        if topic == self._shared_topic:
+            return self.shared_conn
+        return self.conn
+
+    @staticmethod
+    def _acked(conn, msg):
+        tracker = conn.offset_tracker
+        if tracker is not None:
+            tracker.acked(msg.topic, msg.partition, msg.offset)
+
+    def acknowledge(self, message):
+        self._acked(self._conn_for(message), message.kafka_message)
+
+    def requeue(self, message):
+        if self._conn_for(message).offset_tracker is None:
+            LOG.warning(_LW("requeue is not supported"))
+            return
+        self.incoming_queue.append(message)
 
     def stop(self):
         self._stopped.set()
         self.conn.stop_consuming()
+        self.shared_conn.stop_consuming()
+        for thread in self._threads:
+            thread.join()
+        self._announce(leaving=True)
 
     def cleanup(self):
         self.conn.close()
+        self.shared_conn.close()
 
     def commit(self):
-        # TODO(Support for manually/auto commit functionality)
-        # It's better to allow users to commit manually and support for
-        # self.auto_commit = False option. For now, this commit function
-        # is meaningless since user couldn't call this function and
-        # auto_commit option is always True.
         self.conn.commit()
+        if self.shared_conn.consumer is not None:
+            self.shared_conn.commit()
+
+
+def _topic_partition(message):
+    return (message.kafka_message.topic, message.kafka_message.partition)
+
+
+class PartitionLane(object):
+    """Hand the messages of some partitions to the server in order.
+
+    A batch is handed over once every message of the previous one was
+    acknowledged or requeued, requeued messages being handed again first.
+    """
+
+    def __init__(self, listener, buffer_size):
+        self.listener = listener
+        self._buffer_size = buffer_size
+        self._cond = threading.Condition()
+        self._messages = collections.deque()
+        self._in_flight = []
+        self._requeued = []
+        self._revoked = set()
+        self._stopped = False
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def put(self, message):
+        """Queue a message, block while the lane is full."""
+        with self._cond:
+            while (len(self._messages) >= self._buffer_size and
+                    not self._stopped):
+                self._cond.wait()
+            self._messages.append(message)
+            self._cond.notify_all()
+
+    def acknowledge(self, message):
+        self.listener.acknowledge(message)
+        self.done(message)
+
+    def requeue(self, message):
+        self.done(message, requeue=True)
+
+    def done(self, message, requeue=False):
+        """Release a message handed over, its offset is not acknowledged."""
+        with self._cond:
+            self._in_flight.remove(message)
+            if requeue and _topic_partition(message) not in self._revoked:
+                self._requeued.append(message)
+            if not self._in_flight:
+                self._messages.extendleft(reversed(self._requeued))
+                self._requeued = []
+            self._cond.notify_all()
+
+    def drain(self, topic_partitions):
+        """Wait until the messages of partitions are processed.
+
+        Their requeued messages are dropped, they are left to the next
+        consumer of the partitions.
+        """
+        topic_partitions = set(topic_partitions)
+        with self._cond:
+            self._revoked.update(topic_partitions)
+            while any(_topic_partition(message) in topic_partitions
+                      for message in itertools.chain(self._messages,
+                                                     self._in_flight)):
+                self._cond.wait()
+            self._revoked.difference_update(topic_partitions)
+
+    def stop(self):
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+        self._thread.join()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._stopped and (self._in_flight or
+                                             not self._messages):
+                    self._cond.wait()
+                if self._stopped:
+                    return
+                count = min(self.listener.batch_size or 1,
+                            len(self._messages))
+                batch = [self._messages.popleft() for i in range(count)]
+                self._in_flight = list(batch)
+            self.listener.dispatch(batch)
+
+
+class PartitionedKafkaListener(base.Listener):
+    """Listener processing the partitions in parallel, each in order.
+
+    A thread fetches the messages and dispatches them to up to ``max_lanes``
+    PartitionLane, a partition always going to the same lane.
+    """
+
+    def __init__(self, conn, batch_size, batch_timeout, max_lanes,
+                 buffer_size):
+        super(PartitionedKafkaListener, self).__init__(batch_size,
+                                                       batch_timeout)
+        self.conn = conn
+        self._max_lanes = max_lanes
+        self._buffer_size = buffer_size
+        self._lanes = []
+        self._assignment = {}
+        self._stopped = threading.Event()
+        self._consume_thread = threading.Thread(target=self._runner)
+        self._consume_thread.daemon = True
+
+    def start(self, on_incoming_callback):
+        super(PartitionedKafkaListener, self).start(on_incoming_callback)
+        self._consume_thread.start()
+
+    @excutils.forever_retry_uncaught_exceptions
+    def _runner(self):
+        while not self._stopped.is_set():
+            for msg in self.conn.poll():
+                lane = self._lane((msg.topic, msg.partition))
+                lane.put(unpack_message(msg, lane))
+
+    def _lane(self, topic_partition):
+        lane = self._assignment.get(topic_partition)
+        if lane is None:
+            if len(self._lanes) < self._max_lanes:
+                lane = PartitionLane(self, self._buffer_size)
+                self._lanes.append(lane)
+            else:
+                lane = self._lanes[len(self._assignment) % len(self._lanes)]
+            self._assignment[topic_partition] = lane
+        return lane
+
+    def dispatch(self, batch):
+        callback = self.on_incoming_callback
+        if callback is None:
+            for message in batch:
+                message.listener.done(message)
+            return
+        callback(batch)
+
+    def acknowledge(self, message):
+        tracker = self.conn.offset_tracker
+        if tracker is not None:
+            msg = message.kafka_message
+            tracker.acked(msg.topic, msg.partition, msg.offset)
+
+    def revoke(self, topic_partitions):
+        """Drain the lanes of partitions taken away and commit them.
+
+        Must be called from the consuming thread, or once it is stopped.
+        """
+        lanes = {}
+        for topic_partition in topic_partitions:
+            lane = self._assignment.pop(topic_partition, None)
+            if lane is not None:
+                lanes.setdefault(lane, []).append(topic_partition)
+        for lane, lane_partitions in lanes.items():
+            lane.drain(lane_partitions)
+        if self.conn.offset_tracker is not None:
+            self.conn.commit()
+            self.conn.offset_tracker.forget(topic_partitions)
+
+    def stop(self):
+        self._stopped.set()
+        self.conn.stop_consuming()
+        if self._consume_thread.is_alive():
+            self._consume_thread.join()
+        self.revoke(list(self._assignment))
+        for lane in self._lanes:
+            lane.stop()
+        super(PartitionedKafkaListener, self).stop()
+
+    def cleanup(self):
+        self.conn.close()
+
+
+class ReplyWaiter(object):
+    """Hand the replies fetched from the reply topic to the callers.
+
+    The clients share the reply topic, the replies to a client are keyed
+    by its reply_key and the replies to the clients whose keys share its
+    partition are skipped.
+    """
+
+    def __init__(self, conn, reply_key, allowed_remote_exmods):
+        self.conn = conn
+        self.reply_key = reply_key
+        self.allowed_remote_exmods = allowed_remote_exmods
+        self.waiters = amqpdriver.ReplyWaiters()
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._runner)
+        self._thread.daemon = True
+        self._thread.start()
+
+    @excutils.forever_retry_uncaught_exceptions
+    def _runner(self):
+        while not self._stopped.is_set():
+            for msg in self.conn.poll():
+                reply = jsonutils.loads(msg.value)
+                if reply.get('reply_key') != self.reply_key:
+                    continue
+                LOG.debug("received reply msg_id: %s", reply['msg_id'])
+                self.waiters.put(reply['msg_id'], reply)
+
+    def listen(self, msg_id):
+        self.waiters.add(msg_id)
+
+    def unlisten(self, msg_id):
+        self.waiters.remove(msg_id)
+
+    def wait(self, msg_id, timeout):
+        reply = self.waiters.get(msg_id, timeout)
+        if reply['failure']:
+            raise driver_common.deserialize_remote_exception(
+                reply['failure'], self.allowed_remote_exmods)
+        return reply['result']
+
+    def stop(self):
+        self._stopped.set()
+        self.conn.stop_consuming()
+        self._thread.join()
 
 
 class KafkaDriver(base.BaseDriver):
@@ -317,15 +1210,102 @@ class KafkaDriver(base.BaseDriver):
             self._url, Connection)
         self.listeners = []
 
+        self._reply_lock = threading.Lock()
+        self._waiter = None
+
     def cleanup(self):
         for c in self.listeners:
             c.close()
         self.listeners = []
 
+        with self._reply_lock:
+            if self._waiter is not None:
+                self._waiter.stop()
+                self._waiter.conn.close()
+                self._waiter = None
+
+    def _get_exchange(self, target):
+        return target.exchange or self._default_exchange
+
+    def _get_reply_key(self):
+        with self._reply_lock:
+            if self._waiter is not None:
+                return self._waiter.reply_key
+
+            reply_key = uuid.uuid4().hex
+            conn = self._get_connection(purpose=PURPOSE_LISTEN)
+            # NOTE: only fetch the partition the replies of the key land on
+            conn.declare_topic_consumer(
+                [(REPLY_TOPIC, conn.partition_for(REPLY_TOPIC, reply_key))])
+            # NOTE: the replies are neither acknowledged nor committed
+            conn.connection.offset_tracker = None
+            self._waiter = ReplyWaiter(conn, reply_key,
+                                       self._allowed_remote_exmods)
+
+        return reply_key
+
+    def require_features(self, requeue=False):
+        if requeue and self.conf.oslo_messaging_kafka.enable_auto_commit:
+            raise NotImplementedError('Message requeueing not supported by '
+                                      'the kafka driver with '
+                                      'enable_auto_commit')
+
     def send(self, target, ctxt, message, wait_for_reply=None, timeout=None,
              retry=None):
-        raise NotImplementedError(
-            'The RPC implementation for Kafka is not implemented')
+        """Send RPC request to Kafka brokers
+
+        The requests addressed to a server go to the topic of the exchange
+        and topic of their target, keyed by the server name so they land on
+        the partition that server consumes. The fanout requests and the
+        requests any server of the topic may process go to topics of their
+        own, see KafkaRPCListener. The replies come back on the reply topic
+        shared by the clients, keyed by the reply key of this driver.
+
+        :param target: Message destination target
+        :type target: oslo_messaging.Target
+        :param ctxt: Message context
+        :type ctxt: dict
+        :param message: Message payload to pass
+        :type message: dict
+        :param wait_for_reply: Whether to wait for the reply
+        :type wait_for_reply: bool
+        :param timeout: Time in seconds to wait for the reply
+        :type timeout: float
+        :param retry: an optional default kafka consumer retries configuration
+                      None means to retry forever
+                      0 means no retry
+                      N means N retries
+        :type retry: int
+        """
+        msg = pack_context_with_message(ctxt, message)
+        exchange = self._get_exchange(target)
+        key = None
+        if target.fanout:
+            topic = rpc_topic(exchange, target.topic, 'fanout')
+        elif target.server:
+            topic = rpc_topic(exchange, target.topic)
+            key = target.server
+            msg['server'] = target.server
+        else:
+            topic = rpc_topic(exchange, target.topic, 'shared')
+
+        if wait_for_reply:
+            msg_id = uuid.uuid4().hex
+            msg['msg_id'] = msg_id
+            msg['reply_key'] = self._get_reply_key()
+            msg['reply_topic'] = REPLY_TOPIC
+            self._waiter.listen(msg_id)
+            LOG.debug("CALL msg_id: %(msg_id)s topic: %(topic)s",
+                      {'msg_id': msg_id, 'topic': topic})
+
+        try:
+            with self._get_connection(purpose=PURPOSE_SEND) as conn:
+                conn.topic_send(topic, msg, key=key, retry=retry)
+            if wait_for_reply:
+                return self._waiter.wait(msg_id, timeout)
+        finally:
+            if wait_for_reply:
+                self._waiter.unlisten(msg_id)
 
     def send_notification(self, target, ctxt, message, version, retry=None):
         """Send notification to Kafka brokers
@@ -348,8 +1328,34 @@ class KafkaDriver(base.BaseDriver):
             conn.notify_send(target_to_topic(target), ctxt, message, retry)
 
     def listen(self, target, batch_size, batch_timeout):
-        raise NotImplementedError(
-            'The RPC implementation for Kafka is not implemented')
+        """Listen to the RPC requests of a server on Kafka brokers
+
+        Every server has a consumer group of its own, so each of them gets
+        the fanout requests, and only consumes the partition its own
+        requests are sent to. The servers of a topic share the partitions
+        of the requests sent to the topic in a common consumer group.
+
+        :param target: Target of the server
+        :type target: oslo_messaging.Target
+        """
+        conn = self._get_connection(purpose=PURPOSE_LISTEN)
+        exchange = self._get_exchange(target)
+        topic = rpc_topic(exchange, target.topic)
+        # NOTE: servers whose names share a partition still skip the
+        # requests of one another
+        partition = conn.partition_for(topic, target.server)
+        conn.declare_topic_consumer(
+            [(topic, partition),
+             rpc_topic(exchange, target.topic, 'fanout'),
+             rpc_topic(exchange, target.topic, 'members')],
+            '%s_%s' % (topic, target.server))
+
+        listener = KafkaRPCListener(
+            conn, self._get_connection(purpose=PURPOSE_LISTEN), self,
+            exchange, target,
+            self.conf.oslo_messaging_kafka.rpc_server_announce_interval)
+        return base.PollStyleListenerAdapter(listener, batch_size,
+                                             batch_timeout)
 
     def listen_for_notifications(self, targets_and_priorities, pool,
                                  batch_size, batch_timeout):
@@ -370,6 +1376,13 @@ class KafkaDriver(base.BaseDriver):
 
         conn.declare_topic_consumer(topics, pool)
 
+        driver_conf = self.conf.oslo_messaging_kafka
+        if driver_conf.consumer_max_lanes:
+            return PartitionedKafkaListener(
+                conn, batch_size, batch_timeout,
+                driver_conf.consumer_max_lanes,
+                driver_conf.consumer_lane_buffer_size)
+
         listener = KafkaListener(conn)
         return base.PollStyleListenerAdapter(listener, batch_size,
                                              batch_timeout)
@@ -15,6 +15,7 @@
 import contextlib
 import errno
 import functools
+import heapq
 import itertools
 import math
 import os
@@ -34,6 +35,7 @@ from oslo_config import cfg
 from oslo_log import log as logging
 from oslo_utils import eventletutils
 from oslo_utils import netutils
+from oslo_utils import timeutils
 import six
 from six.moves.urllib import parse
 
@@ -91,12 +93,22 @@ rabbit_opts = [
                     'send it its replies. This value should not be longer '
                     'than rpc_response_timeout.'),
     cfg.StrOpt('kombu_failover_strategy',
-               choices=('round-robin', 'shuffle'),
+               choices=('round-robin', 'shuffle', 'latency'),
                default='round-robin',
                help='Determines how the next RabbitMQ node is chosen in case '
                     'the one we are currently connected to becomes '
                     'unavailable. Takes effect only if more than one '
-                    'RabbitMQ node is provided in config.'),
+                    'RabbitMQ node is provided in config. "latency" picks '
+                    'the healthy node with the lowest round trip time, as '
+                    'measured by the time to open a TCP connection to it.'),
+    cfg.IntOpt('kombu_latency_rebalance_interval',
+               default=0,
+               min=0,
+               help='With the "latency" failover strategy, how often (in '
+                    'seconds) listener connections measure the round trip '
+                    'time of all the RabbitMQ nodes and move to a node at '
+                    'least twice as fast as the current one. 0 disables '
+                    'rebalancing.'),
     cfg.StrOpt('rabbit_host',
                default='localhost',
                deprecated_group='DEFAULT',
@@ -185,6 +197,27 @@ rabbit_opts = [
                default=0,
                help='Specifies the number of messages to prefetch. Setting to '
                     'zero allows unlimited messages.'),
+    cfg.BoolOpt('rabbit_qos_prefetch_adaptive',
+                default=False,
+                help='Adjust the prefetch count of listener connections to '
+                     'the rate their messages get processed, between '
+                     'rabbit_qos_prefetch_min and rabbit_qos_prefetch_max, '
+                     'starting from rabbit_qos_prefetch_count. The prefetch '
+                     'count is then shared by all the consumers of the '
+                     'listener.'),
+    cfg.IntOpt('rabbit_qos_prefetch_min',
+               default=1,
+               min=1,
+               help='Lowest prefetch count of an adaptive prefetch.'),
+    cfg.IntOpt('rabbit_qos_prefetch_max',
+               default=100,
+               min=1,
+               help='Highest prefetch count of an adaptive prefetch.'),
+    cfg.IntOpt('rabbit_qos_prefetch_adjust_interval',
+               default=5,
+               min=1,
+               help='Number of seconds between two adjustments of an '
+                    'adaptive prefetch.'),
     cfg.IntOpt('heartbeat_timeout_threshold',
                default=60,
                help="Number of seconds after which the Rabbit broker is "
@@ -194,6 +227,57 @@ rabbit_opts = [
                default=2,
                help='How often times during the heartbeat_timeout_threshold '
                'we check the heartbeat.'),
+    cfg.BoolOpt('heartbeat_shared_thread',
+                default=False,
+                help='Maintain the heartbeat of all the send connections of '
+                     'the process from a single thread, which only wakes up '
+                     'when the heartbeat of a connection is due, instead of '
+                     'running one thread per connection.'),
+    cfg.IntOpt('rabbit_max_priority',
+               default=0,
+               min=0,
+               max=255,
+               help='Declare the RPC topic queues with this maximum message '
+                    'priority (x-max-priority), so that RPC messages sent '
+                    'with a priority overtake the lower priority messages '
+                    'queued on the broker. 0 declares queues without '
+                    'priorities. Existing queues must be deleted when this '
+                    'value changes, RabbitMQ refuses to redeclare them with '
+                    'another maximum priority.'),
+    cfg.ListOpt('rabbit_sharded_topics',
+                default=[],
+                help='RPC topics spread over several queues, for topics too '
+                     'busy for a single queue on a single RabbitMQ node. '
+                     'Messages sent to one of these topics go to one of '
+                     'rabbit_topic_shards queues picked at random, the '
+                     'servers consume from all of them. All the clients and '
+                     'servers of a topic must be configured alike.'),
+    cfg.IntOpt('rabbit_topic_shards',
+               default=4,
+               min=1,
+               help='Number of queues of each topic of '
+                    'rabbit_sharded_topics.'),
+    cfg.StrOpt('rabbit_shard_master_locator',
+               default='min-masters',
+               choices=('min-masters', 'client-local', 'random', ''),
+               help='Queue master locator (x-queue-master-locator) the '
+                    'queues of rabbit_sharded_topics are declared with. '
+                    'RabbitMQ otherwise puts the master of a queue on the '
+                    'node of the connection declaring it, that is all the '
+                    'shards of a topic on a single node. It requires '
+                    'RabbitMQ 3.6 or later. With an empty value, the queues '
+                    'are declared without it and a queue-master-locator '
+                    'policy must spread them instead, e.g. rabbitmqctl '
+                    'set_policy shards \'_shard_[0-9]+$\' '
+                    '\'{"queue-master-locator": "min-masters"}\'. Existing '
+                    'shard queues must be deleted when this value changes.'),
+    cfg.BoolOpt('rabbit_send_channel_multiplexing',
+                default=False,
+                help='Carry all the connections of the send pool as channels '
+                     'of a single AMQP connection per process, instead of '
+                     'opening one AMQP connection (and one heartbeat thread) '
+                     'per pooled connection. Publishers then share the '
+                     'socket and take turns on it.'),
 
     # NOTE(sileht): deprecated option since oslo_messaging 1.5.0,
     cfg.BoolOpt('fake_rabbit',
@@ -206,7 +290,8 @@ rabbit_opts = [
 LOG = logging.getLogger(__name__)
 
 
-def _get_queue_arguments(rabbit_ha_queues, rabbit_queue_ttl):
+def _get_queue_arguments(rabbit_ha_queues, rabbit_queue_ttl,
+                         rabbit_max_priority=0, rabbit_master_locator=None):
     """Construct the arguments for declaring a queue.
 
     If the rabbit_ha_queues option is set, we try to declare a mirrored queue
@@ -229,6 +314,20 @@ def _get_queue_arguments(rabbit_ha_queues, rabbit_queue_ttl):
     Setting a queue TTL causes the queue to be automatically deleted
     if it is unused for the TTL duration.  This is a helpful safeguard
     to prevent queues with zero consumers from growing without bound.
+
+    If the rabbit_max_priority option is > 0, then the queue is declared
+    as a priority queue as described here:
+
+      https://www.rabbitmq.com/priority.html
+
+    Messages published with a higher priority are then delivered before
+    the ones already queued with a lower priority.
+
+    If rabbit_master_locator is set, the queue master is placed on a node
+    picked by this strategy rather than on the node the queue is declared
+    on, as described here:
+
+      https://www.rabbitmq.com/ha.html#queue-master-location
     """
     args = {}
 
@@ -238,22 +337,98 @@ def _get_queue_arguments(rabbit_ha_queues, rabbit_queue_ttl):
     if rabbit_queue_ttl > 0:
         args['x-expires'] = rabbit_queue_ttl * 1000
 
+    if rabbit_max_priority > 0:
+        args['x-max-priority'] = rabbit_max_priority
+
+    if rabbit_master_locator:
+        args['x-queue-master-locator'] = rabbit_master_locator
+
     return args
 
 
+class PrefetchController(object):
+    """Prefetch window of a listener, sized like a TCP congestion window.
+
+    The window is the number of messages the broker may deliver without
+    waiting for an acknowledgement. Every ``interval`` seconds it is
+    compared with what happened since the last adjustment:
+
+    * the window was full and at least a window worth of messages got
+      processed: the consumer waits for messages, the window doubles
+    * the window was full but less than half of it got processed: messages
+      are hoarded by a slow consumer instead of going to the other consumers
+      of the queue, the window is halved
+
+    The window stays within [minimum, maximum].
+    """
+
+    def __init__(self, window, minimum, maximum, interval):
+        self.minimum = minimum
+        self.maximum = max(minimum, maximum)
+        self.window = max(self.minimum, min(self.maximum, window))
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._in_flight = 0
+        self._peak = 0
+        self._processed = 0
+        self._next_adjust = timeutils.now() + interval
+
+    def delivered(self):
+        with self._lock:
+            self._in_flight += 1
+            self._peak = max(self._peak, self._in_flight)
+
+    def processed(self):
+        with self._lock:
+            self._in_flight = max(0, self._in_flight - 1)
+            self._processed += 1
+
+    def adjust(self):
+        """Return the new window when it changes, None otherwise."""
+        now = timeutils.now()
+        if now < self._next_adjust:
+            return None
+        self._next_adjust = now + self.interval
+        with self._lock:
+            peak, processed = self._peak, self._processed
+            self._peak = self._in_flight
+            self._processed = 0
+
+        window = self.window
+        if peak >= window:
+            if processed >= window:
+                window = min(self.maximum, window * 2)
+            elif processed < window / 2.0:
+                window = max(self.minimum, window // 2)
+        if window == self.window:
+            return None
+        self.window = window
+        return window
+
+
 class RabbitMessage(dict):
-    def __init__(self, raw_message):
+    def __init__(self, raw_message, prefetch_controller=None):
         super(RabbitMessage, self).__init__(
             rpc_common.deserialize_msg(raw_message.payload))
         LOG.trace('RabbitMessage.Init: message %s', self)
         self._raw_message = raw_message
+        self._prefetch_controller = prefetch_controller
+        if prefetch_controller is not None:
+            prefetch_controller.delivered()
+
+    def _processed(self):
+        if self._prefetch_controller is not None:
+            self._prefetch_controller.processed()
+            self._prefetch_controller = None
 
     def acknowledge(self):
         LOG.trace('RabbitMessage.acknowledge: message %s', self)
+        self._processed()
         self._raw_message.ack()
 
     def requeue(self):
         LOG.trace('RabbitMessage.requeue: message %s', self)
+        self._processed()
         self._raw_message.requeue()
 
 
@@ -262,7 +437,8 @@ class Consumer(object):
 
     def __init__(self, exchange_name, queue_name, routing_key, type, durable,
                  exchange_auto_delete, queue_auto_delete, callback,
-                 nowait=False, rabbit_ha_queues=None, rabbit_queue_ttl=0):
+                 nowait=False, rabbit_ha_queues=None, rabbit_queue_ttl=0,
+                 rabbit_max_priority=0, rabbit_master_locator=None):
         """Init the Consumer class with the exchange_name, routing_key,
         type, durable auto_delete
         """
@@ -276,10 +452,13 @@ class Consumer(object):
         self.type = type
         self.nowait = nowait
         self.queue_arguments = _get_queue_arguments(rabbit_ha_queues,
-                                                    rabbit_queue_ttl)
+                                                    rabbit_queue_ttl,
+                                                    rabbit_max_priority,
+                                                    rabbit_master_locator)
 
         self.queue = None
         self._declared_on = None
+        self._prefetch_controller = None
         self.exchange = kombu.entity.Exchange(
             name=exchange_name,
             type=type,
@@ -324,6 +503,7 @@ class Consumer(object):
         # Ensure we are on the correct channel before consuming
         if conn.channel != self._declared_on:
             self.declare(conn)
+        self._prefetch_controller = conn.prefetch_controller
         try:
             self.queue.consume(callback=self._callback,
                                consumer_tag=six.text_type(tag),
@@ -362,17 +542,132 @@ class Consumer(object):
         if m2p:
             message = m2p(message)
         try:
-            self.callback(RabbitMessage(message))
+            self.callback(RabbitMessage(message, self._prefetch_controller))
         except Exception:
             LOG.exception(_LE("Failed to process message"
                               " ... skipping it."))
             message.ack()
 
 
+def _host_key(url):
+    parsed = parse.urlsplit(url)
+    return parsed.hostname, parsed.port or 5672
+
+
+class HostLatencyTracker(object):
+    """Process wide record of the round trip time to each broker node.
+
+    The round trip time of a node is measured by opening a TCP connection to
+    it, and smoothed with an exponentially weighted moving average. A node
+    that failed recently is unhealthy, it is ranked after the healthy ones.
+
+    The TCP handshake is used rather than the AMQP heartbeats, which are one
+    way frames nobody replies to, and rather than the connection in use,
+    which only reaches the current node. It measures the network distance
+    to every node at the same cost, not how loaded a broker is.
+    """
+
+    def __init__(self, alpha=0.3, max_age=60, failure_ttl=60,
+                 probe_timeout=1.0):
+        self.alpha = alpha
+        self.max_age = max_age
+        self.failure_ttl = failure_ttl
+        self.probe_timeout = probe_timeout
+        self._lock = threading.Lock()
+        # (hostname, port) -> [rtt, measured at, failed at]
+        self._hosts = {}
+        self._to_probe = []
+        self._prober = None
+
+    def _entry(self, url):
+        return self._hosts.setdefault(_host_key(url), [None, None, None])
+
+    def record(self, url, rtt):
+        with self._lock:
+            entry = self._entry(url)
+            if entry[0] is None:
+                entry[0] = rtt
+            else:
+                entry[0] += self.alpha * (rtt - entry[0])
+            entry[1] = timeutils.now()
+
+    def record_failure(self, url):
+        with self._lock:
+            entry = self._entry(url)
+            entry[1] = entry[2] = timeutils.now()
+
+    def rtt(self, url):
+        return self._hosts.get(_host_key(url), [None])[0]
+
+    def healthy(self, url):
+        failed_at = self._hosts.get(_host_key(url), [None] * 3)[2]
+        return (failed_at is None or
+                timeutils.now() - failed_at > self.failure_ttl)
+
+    def probe(self, url, force=False):
+        """Measure the round trip time to a node, unless it was measured
+        less than max_age seconds ago.
+        """
+        measured_at = self._hosts.get(_host_key(url), [None] * 3)[1]
+        if (not force and measured_at is not None and
+                timeutils.now() - measured_at < self.max_age):
+            return
+        start = timeutils.now()
+        try:
+            sock = socket.create_connection(_host_key(url),
+                                            self.probe_timeout)
+        except (socket.error, socket.timeout):
+            self.record_failure(url)
+        else:
+            self.record(url, timeutils.now() - start)
+            sock.close()
+
+    def probe_in_background(self, urls):
+        """Measure the round trip time to some nodes from a thread of its
+        own, the callers keep ranking the nodes by the previous measures.
+        """
+        with self._lock:
+            for url in urls:
+                if url not in self._to_probe:
+                    self._to_probe.append(url)
+            if self._prober is None:
+                self._prober = threading.Thread(target=self._probe_queued)
+                self._prober.daemon = True
+                self._prober.start()
+
+    def _probe_queued(self):
+        while True:
+            with self._lock:
+                if not self._to_probe:
+                    self._prober = None
+                    return
+                url = self._to_probe.pop(0)
+            try:
+                self.probe(url, force=True)
+            except Exception:
+                LOG.debug('Failed to probe %s', _host_key(url),
+                          exc_info=True)
+
+    def rank(self, urls):
+        """Sort urls, healthy and fast nodes first, unmeasured ones after
+        the measured ones.
+        """
+        def key(url):
+            rtt = self.rtt(url)
+            return (not self.healthy(url), rtt is None, rtt or 0)
+        return sorted(urls, key=key)
+
+
+_host_latencies = HostLatencyTracker()
+
+
 class DummyConnectionLock(_utils.DummyLock):
     def heartbeat_acquire(self):
         pass
 
+    def heartbeat_try_acquire(self):
+        return True
+
 
 class ConnectionLock(DummyConnectionLock):
     """Lock object to protect access to the kombu connection
@@ -421,6 +716,14 @@ class ConnectionLock(DummyConnectionLock):
                 self._heartbeat_waiting = False
             self._lock_acquired = self._get_thread_id()
 
+    def heartbeat_try_acquire(self):
+        """Acquire the lock only if nobody holds it, return whether it did."""
+        with self._monitor:
+            if self._lock_acquired is not None:
+                return False
+            self._lock_acquired = self._get_thread_id()
+            return True
+
     def release(self):
         with self._monitor:
             if self._lock_acquired is None:
@@ -437,20 +740,122 @@ class ConnectionLock(DummyConnectionLock):
                 self._workers_locks.notify()
 
     @contextlib.contextmanager
-    def for_heartbeat(self):
-        self.heartbeat_acquire()
+    def for_heartbeat(self, wait=True):
+        """Hold the lock for the heartbeat, yield whether it was acquired.
+
+        Without wait, the lock is not acquired when someone else holds it.
+        """
+        if wait:
+            self.heartbeat_acquire()
+        elif not self.heartbeat_try_acquire():
+            yield False
+            return
         try:
-            yield
+            yield True
         finally:
             self.release()
 
 
+class HeartbeatScheduler(object):
+    """Single thread maintaining the heartbeat of many connections.
+
+    The registered connections are kept in a heap ordered by the time their
+    heartbeat is due. The thread sleeps until the earliest one, maintains the
+    connections which are due and schedules them again, so idle connections
+    cost neither a thread nor a wake up each. The thread exits once no
+    connection is registered anymore.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._wakeup = threading.Condition(self._lock)
+        # (deadline, registration, connection)
+        self._heap = []
+        # connection -> registration, entries of unregistered connections
+        # are dropped from the heap when they come first
+        self._registered = {}
+        self._registrations = itertools.count()
+        self._current = None
+        self._thread = None
+
+    def register(self, connection, interval):
+        with self._lock:
+            registration = next(self._registrations)
+            self._registered[connection] = registration
+            heapq.heappush(self._heap, (timeutils.now() + interval,
+                                        registration, connection))
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run)
+                self._thread.daemon = True
+                self._thread.start()
+            self._wakeup.notify_all()
+
+    def unregister(self, connection):
+        """Stop maintaining connection, once its heartbeat is done."""
+        with self._lock:
+            self._registered.pop(connection, None)
+            while self._current is connection:
+                self._wakeup.wait()
+
+    def __len__(self):
+        return len(self._registered)
+
+    def _next_due(self):
+        """Wait for the next connection due, None when there is none.
+
+        NOTE: Must be called within the lock
+        """
+        while True:
+            while self._heap and (self._registered.get(self._heap[0][2]) !=
+                                  self._heap[0][1]):
+                heapq.heappop(self._heap)
+            if not self._heap:
+                return None
+            delay = self._heap[0][0] - timeutils.now()
+            if delay <= 0:
+                return heapq.heappop(self._heap)
+            self._wakeup.wait(delay)
+
+    def _run(self):
+        while True:
+            with self._lock:
+                due = self._next_due()
+                if due is None:
+                    self._thread = None
+                    return
+                registration, connection = due[1:]
+                self._current = connection
+            try:
+                # NOTE: neither reconnecting nor waiting for a connection
+                # busy elsewhere must hold up the heartbeat of every other
+                # connection
+                connection._heartbeat_tick(reconnect=False, wait=False)
+            finally:
+                with self._lock:
+                    self._current = None
+                    if self._registered.get(connection) == registration:
+                        heapq.heappush(self._heap, (
+                            timeutils.now() +
+                            connection._heartbeat_wait_timeout,
+                            registration, connection))
+                    self._wakeup.notify_all()
+
+
+_heartbeat_scheduler = HeartbeatScheduler()
+
+
 class Connection(object):
-    """Connection object."""
+    """Connection object.
+
+    When ``shared`` is given, this object does not open its own AMQP
+    connection: it opens a channel on the kombu connection of ``shared``
+    and serializes its use of the socket with ``shared``'s connection lock.
+    The heartbeat of the socket is left to ``shared``.
+    """
 
     pools = {}
 
-    def __init__(self, conf, url, purpose):
+    def __init__(self, conf, url, purpose, shared=None):
         # NOTE(viktors): Parse config options
         driver_conf = conf.oslo_messaging_rabbit
 
@@ -470,9 +875,12 @@ class Connection(object):
         self.rabbit_transient_queues_ttl = \
             driver_conf.rabbit_transient_queues_ttl
         self.rabbit_qos_prefetch_count = driver_conf.rabbit_qos_prefetch_count
+        self.rabbit_qos_prefetch_adaptive = \
+            driver_conf.rabbit_qos_prefetch_adaptive
         self.heartbeat_timeout_threshold = \
             driver_conf.heartbeat_timeout_threshold
         self.heartbeat_rate = driver_conf.heartbeat_rate
+        self.heartbeat_shared_thread = driver_conf.heartbeat_shared_thread
         self.kombu_reconnect_delay = driver_conf.kombu_reconnect_delay
         self.amqp_durable_queues = driver_conf.amqp_durable_queues
         self.amqp_auto_delete = driver_conf.amqp_auto_delete
@@ -480,7 +888,14 @@ class Connection(object):
         self.kombu_missing_consumer_retry_timeout = \
             driver_conf.kombu_missing_consumer_retry_timeout
         self.kombu_failover_strategy = driver_conf.kombu_failover_strategy
+        self.kombu_latency_rebalance_interval = \
+            driver_conf.kombu_latency_rebalance_interval
         self.kombu_compression = driver_conf.kombu_compression
+        self.rabbit_max_priority = driver_conf.rabbit_max_priority
+        self.rabbit_sharded_topics = set(driver_conf.rabbit_sharded_topics)
+        self.rabbit_topic_shards = driver_conf.rabbit_topic_shards
+        self.rabbit_shard_master_locator = \
+            driver_conf.rabbit_shard_master_locator
 
         if self.rabbit_use_ssl:
             self.kombu_ssl_version = driver_conf.kombu_ssl_version
@@ -498,6 +913,7 @@ class Connection(object):
             virtual_host = self.virtual_host
 
         self._url = ''
+        self._host_urls = []
         if self.fake_rabbit:
             LOG.warning(_LW("Deprecated: fake_rabbit option is deprecated, "
                             "set rpc_backend to kombu+memory or use the fake "
@@ -514,14 +930,13 @@ class Connection(object):
             for host in url.hosts:
                 transport = url.transport.replace('kombu+', '')
                 transport = transport.replace('rabbit', 'amqp')
-                self._url += '%s%s://%s:%s@%s:%s/%s' % (
-                    ";" if self._url else '',
+                self._host_urls.append('%s://%s:%s@%s:%s/%s' % (
                     transport,
                     parse.quote(host.username or ''),
                     parse.quote(host.password or ''),
                     self._parse_url_hostname(host.hostname) or '',
                     str(host.port or 5672),
-                    virtual_host)
+                    virtual_host))
         elif url.transport.startswith('kombu+'):
             # NOTE(sileht): url have a + but no hosts
             # (like kombu+memory:///), pass it to kombu as-is
@@ -533,12 +948,23 @@ class Connection(object):
             for adr in self.rabbit_hosts:
                 hostname, port = netutils.parse_host_port(
                     adr, default_port=self.rabbit_port)
-                self._url += '%samqp://%s:%s@%s:%s/%s' % (
-                    ";" if self._url else '',
+                self._host_urls.append('amqp://%s:%s@%s:%s/%s' % (
                     parse.quote(self.rabbit_userid, ''),
                     parse.quote(self.rabbit_password, ''),
                     self._parse_url_hostname(hostname), port,
-                    virtual_host)
+                    virtual_host))
+
+        self._latency_failover = (self.kombu_failover_strategy == 'latency' and
+                                  len(self._host_urls) > 1)
+        if self._latency_failover:
+            # NOTE: the first connections of a process keep the configured
+            # order of the nodes until they are measured
+            _host_latencies.probe_in_background(self._host_urls)
+            self._host_urls = _host_latencies.rank(self._host_urls)
+        if self._host_urls:
+            self._url = ';'.join(self._host_urls)
+        self._next_rebalance = (timeutils.now() +
+                                self.kombu_latency_rebalance_interval)
 
         self._initial_pid = os.getpid()
 
@@ -558,10 +984,26 @@ class Connection(object):
         self.channel = None
         self.purpose = purpose
 
+        self.prefetch_controller = None
+        if (self.rabbit_qos_prefetch_adaptive and
+                purpose == rpc_common.PURPOSE_LISTEN):
+            self.prefetch_controller = PrefetchController(
+                self.rabbit_qos_prefetch_count,
+                driver_conf.rabbit_qos_prefetch_min,
+                driver_conf.rabbit_qos_prefetch_max,
+                driver_conf.rabbit_qos_prefetch_adjust_interval)
+
+        # NOTE: the kombu transport connection the channel of a shared
+        # connection was opened on, to notice it went away on reconnection
+        self._shared = shared
+        self._channel_connection = None
+
         # NOTE(sileht): if purpose is PURPOSE_LISTEN
         # we don't need the lock because we don't
         # have a heartbeat thread
-        if purpose == rpc_common.PURPOSE_SEND:
+        if shared is not None:
+            self._connection_lock = shared._connection_lock
+        elif purpose == rpc_common.PURPOSE_SEND:
             self._connection_lock = ConnectionLock()
         else:
             self._connection_lock = DummyConnectionLock()
@@ -570,24 +1012,10 @@ class Connection(object):
         self.name = "%s:%d:%s" % (os.path.basename(sys.argv[0]),
                                   os.getpid(),
                                   self.connection_id)
-        self.connection = kombu.connection.Connection(
-            self._url, ssl=self._fetch_ssl_params(),
-            login_method=self.login_method,
-            heartbeat=self.heartbeat_timeout_threshold,
-            failover_strategy=self.kombu_failover_strategy,
-            transport_options={
-                'confirm_publish': True,
-                'client_properties': {
-                    'capabilities': {
-                        'authentication_failure_close': True,
-                        'connection.blocked': True,
-                        'consumer_cancel_notify': True
-                    },
-                    'connection_name': self.name},
-                'on_blocked': self._on_connection_blocked,
-                'on_unblocked': self._on_connection_unblocked,
-            },
-        )
+        if shared is not None:
+            self.connection = shared.connection
+        else:
+            self.connection = self._create_connection()
 
         LOG.debug('[%(connection_id)s] Connecting to AMQP server on'
                   ' %(hostname)s:%(port)s',
@@ -607,13 +1035,20 @@ class Connection(object):
         self._heartbeat_support_log_emitted = False
 
         # NOTE(sileht): just ensure the connection is setuped at startup
-        self.ensure_connection()
+        if shared is not None:
+            # NOTE: the heartbeat thread of the shared connection
+            # is already running
+            with self._connection_lock:
+                self.ensure_connection()
+        else:
+            self.ensure_connection()
 
         # NOTE(sileht): if purpose is PURPOSE_LISTEN
         # the consume code does the heartbeat stuff
         # we don't need a thread
         self._heartbeat_thread = None
-        if purpose == rpc_common.PURPOSE_SEND:
+        self._heartbeat_scheduled = False
+        if purpose == rpc_common.PURPOSE_SEND and shared is None:
             self._heartbeat_start()
 
         LOG.debug('[%(connection_id)s] Connected to AMQP server on '
@@ -638,6 +1073,86 @@ class Connection(object):
             self.connection.port = 1234
             self._poll_timeout = 0.05
 
+    def _create_connection(self):
+        if self._latency_failover:
+            failover_strategy = self._latency_failover_cycle
+        else:
+            failover_strategy = self.kombu_failover_strategy
+        return kombu.connection.Connection(
+            self._url, ssl=self._fetch_ssl_params(),
+            login_method=self.login_method,
+            heartbeat=self.heartbeat_timeout_threshold,
+            failover_strategy=failover_strategy,
+            transport_options={
+                'confirm_publish': True,
+                'client_properties': {
+                    'capabilities': {
+                        'authentication_failure_close': True,
+                        'connection.blocked': True,
+                        'consumer_cancel_notify': True
+                    },
+                    'connection_name': self.name},
+                'on_blocked': self._on_connection_blocked,
+                'on_unblocked': self._on_connection_unblocked,
+            },
+        )
+
+    def _current_host_url(self):
+        current = (self.connection.hostname, self.connection.port or 5672)
+        for host_url in self._host_urls:
+            if _host_key(host_url) == current:
+                return host_url
+
+    def _latency_failover_cycle(self, host_urls):
+        """kombu failover strategy picking the fastest healthy node."""
+        # NOTE: kombu skips the first node, it is the one used initially
+        yield host_urls[0]
+        while True:
+            current = self._current_host_url()
+            others = [host_url for host_url in host_urls
+                      if host_url != current] or host_urls
+            for host_url in others:
+                _host_latencies.probe(host_url)
+            yield _host_latencies.rank(others)[0]
+
+    def _maybe_rebalance(self):
+        """Move a listener connection to a node at least twice as fast as
+        the current one, see kombu_latency_rebalance_interval.
+
+        The nodes are ranked by the round trip times measured so far, the
+        new measures are taken in the background not to hold the connection
+        lock meanwhile, and are used by the next rebalance.
+
+        NOTE: Must be called within the connection lock
+        """
+        if (not self._latency_failover or
+                not self.kombu_latency_rebalance_interval or
+                self.purpose != rpc_common.PURPOSE_LISTEN):
+            return
+        now = timeutils.now()
+        if now < self._next_rebalance:
+            return
+        self._next_rebalance = now + self.kombu_latency_rebalance_interval
+
+        _host_latencies.probe_in_background(self._host_urls)
+        current = self._current_host_url()
+        best = _host_latencies.rank(self._host_urls)[0]
+        if current is None or best == current:
+            return
+        current_rtt = _host_latencies.rtt(current)
+        if (_host_latencies.healthy(current) and current_rtt is not None and
+                _host_latencies.rtt(best) * 2 > current_rtt):
+            return
+
+        LOG.info(_LI('[%(connection_id)s] Moving to the faster AMQP server '
+                     'on %(hostname)s:%(port)s'),
+                 {'connection_id': self.connection_id,
+                  'hostname': _host_key(best)[0],
+                  'port': _host_key(best)[1]})
+        self.connection.switch(best)
+        self._new_tags = set(self._consumers.values())
+        self.ensure_connection()
+
     # FIXME(markmc): use oslo sslutils when it is available as a library
     _SSL_PROTOCOLS = {
         "tlsv1": ssl.PROTOCOL_TLSv1,
@@ -739,6 +1254,11 @@ class Connection(object):
                       % self.connection_id,
                       exc_info=True)
 
+            if self._latency_failover:
+                current = self._current_host_url()
+                if current is not None:
+                    _host_latencies.record_failure(current)
+
             recoverable_error_callback and recoverable_error_callback(exc)
 
             interval = (self.kombu_reconnect_delay + interval
@@ -779,8 +1299,11 @@ class Connection(object):
             """Callback invoked when the kombu reconnects and creates
             a new channel, we use it the reconfigure our consumers.
             """
-            self._set_current_channel(new_channel)
-            self.set_transport_socket_timeout()
+            # NOTE: new_channel is the default channel of the shared
+            # connection, a channel of our own is opened by execute_method
+            if self._shared is None:
+                self._set_current_channel(new_channel)
+                self.set_transport_socket_timeout()
 
             LOG.info(_LI('[%(connection_id)s] Reconnected to AMQP server on '
                          '%(hostname)s:%(port)s via [%(transport)s] client '
@@ -788,6 +1311,8 @@ class Connection(object):
                      self._get_connection_info())
 
         def execute_method(channel):
+            if self._shared is not None:
+                channel = self._shared_channel()
             self._set_current_channel(channel)
             method()
 
@@ -814,7 +1339,8 @@ class Connection(object):
                 interval_max=self.interval_max,
                 on_revive=on_reconnection)
             ret, channel = autoretry_method()
-            self._set_current_channel(channel)
+            if self._shared is None:
+                self._set_current_channel(channel)
             return ret
         except recoverable_errors as exc:
             LOG.debug("Received recoverable error from kombu:",
@@ -838,6 +1364,21 @@ class Connection(object):
             error_callback and error_callback(exc)
             raise
 
+    def _shared_channel(self):
+        """Return our channel on the shared connection, opening a new one
+        if the shared connection has been reestablished since.
+
+        NOTE: Must be called within the connection lock
+        """
+        transport_connection = self.connection.connection
+        if (self.channel is None or
+                self._channel_connection is not transport_connection):
+            self._set_current_channel(None)
+            self._set_current_channel(self.connection.channel())
+            self._channel_connection = transport_connection
+            self.set_transport_socket_timeout()
+        return self.channel
+
     def _set_current_channel(self, new_channel):
         """Change the channel to use.
 
@@ -860,15 +1401,60 @@ class Connection(object):
             for consumer in self._consumers:
                 consumer.declare(self)
 
+    def _maybe_adjust_prefetch(self):
+        """Apply the new window of an adaptive prefetch, if any.
+
+        NOTE: Must be called within the connection lock
+        """
+        if self.prefetch_controller is None:
+            return
+        window = self.prefetch_controller.adjust()
+        if window is None or self.channel is None:
+            return
+        LOG.debug('[%(connection_id)s] Prefetch count set to %(window)d',
+                  {'connection_id': self.connection_id, 'window': window})
+        try:
+            self.channel.basic_qos(0, window, True)
+        except self.connection.recoverable_channel_errors as exc:
+            # NOTE: the window is applied again with the new channel
+            LOG.debug('Unable to set the prefetch count: %s', exc)
+
+    def set_prefetch_count(self, prefetch_count):
+        """Use a fixed prefetch count instead of an adaptive one."""
+        with self._connection_lock:
+            adaptive = self.prefetch_controller is not None
+            self.prefetch_controller = None
+            self.rabbit_qos_prefetch_count = prefetch_count
+            if self.channel is None:
+                return
+            if adaptive:
+                # NOTE: the per channel window would still cap the per
+                # consumer prefetch count, lift it
+                self.channel.basic_qos(0, 0, True)
+            self._set_qos(self.channel)
+
     def _set_qos(self, channel):
         """Set QoS prefetch count on the channel"""
-        if self.rabbit_qos_prefetch_count > 0:
+        if self.prefetch_controller is not None:
+            # NOTE: a per consumer prefetch count only applies to the
+            # consumers started after it is set, a per channel one can be
+            # changed while consuming
+            channel.basic_qos(0, self.prefetch_controller.window, True)
+        elif self.rabbit_qos_prefetch_count > 0:
             channel.basic_qos(0,
                               self.rabbit_qos_prefetch_count,
                               False)
 
     def close(self):
         """Close/release this connection."""
+        if self._shared is not None:
+            # NOTE: only our channel belongs to us, the shared connection
+            # is released by its owner
+            if self.connection:
+                with self._connection_lock:
+                    self._set_current_channel(None)
+                self.connection = None
+            return
         self._heartbeat_stop()
         if self.connection:
             for consumer, tag in self._consumers.items():
@@ -880,6 +1466,21 @@ class Connection(object):
             self.connection.release()
             self.connection = None
 
+    def is_healthy(self):
+        """Check whether the connection to the broker is still usable."""
+        if self.connection is None or not self.connection.connected:
+            return False
+        if not self._heartbeat_supported_and_enabled():
+            return True
+        recoverable_errors = (self.connection.recoverable_channel_errors +
+                              self.connection.recoverable_connection_errors)
+        with self._connection_lock:
+            try:
+                self._heartbeat_check()
+            except recoverable_errors:
+                return False
+        return True
+
     def reset(self):
         """Reset a connection so it can be used again."""
         recoverable_errors = (self.connection.recoverable_channel_errors +
@@ -965,7 +1566,11 @@ class Connection(object):
         self.connection.heartbeat_check(rate=self.heartbeat_rate)
 
     def _heartbeat_start(self):
-        if self._heartbeat_supported_and_enabled():
+        if self._heartbeat_supported_and_enabled() and \
+                self.heartbeat_shared_thread:
+            _heartbeat_scheduler.register(self, self._heartbeat_wait_timeout)
+            self._heartbeat_scheduled = True
+        elif self._heartbeat_supported_and_enabled():
             self._heartbeat_exit_event = eventletutils.Event()
             self._heartbeat_thread = threading.Thread(
                 target=self._heartbeat_thread_job)
@@ -975,6 +1580,9 @@ class Connection(object):
             self._heartbeat_thread = None
 
     def _heartbeat_stop(self):
+        if self._heartbeat_scheduled:
+            _heartbeat_scheduler.unregister(self)
+            self._heartbeat_scheduled = False
         if self._heartbeat_thread is not None:
             self._heartbeat_exit_event.set()
             self._heartbeat_thread.join()
@@ -984,37 +1592,53 @@ class Connection(object):
         """Thread that maintains inactive connections
         """
         while not self._heartbeat_exit_event.is_set():
-            with self._connection_lock.for_heartbeat():
+            self._heartbeat_tick()
+            self._heartbeat_exit_event.wait(
+                timeout=self._heartbeat_wait_timeout)
+        self._heartbeat_exit_event.clear()
+
+    def _heartbeat_tick(self, reconnect=True, wait=True):
+        """Maintain an inactive connection once.
 
-                recoverable_errors = (
-                    self.connection.recoverable_channel_errors +
-                    self.connection.recoverable_connection_errors)
+        Without reconnect, a broken connection is left to be reconnected
+        by its next user rather than holding up the caller. Without wait,
+        a connection which is in use is skipped, its user is already doing
+        I/O on it.
+        """
+        with self._connection_lock.for_heartbeat(wait=wait) as acquired:
+            if not acquired:
+                LOG.debug("Connection in use, skipping its heartbeat")
+                return
 
+            recoverable_errors = (
+                self.connection.recoverable_channel_errors +
+                self.connection.recoverable_connection_errors)
+
+            try:
                 try:
+                    self._heartbeat_check()
+                    # NOTE(sileht): We need to drain event to receive
+                    # heartbeat from the broker but don't hold the
+                    # connection too much times. In amqpdriver a connection
+                    # is used exclusively for read or for write, so we have
+                    # to do this for connection used for write drain_events
+                    # already do that for other connection
                     try:
-                        self._heartbeat_check()
-                        # NOTE(sileht): We need to drain event to receive
-                        # heartbeat from the broker but don't hold the
-                        # connection too much times. In amqpdriver a connection
-                        # is used exclusively for read or for write, so we have
-                        # to do this for connection used for write drain_events
-                        # already do that for other connection
-                        try:
-                            self.connection.drain_events(timeout=0.001)
-                        except socket.timeout:
-                            pass
-                    except recoverable_errors as exc:
+                        self.connection.drain_events(timeout=0.001)
+                    except socket.timeout:
+                        pass
+                except recoverable_errors as exc:
+                    if not reconnect:
                         LOG.info(_LI("A recoverable connection/channel error "
-                                     "occurred, trying to reconnect: %s"), exc)
-                        self.ensure_connection()
-                except Exception:
-                    LOG.warning(_LW("Unexpected error during heartbeart "
-                                    "thread processing, retrying..."))
-                    LOG.debug('Exception', exc_info=True)
-
-            self._heartbeat_exit_event.wait(
-                timeout=self._heartbeat_wait_timeout)
-        self._heartbeat_exit_event.clear()
+                                     "occurred: %s"), exc)
+                        return
+                    LOG.info(_LI("A recoverable connection/channel error "
+                                 "occurred, trying to reconnect: %s"), exc)
+                    self.ensure_connection()
+            except Exception:
+                LOG.warning(_LW("Unexpected error during heartbeart "
+                                "thread processing, retrying..."))
+                LOG.debug('Exception', exc_info=True)
 
     def declare_consumer(self, consumer):
         """Create a Consumer using the class that was passed in and
@@ -1092,6 +1716,8 @@ class Connection(object):
                         _raise_timeout, exc, maximum=self._poll_timeout)
 
         with self._connection_lock:
+            self._maybe_rebalance()
+            self._maybe_adjust_prefetch()
             self.ensure(_consume,
                         recoverable_error_callback=_recoverable_error_callback,
                         error_callback=_error_callback)
@@ -1118,20 +1744,44 @@ class Connection(object):
 
         self.declare_consumer(consumer)
 
-    def declare_topic_consumer(self, exchange_name, topic, callback=None,
-                               queue_name=None):
-        """Create a 'topic' consumer."""
-        consumer = Consumer(exchange_name=exchange_name,
-                            queue_name=queue_name or topic,
-                            routing_key=topic,
-                            type='topic',
-                            durable=self.amqp_durable_queues,
-                            exchange_auto_delete=self.amqp_auto_delete,
-                            queue_auto_delete=self.amqp_auto_delete,
-                            callback=callback,
-                            rabbit_ha_queues=self.rabbit_ha_queues)
+    def _topic_shard(self, topic, shard):
+        return '%s_shard_%d' % (topic, shard)
 
-        self.declare_consumer(consumer)
+    def declare_topic_consumer(self, exchange_name, topic, callback=None,
+                               queue_name=None, prioritized=False):
+        """Create a 'topic' consumer.
+
+        The consumer of a sharded topic consumes from every shard of the
+        topic, and from the topic itself for the senders not sharding it.
+        The shards are declared with the rabbit_shard_master_locator queue
+        master locator, so that they do not all land on the node of this
+        connection.
+        The queues of a prioritized consumer are declared with the
+        rabbit_max_priority maximum priority.
+        """
+        routing_keys = [topic]
+        if queue_name is None and topic in self.rabbit_sharded_topics:
+            routing_keys.extend(self._topic_shard(topic, shard)
+                                for shard in range(self.rabbit_topic_shards))
+
+        for routing_key in routing_keys:
+            master_locator = (self.rabbit_shard_master_locator
+                              if routing_key != topic else None)
+            consumer = Consumer(exchange_name=exchange_name,
+                                queue_name=queue_name or routing_key,
+                                routing_key=routing_key,
+                                type='topic',
+                                durable=self.amqp_durable_queues,
+                                exchange_auto_delete=self.amqp_auto_delete,
+                                queue_auto_delete=self.amqp_auto_delete,
+                                callback=callback,
+                                rabbit_ha_queues=self.rabbit_ha_queues,
+                                rabbit_max_priority=(
+                                    self.rabbit_max_priority
+                                    if prioritized else 0),
+                                rabbit_master_locator=master_locator)
+
+            self.declare_consumer(consumer)
 
     def declare_fanout_consumer(self, topic, callback):
         """Create a 'fanout' consumer."""
@@ -1154,7 +1804,7 @@ class Connection(object):
         self.declare_consumer(consumer)
 
     def _ensure_publishing(self, method, exchange, msg, routing_key=None,
-                           timeout=None, retry=None):
+                           timeout=None, retry=None, **kwargs):
         """Send to a publisher based on the publisher class."""
 
         def _error_callback(exc):
@@ -1163,7 +1813,8 @@ class Connection(object):
                           "'%(topic)s': %(err_str)s"), log_info)
             LOG.debug('Exception', exc_info=exc)
 
-        method = functools.partial(method, exchange, msg, routing_key, timeout)
+        method = functools.partial(method, exchange, msg, routing_key, timeout,
+                                   **kwargs)
 
         with self._connection_lock:
             self.ensure(method, retry=retry, error_callback=_error_callback)
@@ -1177,7 +1828,8 @@ class Connection(object):
                      'connection_id': self.connection_id})
         return info
 
-    def _publish(self, exchange, msg, routing_key=None, timeout=None):
+    def _publish(self, exchange, msg, routing_key=None, timeout=None,
+                 priority=None):
         """Publish a message."""
 
         if not (exchange.passive or exchange.name in self._declared_exchanges):
@@ -1190,6 +1842,10 @@ class Connection(object):
         LOG.trace('Connection._publish: sending message %(msg)s to'
                   ' %(who)s with routing key %(key)s', log_info)
 
+        kwargs = {}
+        if priority is not None:
+            kwargs['priority'] = priority
+
         # NOTE(sileht): no need to wait more, caller expects
         # a answer before timeout is reached
         with self._transport_socket_timeout(timeout):
@@ -1197,7 +1853,8 @@ class Connection(object):
                                    exchange=exchange,
                                    routing_key=routing_key,
                                    expiration=timeout,
-                                   compression=self.kombu_compression)
+                                   compression=self.kombu_compression,
+                                   **kwargs)
 
     def _publish_and_creates_default_queue(self, exchange, msg,
                                            routing_key=None, timeout=None):
@@ -1272,7 +1929,8 @@ class Connection(object):
         self._ensure_publishing(self._publish_and_raises_on_missing_exchange,
                                 exchange, msg, routing_key=msg_id)
 
-    def topic_send(self, exchange_name, topic, msg, timeout=None, retry=None):
+    def topic_send(self, exchange_name, topic, msg, timeout=None, retry=None,
+                   priority=None):
         """Send a 'topic' message."""
         exchange = kombu.entity.Exchange(
             name=exchange_name,
@@ -1280,9 +1938,13 @@ class Connection(object):
             durable=self.amqp_durable_queues,
             auto_delete=self.amqp_auto_delete)
 
+        if topic in self.rabbit_sharded_topics:
+            topic = self._topic_shard(
+                topic, random.randrange(self.rabbit_topic_shards))
+
         self._ensure_publishing(self._publish, exchange, msg,
                                 routing_key=topic, timeout=timeout,
-                                retry=retry)
+                                retry=retry, priority=priority)
 
     def fanout_send(self, topic, msg, retry=None):
         """Send a 'fanout' message."""
@@ -1305,6 +1967,40 @@ class Connection(object):
                                 exchange, msg, routing_key=topic, retry=retry)
 
 
+class ChannelConnectionPool(pool.ConnectionPool):
+    """Pool handing out channels of one shared connection for sending.
+
+    The first send connection created by the pool owns the AMQP connection
+    and its heartbeat thread, it is never handed out. Listeners still get
+    a connection of their own.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(ChannelConnectionPool, self).__init__(*args, **kwargs)
+        self._shared = None
+        self._shared_lock = threading.Lock()
+
+    def create(self, purpose=rpc_common.PURPOSE_SEND):
+        if purpose != rpc_common.PURPOSE_SEND:
+            return super(ChannelConnectionPool, self).create(purpose)
+        with self._shared_lock:
+            if self._shared is None:
+                LOG.debug('Pool creating new shared connection')
+                self._shared = self.connection_cls(self.conf, self.url,
+                                                   purpose)
+            shared = self._shared
+        LOG.debug('Pool creating new channel on the shared connection')
+        return self.connection_cls(self.conf, self.url, purpose,
+                                   shared=shared)
+
+    def empty(self):
+        super(ChannelConnectionPool, self).empty()
+        with self._shared_lock:
+            if self._shared is not None:
+                self._shared.close()
+                self._shared = None
+
+
 class RabbitDriver(amqpdriver.AMQPDriverBase):
     """RabbitMQ Driver
 
@@ -1329,6 +2025,8 @@ class RabbitDriver(amqpdriver.AMQPDriverBase):
         self.missing_destination_retry_timeout = (
             conf.oslo_messaging_rabbit.kombu_missing_consumer_retry_timeout)
 
+        self.stream_window = conf.oslo_messaging_rabbit.amqp_stream_window
+
         self.prefetch_size = (
             conf.oslo_messaging_rabbit.rabbit_qos_prefetch_count)
 
@@ -1337,9 +2035,18 @@ class RabbitDriver(amqpdriver.AMQPDriverBase):
         min_size = conf.oslo_messaging_rabbit.conn_pool_min_size
         ttl = conf.oslo_messaging_rabbit.conn_pool_ttl
 
-        connection_pool = pool.ConnectionPool(
+        validate_after = (
+            conf.oslo_messaging_rabbit.conn_pool_validate_after or None)
+
+        if conf.oslo_messaging_rabbit.rabbit_send_channel_multiplexing:
+            pool_cls = ChannelConnectionPool
+        else:
+            pool_cls = pool.ConnectionPool
+        connection_pool = pool_cls(
             conf, max_size, min_size, ttl,
-            url, Connection)
+            url, Connection, validate_after)
+        if conf.oslo_messaging_rabbit.conn_pool_warmup:
+            connection_pool.warmup()
 
         super(RabbitDriver, self).__init__(
             conf, url,
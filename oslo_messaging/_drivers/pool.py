@@ -16,12 +16,14 @@ import abc
 import collections
 import sys
 import threading
+import weakref
 
 from oslo_log import log as logging
 from oslo_utils import timeutils
 import six
 
 from oslo_messaging._drivers import common
+from oslo_messaging._i18n import _LE
 
 LOG = logging.getLogger(__name__)
 
@@ -43,81 +45,204 @@ class Pool(object):
     Modelled after the eventlet.pools.Pool interface, but designed to be safe
     when using native threads without the GIL.
 
+    Items idle in the pool for more than `ttl` seconds are expired by a
+    background thread, started when the first item is returned to the pool,
+    as long as more than `min_size` items are free. Items idle for at least
+    `validate_after` seconds are checked with validate() before being handed
+    out, the ones failing the check are discarded.
+
     Resizing is not supported.
 
     """
 
-    def __init__(self, max_size=4, min_size=2, ttl=1200, on_expire=None):
+    def __init__(self, max_size=4, min_size=2, ttl=1200, on_expire=None,
+                 validate_after=None):
         super(Pool, self).__init__()
         self._min_size = min_size
         self._max_size = max_size
         self._item_ttl = ttl
+        self._validate_after = validate_after
         self._current_size = 0
         self._cond = threading.Condition()
         self._items = collections.deque()
         self._on_expire = on_expire
+        self._reaper = None
+        self._reaper_exit = threading.Event()
+        self._stats = collections.Counter()
+        self._max_wait_time = 0
 
     def expire(self):
         """Remove expired items from left (the oldest item) to
         right (the newest item).
         """
+        if self._item_ttl is None:
+            return
+        expired = []
         with self._cond:
-            while len(self._items) > self._min_size:
-                try:
-                    ttl_watch, item = self._items.popleft()
-                    if ttl_watch.expired():
-                        self._on_expire and self._on_expire(item)
-                        self._current_size -= 1
-                    else:
-                        self._items.appendleft((ttl_watch, item))
-                        return
-                except IndexError:
-                    break
+            now = timeutils.now()
+            while (len(self._items) > self._min_size and
+                   now - self._items[0][0] > self._item_ttl):
+                expired.append(self._items.popleft()[1])
+                self._current_size -= 1
+            self._stats['expired'] += len(expired)
+        for item in expired:
+            self._on_expire and self._on_expire(item)
+
+    @staticmethod
+    def _reap(pool_ref, exit_event, interval):
+        # NOTE: the thread only holds a weak reference so that it does not
+        # keep alive a pool which was not stopped
+        while not exit_event.wait(interval):
+            pool = pool_ref()
+            if pool is None:
+                return
+            try:
+                pool.expire()
+            except Exception:
+                LOG.exception(_LE("Failed to expire idle pool items"))
+            del pool
+
+    def _start_reaper(self):
+        # NOTE: check at least once a minute so that items do not outlive
+        # their ttl by much
+        interval = max(min(self._item_ttl, 60), 1)
+        self._reaper = threading.Thread(
+            target=self._reap,
+            args=(weakref.ref(self), self._reaper_exit, interval))
+        self._reaper.daemon = True
+        self._reaper.start()
+
+    def stop(self):
+        """Stop expiring idle items."""
+        with self._cond:
+            reaper, self._reaper = self._reaper, None
+        if reaper is not None:
+            self._reaper_exit.set()
+            reaper.join()
+            self._reaper_exit.clear()
 
     def put(self, item):
         """Return an item to the pool."""
         with self._cond:
-            ttl_watch = timeutils.StopWatch(duration=self._item_ttl)
-            ttl_watch.start()
-            self._items.append((ttl_watch, item))
+            self._items.append((timeutils.now(), item))
+            self._cond.notify()
+            if self._reaper is None and self._item_ttl is not None:
+                self._start_reaper()
+
+    def _discard(self, item):
+        with self._cond:
+            self._current_size -= 1
+            self._stats['invalidated'] += 1
             self._cond.notify()
+        try:
+            self._on_expire and self._on_expire(item)
+        except Exception:
+            LOG.debug('Failed to release a stale pool item', exc_info=True)
 
     def get(self):
         """Return an item from the pool, when one is available.
 
         This may cause the calling thread to block.
         """
-        with self._cond:
-            while True:
-                try:
-                    ttl_watch, item = self._items.pop()
-                    self.expire()
-                    return item
-                except IndexError:
-                    pass
+        while True:
+            with self._cond:
+                wait_start = None
+                while True:
+                    try:
+                        returned, item = self._items.pop()
+                        break
+                    except IndexError:
+                        pass
 
-                if self._current_size < self._max_size:
-                    self._current_size += 1
-                    break
+                    if self._current_size < self._max_size:
+                        self._current_size += 1
+                        returned = item = None
+                        break
 
-                wait_condition(self._cond)
+                    if wait_start is None:
+                        self._stats['exhausted'] += 1
+                        wait_start = timeutils.now()
+                    wait_condition(self._cond)
+
+                if wait_start is not None:
+                    wait_time = timeutils.now() - wait_start
+                    self._stats['wait_time'] += wait_time
+                    self._max_wait_time = max(self._max_wait_time, wait_time)
+
+            if returned is None:
+                break
+
+            if (self._validate_after is None or
+                    timeutils.now() - returned < self._validate_after):
+                return item
+            try:
+                if self.validate(item):
+                    return item
+            except Exception:
+                LOG.debug('Failed to validate a pool item', exc_info=True)
+            LOG.debug('Pool discarding a stale item')
+            self._discard(item)
 
         # We've grabbed a slot and dropped the lock, now do the creation
         try:
-            return self.create()
+            item = self.create()
         except Exception:
             with self._cond:
                 self._current_size -= 1
+                self._cond.notify()
             raise
+        with self._cond:
+            self._stats['created'] += 1
+        return item
+
+    def warmup(self):
+        """Fill the pool up to min_size free items in a background thread."""
+        def fill():
+            items = []
+            try:
+                while len(items) < self._min_size:
+                    items.append(self.get())
+            except Exception:
+                LOG.exception(_LE("Failed to warm up the pool"))
+            for item in items:
+                self.put(item)
+
+        thread = threading.Thread(target=fill)
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def stats(self):
+        """Return the counters of the pool.
+
+        :returns: a dict with the number of items 'created', 'expired' and
+                  'invalidated', the number of times the pool was
+                  'exhausted' and a caller had to wait, the total and the
+                  maximum 'wait_time' and 'max_wait_time' in seconds, the
+                  current 'size' of the pool and the number of 'free' items
+        """
+        with self._cond:
+            stats = dict(created=0, expired=0, invalidated=0, exhausted=0,
+                         wait_time=0)
+            stats.update(self._stats)
+            stats.update(max_wait_time=self._max_wait_time,
+                         size=self._current_size,
+                         free=len(self._items))
+            return stats
 
     def iter_free(self):
         """Iterate over free items."""
         while True:
-            try:
-                _, item = self._items.pop()
-                yield item
-            except IndexError:
-                raise StopIteration
+            with self._cond:
+                try:
+                    _, item = self._items.pop()
+                except IndexError:
+                    return
+            yield item
+
+    def validate(self, item):
+        """Check whether an item which was idle may still be used."""
+        return True
 
     @abc.abstractmethod
     def create(self):
@@ -127,22 +252,27 @@ class Pool(object):
 class ConnectionPool(Pool):
     """Class that implements a Pool of Connections."""
 
-    def __init__(self, conf, max_size, min_size, ttl, url, connection_cls):
+    def __init__(self, conf, max_size, min_size, ttl, url, connection_cls,
+                 validate_after=None):
         self.connection_cls = connection_cls
         self.conf = conf
         self.url = url
         super(ConnectionPool, self).__init__(max_size, min_size, ttl,
-                                             self._on_expire)
+                                             self._on_expire, validate_after)
 
     def _on_expire(self, connection):
         connection.close()
         LOG.debug("Idle connection has expired and been closed."
                   " Pool size: %d" % len(self._items))
 
+    def validate(self, connection):
+        return connection.is_healthy()
+
     def create(self, purpose=common.PURPOSE_SEND):
         LOG.debug('Pool creating new connection')
         return self.connection_cls(self.conf, self.url, purpose)
 
     def empty(self):
+        self.stop()
         for item in self.iter_free():
             item.close()
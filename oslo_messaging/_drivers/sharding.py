@@ -0,0 +1,174 @@
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import bisect
+import collections
+import hashlib
+
+from oslo_messaging._drivers import base
+
+
+class HashRing(object):
+    """Consistent hash ring mapping keys to shards.
+
+    Each shard is placed ``replicas`` times on the ring, a key belongs to the
+    shard owning the next point of the ring. Adding a shard only moves the
+    keys taken over by its points, about 1/N of them.
+
+    :param names: stable names of the shards, the ring positions are derived
+        from them
+    :type names: list
+    :param replicas: number of points of each shard on the ring
+    :type replicas: int
+    """
+
+    def __init__(self, names, replicas=100):
+        if not names:
+            raise ValueError('A hash ring needs at least one shard')
+        points = []
+        for index, name in enumerate(names):
+            for replica in range(replicas):
+                points.append((self._hash('%s-%d' % (name, replica)), index))
+        points.sort()
+        self._hashes = [point[0] for point in points]
+        self._shards = [point[1] for point in points]
+
+    @staticmethod
+    def _hash(key):
+        return int(hashlib.md5(key.encode('utf-8')).hexdigest()[:16], 16)
+
+    def get(self, key):
+        """Return the index of the shard owning key."""
+        pos = bisect.bisect(self._hashes, self._hash(key))
+        return self._shards[pos % len(self._shards)]
+
+
+class MultiListener(base.Listener):
+    """Listener gathering the messages of listeners on several shards."""
+
+    def __init__(self, listeners):
+        first = listeners[0]
+        super(MultiListener, self).__init__(first.batch_size,
+                                            first.batch_timeout,
+                                            first.prefetch_size)
+        self._listeners = listeners
+
+    def start(self, on_incoming_callback):
+        super(MultiListener, self).start(on_incoming_callback)
+        for listener in self._listeners:
+            listener.start(on_incoming_callback)
+
+    def stop(self):
+        for listener in self._listeners:
+            listener.stop()
+        super(MultiListener, self).stop()
+
+    def cleanup(self):
+        for listener in self._listeners:
+            listener.cleanup()
+
+
+class ShardedDriver(base.BaseDriver):
+    """Driver spreading targets over independent brokers.
+
+    Each (exchange, topic, server) address is owned by one of the drivers,
+    chosen by consistent hashing:
+
+    * messages sent to a topic, including fanout ones, go to the shard
+      owning (exchange, topic)
+    * messages sent to a server go to the shard owning
+      (exchange, topic, server)
+    * servers listen on both of these shards, so they get every message
+      meant for them exactly once
+    * notifications go to the shard owning their exchange and topic
+
+    :param transports: the transport of each shard, they are cleaned up
+        with this driver
+    :type transports: list
+    :param names: stable name of each shard, for the hash ring
+    :type names: list
+    """
+
+    def __init__(self, conf, transports, names,
+                 default_exchange=None, allowed_remote_exmods=None):
+        super(ShardedDriver, self).__init__(conf, None, default_exchange,
+                                            allowed_remote_exmods)
+        self._transports = transports
+        self._drivers = [transport._driver for transport in transports]
+        self._ring = HashRing(names)
+
+    def _shard(self, exchange, topic, server=None):
+        key = '%s/%s/%s' % (exchange or self._default_exchange, topic,
+                            server or '')
+        return self._ring.get(key)
+
+    def _driver_for(self, target):
+        if target.fanout:
+            shard = self._shard(target.exchange, target.topic)
+        else:
+            shard = self._shard(target.exchange, target.topic, target.server)
+        return self._drivers[shard]
+
+    def require_features(self, requeue=False):
+        for driver in self._drivers:
+            driver.require_features(requeue=requeue)
+
+    def send(self, target, ctxt, message, wait_for_reply=None, timeout=None,
+             retry=None):
+        return self._driver_for(target).send(
+            target, ctxt, message, wait_for_reply=wait_for_reply,
+            timeout=timeout, retry=retry)
+
+    def send_stream(self, target, ctxt, message, timeout=None, retry=None):
+        return self._driver_for(target).send_stream(
+            target, ctxt, message, timeout=timeout, retry=retry)
+
+    def send_hedged(self, target, ctxt, message, hedge_delay, timeout=None,
+                    retry=None):
+        return self._driver_for(target).send_hedged(
+            target, ctxt, message, hedge_delay, timeout=timeout, retry=retry)
+
+    def send_notification(self, target, ctxt, message, version, retry=None):
+        driver = self._drivers[self._shard(target.exchange, target.topic)]
+        driver.send_notification(target, ctxt, message, version, retry=retry)
+
+    def listen(self, target, batch_size, batch_timeout):
+        shards = [self._shard(target.exchange, target.topic)]
+        if target.server:
+            shard = self._shard(target.exchange, target.topic, target.server)
+            if shard not in shards:
+                shards.append(shard)
+        listeners = [self._drivers[shard].listen(target, batch_size,
+                                                 batch_timeout)
+                     for shard in shards]
+        if len(listeners) == 1:
+            return listeners[0]
+        return MultiListener(listeners)
+
+    def listen_for_notifications(self, targets_and_priorities, pool,
+                                 batch_size, batch_timeout):
+        by_shard = collections.OrderedDict()
+        for target, priority in targets_and_priorities:
+            topic = '%s.%s' % (target.topic, priority)
+            shard = self._shard(target.exchange, topic)
+            by_shard.setdefault(shard, []).append((target, priority))
+        listeners = [
+            self._drivers[shard].listen_for_notifications(
+                shard_targets, pool, batch_size, batch_timeout)
+            for shard, shard_targets in by_shard.items()]
+        if len(listeners) == 1:
+            return listeners[0]
+        return MultiListener(listeners)
+
+    def cleanup(self):
+        for transport in self._transports:
+            transport.cleanup()
@@ -13,6 +13,14 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import math
+import threading
+import time
+
+from oslo_utils import timeutils
+
+from oslo_messaging import exceptions
+
 
 def version_is_compatible(imp_version, version):
     """Determine whether versions are compatible.
@@ -59,3 +67,97 @@ class DummyLock(object):
 
     def __exit__(self, type, value, traceback):
         self.release()
+
+
+class TokenBucket(object):
+    """Token bucket refilled with `rate` tokens per second.
+
+    The bucket holds at most `burst` tokens, the number of messages which may
+    be sent at once after a period of inactivity.
+    """
+
+    def __init__(self, rate, burst):
+        self.rate = float(rate)
+        self.burst = burst
+        self._tokens = float(burst)
+        self._lock = threading.Lock()
+        self._watch = timeutils.StopWatch()
+        self._watch.start()
+
+    def consume(self):
+        """Take a token from the bucket.
+
+        :returns: 0 if a token was taken, else the number of seconds until a
+                  token is available
+        """
+        with self._lock:
+            refill = self._watch.elapsed() * self.rate
+            self._watch.restart()
+            self._tokens = min(self.burst, self._tokens + refill)
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return 0
+            return (1 - self._tokens) / self.rate
+
+    def refund(self):
+        with self._lock:
+            self._tokens = min(self.burst, self._tokens + 1)
+
+
+class RateLimiter(object):
+    """Token buckets limiting the rate of the messages sent by a client.
+
+    A message is sent once a token is taken from the bucket of each limit
+    applying to it. When a bucket is empty the caller either blocks until a
+    token is available, drops the message or gets a RateLimitExceeded.
+    """
+
+    BLOCK = 'block'
+    DROP = 'drop'
+    RAISE = 'raise'
+    ACTIONS = (BLOCK, DROP, RAISE)
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._buckets = {}
+
+    def _bucket(self, limit, rate, burst):
+        if not burst:
+            burst = max(1, int(math.ceil(rate)))
+        key = (limit, rate, burst)
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                bucket = self._buckets[key] = TokenBucket(rate, burst)
+            return bucket
+
+    def acquire(self, limits, action, burst=None):
+        """Take a token for each of the (limit, rate) pairs.
+
+        :param limits: the limits applying to the message, each a key naming
+                       the limit and its rate in messages per second
+        :type limits: list of tuples
+        :param action: what to do when a limit is exceeded
+        :type action: one of ACTIONS
+        :param burst: the size of the buckets, defaults to one second of rate
+        :type burst: int
+        :returns: False if the message must be dropped, True otherwise
+        :raises: RateLimitExceeded if action is RAISE and a limit is exceeded
+        """
+        taken = []
+        for limit, rate in limits:
+            bucket = self._bucket(limit, rate, burst)
+            wait = bucket.consume()
+            while wait and action == self.BLOCK:
+                time.sleep(wait)
+                wait = bucket.consume()
+            if wait:
+                # NOTE: the message is not sent, give back the tokens taken
+                # for the other limits
+                for other in taken:
+                    other.refund()
+                if action == self.RAISE:
+                    raise exceptions.RateLimitExceeded(limit, wait)
+                return False
+            taken.append(bucket)
+        return True
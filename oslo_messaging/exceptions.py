@@ -14,7 +14,7 @@
 #    under the License.
 
 __all__ = ['MessagingException', 'MessagingTimeout', 'MessageDeliveryFailure',
-           'InvalidTarget']
+           'InvalidTarget', 'RateLimitExceeded']
 
 import six
 
@@ -38,3 +38,14 @@ class InvalidTarget(MessagingException, ValueError):
         msg = msg + ":" + six.text_type(target)
         super(InvalidTarget, self).__init__(msg)
         self.target = target
+
+
+class RateLimitExceeded(MessagingException):
+    """Raised if sending a message would exceed a configured rate limit."""
+
+    def __init__(self, limit, retry_after):
+        msg = ('Rate limit for %(limit)s exceeded, retry in %(retry_after).3f '
+               'seconds' % dict(limit=limit, retry_after=retry_after))
+        super(RateLimitExceeded, self).__init__(msg)
+        self.limit = limit
+        self.retry_after = retry_after
@@ -24,10 +24,10 @@ from debtcollector import renames
 from oslo_config import cfg
 from oslo_utils import timeutils
 import six
-from stevedore import extension
-from stevedore import named
 
 from oslo_messaging._i18n import _LE
+from oslo_messaging import _utils as utils
+from oslo_messaging import exceptions
 from oslo_messaging import serializer as msg_serializer
 from oslo_messaging import transport as msg_transport
 
@@ -55,6 +55,28 @@ _notifier_opts = [
                                       group='DEFAULT')
                 ],
                 help='AMQP topic used for OpenStack notifications.'),
+    cfg.FloatOpt('rate_limit',
+                 default=0,
+                 min=0,
+                 help='Maximum number of notifications per second sent by a '
+                      'notifier to each of its topics. 0 means unlimited.'),
+    cfg.DictOpt('event_type_rate_limits',
+                default={},
+                help='Maximum number of notifications per second sent by a '
+                     'notifier for an event type, as a dict of event types '
+                     'to rates.'),
+    cfg.IntOpt('rate_limit_burst',
+               default=0,
+               min=0,
+               help='Number of notifications which may be sent at once above '
+                    'the rate limits after a quiet period. 0 means one '
+                    'second worth of notifications.'),
+    cfg.StrOpt('rate_limit_action',
+               default='block',
+               choices=('block', 'drop', 'raise'),
+               help='What a notifier does with a notification exceeding a '
+                    'rate limit: wait until it may be sent, drop it or raise '
+                    'RateLimitExceeded.'),
 ]
 
 _LOG = logging.getLogger(__name__)
@@ -62,6 +84,8 @@ _LOG = logging.getLogger(__name__)
 
 def _send_notification():
     """Command line tool to send notifications manually."""
+    from stevedore import extension
+
     parser = argparse.ArgumentParser(
         description='Oslo.messaging notification sending',
     )
@@ -252,6 +276,9 @@ class Notifier(object):
         self.transport = transport
         self.publisher_id = publisher_id
         self.retry = retry
+        self.rate_limit = None
+        self.rate_limit_action = None
+        self._rate_limiter = utils.RateLimiter()
 
         self._driver_names = ([driver] if driver is not None else
                               conf.oslo_messaging_notifications.driver)
@@ -264,6 +291,10 @@ class Notifier(object):
             self._topics = conf.oslo_messaging_notifications.topics
         self._serializer = serializer or msg_serializer.NoOpSerializer()
 
+        # NOTE: stevedore is imported on first use, it brings pkg_resources
+        # which dominates the import time of oslo_messaging otherwise
+        from stevedore import named
+
         self._driver_mgr = named.NamedExtensionManager(
             'oslo.messaging.notify.drivers',
             names=self._driver_names,
@@ -277,7 +308,8 @@ class Notifier(object):
 
     _marker = object()
 
-    def prepare(self, publisher_id=_marker, retry=_marker):
+    def prepare(self, publisher_id=_marker, retry=_marker,
+                rate_limit=_marker, rate_limit_action=_marker):
         """Return a specialized Notifier instance.
 
         Returns a new Notifier instance with the supplied publisher_id. Allows
@@ -293,11 +325,47 @@ class Notifier(object):
                       0 means no retry is attempted.
                       N means attempt at most N retries.
         :type retry: int
+        :param rate_limit: maximum number of notifications per second to each
+                           topic, overriding the rate_limit option. 0 means
+                           unlimited.
+        :type rate_limit: float
+        :param rate_limit_action: what to do with a notification exceeding a
+                                  rate limit, overriding the
+                                  rate_limit_action option
+        :type rate_limit_action: 'block', 'drop' or 'raise'
         """
-        return _SubNotifier._prepare(self, publisher_id, retry=retry)
+        return _SubNotifier._prepare(self, publisher_id, retry=retry,
+                                     rate_limit=rate_limit,
+                                     rate_limit_action=rate_limit_action)
+
+    def _check_rate_limit(self, event_type):
+        """Return whether the notification may be sent."""
+        conf = self.transport.conf.oslo_messaging_notifications
+        rate = self.rate_limit
+        if rate is None:
+            rate = conf.rate_limit
+        limits = []
+        if rate:
+            limits.extend(('topic %s' % topic, rate)
+                          for topic in self._topics)
+        rate = conf.event_type_rate_limits.get(event_type)
+        if rate:
+            limits.append(('event type %s' % event_type, float(rate)))
+        if not limits:
+            return True
+
+        action = self.rate_limit_action or conf.rate_limit_action
+        if self._rate_limiter.acquire(limits, action, conf.rate_limit_burst):
+            return True
+        _LOG.debug('Dropped notification %s exceeding its rate limit',
+                   event_type)
+        return False
 
     def _notify(self, ctxt, event_type, payload, priority, publisher_id=None,
                 retry=None):
+        if not self._check_rate_limit(event_type):
+            return
+
         payload = self._serializer.serialize_entity(ctxt, payload)
         ctxt = self._serializer.serialize_context(ctxt)
 
@@ -430,22 +498,38 @@ class _SubNotifier(Notifier):
 
     _marker = Notifier._marker
 
-    def __init__(self, base, publisher_id, retry):
+    def __init__(self, base, publisher_id, retry, rate_limit=None,
+                 rate_limit_action=None):
         self._base = base
         self.transport = base.transport
         self.publisher_id = publisher_id
         self.retry = retry
+        self.rate_limit = rate_limit
+        self.rate_limit_action = rate_limit_action
 
         self._serializer = self._base._serializer
         self._driver_mgr = self._base._driver_mgr
+        self._topics = self._base._topics
+        self._rate_limiter = self._base._rate_limiter
 
     def _notify(self, ctxt, event_type, payload, priority):
         super(_SubNotifier, self)._notify(ctxt, event_type, payload, priority)
 
     @classmethod
-    def _prepare(cls, base, publisher_id=_marker, retry=_marker):
+    def _prepare(cls, base, publisher_id=_marker, retry=_marker,
+                 rate_limit=_marker, rate_limit_action=_marker):
         if publisher_id is cls._marker:
             publisher_id = base.publisher_id
         if retry is cls._marker:
             retry = base.retry
-        return cls(base, publisher_id, retry=retry)
+        if rate_limit is cls._marker:
+            rate_limit = base.rate_limit
+        if rate_limit_action is cls._marker:
+            rate_limit_action = base.rate_limit_action
+        elif (rate_limit_action is not None and
+              rate_limit_action not in utils.RateLimiter.ACTIONS):
+            raise exceptions.MessagingException(
+                "rate_limit_action must be one of %s. Got %s" %
+                (', '.join(utils.RateLimiter.ACTIONS), rate_limit_action))
+        return cls(base, publisher_id, retry=retry, rate_limit=rate_limit,
+                   rate_limit_action=rate_limit_action)
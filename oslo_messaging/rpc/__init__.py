@@ -19,6 +19,7 @@ __all__ = [
     'NoSuchMethod',
     'RPCClient',
     'RPCAccessPolicyBase',
+    'RPCCircuitOpenError',
     'LegacyRPCAccessPolicy',
     'DefaultRPCAccessPolicy',
     'ExplicitRPCAccessPolicy',
@@ -18,25 +18,107 @@
 
 __all__ = [
     'ClientSendError',
+    'RPCCircuitOpenError',
     'RPCClient',
     'RPCVersionCapError',
     'RemoteError',
 ]
 
 import abc
+import collections
+import contextlib
+import copy
+import logging
+import math
+import sys
+import threading
 
 from oslo_config import cfg
+from oslo_serialization import jsonutils
+from oslo_utils import timeutils
 import six
 
 from oslo_messaging._drivers import base as driver_base
+from oslo_messaging._i18n import _LI
+from oslo_messaging._i18n import _LW
 from oslo_messaging import _utils as utils
 from oslo_messaging import exceptions
 from oslo_messaging import serializer as msg_serializer
 
+LOG = logging.getLogger(__name__)
+
 _client_opts = [
     cfg.IntOpt('rpc_response_timeout',
                default=60,
                help='Seconds to wait for a response from a call.'),
+    cfg.IntOpt('rpc_circuit_breaker_threshold',
+               default=0,
+               min=0,
+               help='Number of consecutive call timeouts to the same '
+                    'exchange, topic and server after which further calls '
+                    'fail immediately with RPCCircuitOpenError. '
+                    '0 disables the circuit breaker.'),
+    cfg.IntOpt('rpc_circuit_breaker_cooldown',
+               default=30,
+               min=0,
+               help='Seconds an open circuit breaker fails calls fast before '
+                    'letting a single probe call through to check whether '
+                    'the target has recovered.'),
+    cfg.FloatOpt('rpc_hedge_percentile',
+                 default=95.0,
+                 min=0,
+                 max=100,
+                 help='Percentile of the observed latency of a method after '
+                      'which a hedged call sends a duplicate request. Only '
+                      'applies to calls prepared with hedge=True.'),
+    cfg.FloatOpt('rpc_adaptive_timeout_multiplier',
+                 default=0,
+                 min=0,
+                 help='Derive the timeout of a call from the latency observed '
+                      'for its method: the 99.9th percentile of the latency '
+                      'times this multiplier, bounded by the timeout of the '
+                      'call or rpc_response_timeout. 0 disables adaptive '
+                      'timeouts.'),
+    cfg.FloatOpt('rpc_adaptive_timeout_minimum',
+                 default=1.0,
+                 min=0,
+                 help='Minimum seconds to wait for a response from a call '
+                      'when adaptive timeouts are enabled.'),
+    cfg.FloatOpt('rpc_coalesce_cache_ttl',
+                 default=0,
+                 min=0,
+                 help='Seconds the result of a call prepared with '
+                      'coalesce=True is reused for identical calls. 0 only '
+                      'coalesces the calls in flight at the same time.'),
+    cfg.IntOpt('rpc_coalesce_cache_size',
+               default=1000,
+               min=1,
+               help='Maximum number of results of coalesced calls cached, '
+                    'the oldest ones are evicted first.'),
+    cfg.FloatOpt('rpc_rate_limit',
+                 default=0,
+                 min=0,
+                 help='Maximum number of calls and casts per second sent by '
+                      'an RPC client to the same exchange and topic. 0 means '
+                      'unlimited.'),
+    cfg.DictOpt('rpc_method_rate_limits',
+                default={},
+                help='Maximum number of calls and casts per second sent by '
+                     'an RPC client for a method on the same exchange and '
+                     'topic, as a dict of method names to rates.'),
+    cfg.IntOpt('rpc_rate_limit_burst',
+               default=0,
+               min=0,
+               help='Number of messages which may be sent at once above the '
+                    'RPC rate limits after a quiet period. 0 means one second '
+                    'worth of messages.'),
+    cfg.StrOpt('rpc_rate_limit_action',
+               default='block',
+               choices=('block', 'drop', 'raise'),
+               help='What an RPC client does with a message exceeding a rate '
+                    'limit: wait until it may be sent, drop it or raise '
+                    'RateLimitExceeded. Calls are never dropped, they raise '
+                    'instead.'),
 ]
 
 
@@ -73,6 +155,23 @@ class RPCVersionCapError(exceptions.MessagingException):
         super(RPCVersionCapError, self).__init__(msg)
 
 
+class RPCCircuitOpenError(exceptions.MessagingTimeout):
+    """Raised instead of sending a call to a target known to be unhealthy.
+
+    The circuit breaker of a target opens when too many consecutive calls
+    to it timed out. This is a MessagingTimeout so that callers handling
+    timeouts handle it as well, without waiting for the full timeout.
+    """
+
+    def __init__(self, target, retry_after):
+        msg = ('Circuit breaker open for target "%(target)s" after repeated '
+               'timeouts, retry in %(retry_after).1f seconds' %
+               dict(target=target, retry_after=retry_after))
+        super(RPCCircuitOpenError, self).__init__(msg)
+        self.target = target
+        self.retry_after = retry_after
+
+
 class ClientSendError(exceptions.MessagingException):
     """Raised if we failed to send a message to a target."""
 
@@ -83,13 +182,300 @@ class ClientSendError(exceptions.MessagingException):
         self.ex = ex
 
 
+class _CircuitBreaker(object):
+    """Circuit breaker for the calls sent to a single target.
+
+    The breaker is closed while calls complete. It opens after `threshold`
+    consecutive timeouts and then rejects calls for `cooldown` seconds. Once
+    the cooldown has elapsed the breaker is half-open: a single probe call is
+    let through, its success closes the breaker and its timeout opens it
+    again for another cooldown period.
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, target, threshold, cooldown):
+        self._target = target
+        self._threshold = threshold
+        self._cooldown = cooldown
+        self._lock = threading.Lock()
+        self._watch = None
+        self._probing = False
+        self.state = self.CLOSED
+        self.failures = 0
+        self.rejected = 0
+        self.transitions = collections.Counter()
+
+    def _transition(self, state):
+        self.transitions[state] += 1
+        self.state = state
+        if state == self.OPEN:
+            self._watch = timeutils.StopWatch(duration=self._cooldown)
+            self._watch.start()
+            LOG.warning(_LW('Circuit breaker opened for target %(target)s '
+                            'after %(failures)d consecutive timeouts'),
+                        {'target': self._target, 'failures': self.failures})
+        else:
+            LOG.info(_LI('Circuit breaker %(state)s for target %(target)s'),
+                     {'target': self._target, 'state': state})
+
+    def acquire(self):
+        with self._lock:
+            if self.state == self.OPEN and self._watch.expired():
+                self._transition(self.HALF_OPEN)
+            if self.state == self.OPEN or (self.state == self.HALF_OPEN and
+                                           self._probing):
+                self.rejected += 1
+                retry_after = (self._watch.leftover()
+                               if self.state == self.OPEN else 0)
+                raise RPCCircuitOpenError(self._target, retry_after)
+            if self.state == self.HALF_OPEN:
+                self._probing = True
+
+    def release(self, timed_out):
+        with self._lock:
+            self._probing = False
+            if not timed_out:
+                self.failures = 0
+                if self.state != self.CLOSED:
+                    self._transition(self.CLOSED)
+                return
+            self.failures += 1
+            if (self.state == self.HALF_OPEN or
+                    (self.state == self.CLOSED and
+                     self.failures >= self._threshold)):
+                self._transition(self.OPEN)
+
+    def stats(self):
+        with self._lock:
+            return dict(state=self.state,
+                        failures=self.failures,
+                        rejected=self.rejected,
+                        transitions=dict(self.transitions))
+
+
+class _CircuitBreakers(object):
+    """Circuit breakers of an RPC client keyed by (exchange, topic, server).
+    """
+
+    def __init__(self, conf):
+        self._threshold = conf.rpc_circuit_breaker_threshold
+        self._cooldown = conf.rpc_circuit_breaker_cooldown
+        self._lock = threading.Lock()
+        self._breakers = {}
+
+    @contextlib.contextmanager
+    def guard(self, target):
+        if not self._threshold:
+            yield
+            return
+
+        key = (target.exchange, target.topic, target.server)
+        with self._lock:
+            breaker = self._breakers.get(key)
+            if breaker is None:
+                breaker = _CircuitBreaker(target, self._threshold,
+                                          self._cooldown)
+                self._breakers[key] = breaker
+
+        breaker.acquire()
+        try:
+            yield
+        except exceptions.MessagingTimeout:
+            breaker.release(timed_out=True)
+            raise
+        except Exception:
+            # NOTE: any other outcome, including a remote error, proves the
+            # target answers in time
+            breaker.release(timed_out=False)
+            raise
+        else:
+            breaker.release(timed_out=False)
+
+    def stats(self):
+        with self._lock:
+            breakers = list(self._breakers.items())
+        return dict((key, breaker.stats()) for key, breaker in breakers)
+
+
+class _LatencyHistogram(object):
+    """Histogram of call latencies with logarithmically sized buckets.
+
+    Bucket boundaries grow by 10% so percentiles are estimated to within 10%
+    whatever the latency range, in constant memory. Counts are halved every
+    `decay` samples so that the histogram follows the recent latencies.
+    """
+
+    _BASE = 0.001
+    _FACTOR = 1.1
+    _BUCKETS = 160
+
+    def __init__(self, decay=2000):
+        self._decay = decay
+        self._counts = [0] * self._BUCKETS
+        self._recorded = 0
+        self.count = 0
+
+    def _bucket(self, latency):
+        if latency <= self._BASE:
+            return 0
+        bucket = int(math.ceil(math.log(latency / self._BASE, self._FACTOR)))
+        return min(bucket, self._BUCKETS - 1)
+
+    def record(self, latency):
+        self._counts[self._bucket(latency)] += 1
+        self.count += 1
+        self._recorded += 1
+        if self._recorded >= self._decay:
+            self._counts = [c // 2 for c in self._counts]
+            self.count = sum(self._counts)
+            self._recorded = 0
+
+    def percentile(self, percent):
+        """Return the upper bound of the bucket holding the percentile."""
+        if not self.count:
+            return None
+        threshold = self.count * percent / 100.0
+        seen = 0
+        for bucket, count in enumerate(self._counts):
+            seen += count
+            if count and seen >= threshold:
+                break
+        return self._BASE * self._FACTOR ** bucket
+
+
+class _LatencyTracker(object):
+    """Latency histograms of an RPC client keyed by (exchange, topic, method).
+    """
+
+    # NOTE: a percentile computed from fewer samples is meaningless
+    min_samples = 20
+    # NOTE: the tail of the latency needs more samples to be estimated
+    min_tail_samples = 100
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._histograms = {}
+
+    def record(self, key, latency):
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = _LatencyHistogram()
+                self._histograms[key] = histogram
+            histogram.record(latency)
+
+    def percentile(self, key, percent, min_samples=None):
+        if min_samples is None:
+            min_samples = self.min_samples
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None or histogram.count < min_samples:
+                return None
+            return histogram.percentile(percent)
+
+
+class _InFlightCall(object):
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.exc_info = None
+        self.followers = 0
+
+
+class _CallCoalescer(object):
+    """Coalesces identical calls of an RPC client into a single request.
+
+    The first caller sends the request while the callers issuing an identical
+    call in the meantime wait for its outcome, for at most their own timeout.
+    Results may also be cached for `ttl` seconds, in which case at most `size`
+    of them are kept. As all results live for the same duration, evicting the
+    oldest entry first evicts the expired ones first. Every caller gets a copy
+    of a shared result, so that none of them sees the changes of the others.
+    """
+
+    def __init__(self, conf):
+        self._ttl = conf.rpc_coalesce_cache_ttl
+        self._size = conf.rpc_coalesce_cache_size
+        self._lock = threading.Lock()
+        self._in_flight = {}
+        self._cache = collections.OrderedDict()
+
+    def _cached(self, key):
+        while self._cache:
+            oldest = next(iter(self._cache))
+            if not self._cache[oldest][0].expired():
+                break
+            del self._cache[oldest]
+        entry = self._cache.get(key)
+        return ((True, copy.deepcopy(entry[1])) if entry is not None
+                else (False, None))
+
+    def _cache_result(self, key, result):
+        watch = timeutils.StopWatch(duration=self._ttl)
+        watch.start()
+        with self._lock:
+            self._cache.pop(key, None)
+            self._cache[key] = (watch, result)
+            while len(self._cache) > self._size:
+                self._cache.popitem(last=False)
+
+    def call(self, key, send, timeout=None):
+        with self._lock:
+            cached, result = self._cached(key)
+            if cached:
+                return result
+            call = self._in_flight.get(key)
+            leader = call is None
+            if leader:
+                call = self._in_flight[key] = _InFlightCall()
+            else:
+                call.followers += 1
+
+        if not leader:
+            if not call.done.wait(timeout):
+                raise exceptions.MessagingTimeout(
+                    'Timed out waiting for the reply of a coalesced call')
+            if call.exc_info is not None:
+                six.reraise(*call.exc_info)
+            return copy.deepcopy(call.result)
+
+        try:
+            call.result = send()
+        except Exception:
+            call.exc_info = sys.exc_info()
+            raise
+        else:
+            if self._ttl:
+                self._cache_result(key, call.result)
+        finally:
+            with self._lock:
+                del self._in_flight[key]
+                shared = call.followers or self._ttl
+            call.done.set()
+        # NOTE: the result kept for the followers and the cache must not be
+        # changed by the leader
+        return copy.deepcopy(call.result) if shared else call.result
+
+
+@contextlib.contextmanager
+def _null_context():
+    yield
+
+
 @six.add_metaclass(abc.ABCMeta)
 class _BaseCallContext(object):
 
     _marker = object()
 
     def __init__(self, transport, target, serializer,
-                 timeout=None, version_cap=None, retry=None):
+                 timeout=None, version_cap=None, retry=None,
+                 circuit_breakers=None, hedge=False, latencies=None,
+                 coalesce=False, call_coalescer=None,
+                 rate_limit=None, rate_limit_action=None, rate_limiter=None,
+                 priority=None):
         self.conf = transport.conf
 
         self.transport = transport
@@ -98,6 +484,15 @@ class _BaseCallContext(object):
         self.timeout = timeout
         self.retry = retry
         self.version_cap = version_cap
+        self.circuit_breakers = circuit_breakers
+        self.hedge = hedge
+        self.latencies = latencies
+        self.coalesce = coalesce
+        self.call_coalescer = call_coalescer
+        self.rate_limit = rate_limit
+        self.rate_limit_action = rate_limit_action
+        self.rate_limiter = rate_limiter
+        self.priority = priority
 
         super(_BaseCallContext, self).__init__()
 
@@ -112,6 +507,8 @@ class _BaseCallContext(object):
             msg['namespace'] = self.target.namespace
         if self.target.version is not None:
             msg['version'] = self.target.version
+        if self.priority is not None:
+            msg['priority'] = self.priority
 
         return msg
 
@@ -136,6 +533,43 @@ class _BaseCallContext(object):
                     "Version must contain a major and minor integer. Got %s"
                     % version)
 
+    @classmethod
+    def _check_priority(cls, priority):
+        if priority is not cls._marker and priority is not None:
+            if (not isinstance(priority, six.integer_types) or
+                    isinstance(priority, bool) or
+                    not 0 <= priority <= 255):
+                raise exceptions.MessagingException(
+                    "Priority must be an integer between 0 and 255. Got %s"
+                    % priority)
+
+    def _check_rate_limit(self, method, call):
+        """Return whether the message may be sent."""
+        exchange, topic = self.target.exchange, self.target.topic
+        limits = []
+        rate = self.rate_limit
+        if rate is None:
+            rate = self.conf.rpc_rate_limit
+        if rate:
+            limits.append(('exchange %s topic %s' % (exchange, topic), rate))
+        rate = self.conf.rpc_method_rate_limits.get(method)
+        if rate:
+            limits.append(('exchange %s topic %s method %s' %
+                           (exchange, topic, method), float(rate)))
+        if not limits or self.rate_limiter is None:
+            return True
+
+        action = self.rate_limit_action or self.conf.rpc_rate_limit_action
+        if call and action == utils.RateLimiter.DROP:
+            # NOTE: a call has no result to return when dropped
+            action = utils.RateLimiter.RAISE
+        if self.rate_limiter.acquire(limits, action,
+                                     self.conf.rpc_rate_limit_burst):
+            return True
+        LOG.debug('Dropped cast of %(method)s to %(target)s exceeding its '
+                  'rate limit', {'method': method, 'target': self.target})
+        return False
+
     def cast(self, ctxt, method, **kwargs):
         """Invoke a method and return immediately. See RPCClient.cast()."""
         msg = self._make_message(ctxt, method, kwargs)
@@ -143,6 +577,9 @@ class _BaseCallContext(object):
 
         self._check_version_cap(msg.get('version'))
 
+        if not self._check_rate_limit(method, call=False):
+            return
+
         try:
             self.transport._send(self.target, msg_ctxt, msg, retry=self.retry)
         except driver_base.TransportDriverError as ex:
@@ -163,19 +600,131 @@ class _BaseCallContext(object):
 
         self._check_version_cap(msg.get('version'))
 
+        self._check_rate_limit(method, call=True)
+
+        key = (self.target.exchange, self.target.topic, method)
+        adaptive = self.conf.rpc_adaptive_timeout_multiplier > 0
+        if adaptive:
+            timeout = self._adaptive_timeout(key, timeout)
+
+        def send():
+            with self._circuit_breaker():
+                if self.hedge or adaptive:
+                    with self._track_latency(key):
+                        return self._send_call(key, msg_ctxt, msg, timeout)
+                return self.transport._send(self.target, msg_ctxt, msg,
+                                            wait_for_reply=True,
+                                            timeout=timeout,
+                                            retry=self.retry)
+
         try:
-            result = self.transport._send(self.target, msg_ctxt, msg,
-                                          wait_for_reply=True, timeout=timeout,
-                                          retry=self.retry)
+            if self.coalesce:
+                result = self.call_coalescer.call(
+                    self._coalesce_key(msg_ctxt, msg), send, timeout)
+            else:
+                result = send()
         except driver_base.TransportDriverError as ex:
             raise ClientSendError(self.target, ex)
 
         return self.serializer.deserialize_entity(ctxt, result)
 
+    def _coalesce_key(self, msg_ctxt, msg):
+        # NOTE: the calls of distinct users or projects must not share their
+        # results, the request context is part of the key
+        ctxt_key = (self.coalesce(msg_ctxt) if callable(self.coalesce)
+                    else msg_ctxt)
+        return (self.target.exchange, self.target.topic, self.target.server,
+                jsonutils.dumps(ctxt_key, sort_keys=True),
+                jsonutils.dumps(msg, sort_keys=True))
+
+    def _adaptive_timeout(self, key, timeout):
+        latency = self.latencies.percentile(
+            key, 99.9, min_samples=self.latencies.min_tail_samples)
+        if latency is None:
+            return timeout
+        adaptive_timeout = max(
+            latency * self.conf.rpc_adaptive_timeout_multiplier,
+            self.conf.rpc_adaptive_timeout_minimum)
+        if timeout is None:
+            return adaptive_timeout
+        return min(adaptive_timeout, timeout)
+
+    @contextlib.contextmanager
+    def _track_latency(self, key):
+        # NOTE: the latency of calls timing out is recorded as well, this is
+        # what lets adaptive timeouts grow when the method slows down
+        watch = timeutils.StopWatch()
+        watch.start()
+        try:
+            yield
+        finally:
+            self.latencies.record(key, watch.elapsed())
+
+    def _send_call(self, key, msg_ctxt, msg, timeout):
+        delay = None
+        # NOTE: the duplicate of a request to a single server would only
+        # queue up behind the original one
+        if self.hedge and not (self.target.server or self.target.fanout):
+            delay = self.latencies.percentile(key,
+                                              self.conf.rpc_hedge_percentile)
+
+        if delay is None or (timeout and delay >= timeout):
+            return self.transport._send(self.target, msg_ctxt, msg,
+                                        wait_for_reply=True,
+                                        timeout=timeout,
+                                        retry=self.retry)
+        return self.transport._send_hedged(self.target, msg_ctxt, msg,
+                                           delay, timeout=timeout,
+                                           retry=self.retry)
+
+    def _circuit_breaker(self):
+        if self.circuit_breakers is None:
+            return _null_context()
+        return self.circuit_breakers.guard(self.target)
+
+    def call_stream(self, ctxt, method, **kwargs):
+        """Invoke a method and iterate over its reply. See
+        RPCClient.call_stream().
+        """
+        if self.target.fanout:
+            raise exceptions.InvalidTarget('A call cannot be used with fanout',
+                                           self.target)
+
+        msg = self._make_message(ctxt, method, kwargs)
+        msg_ctxt = self.serializer.serialize_context(ctxt)
+
+        timeout = self.timeout
+        if self.timeout is None:
+            timeout = self.conf.rpc_response_timeout
+
+        self._check_version_cap(msg.get('version'))
+
+        self._check_rate_limit(method, call=True)
+
+        try:
+            replies = self.transport._send_stream(self.target, msg_ctxt, msg,
+                                                  timeout=timeout,
+                                                  retry=self.retry)
+        except driver_base.TransportDriverError as ex:
+            raise ClientSendError(self.target, ex)
+
+        def deserialize():
+            try:
+                for reply in replies:
+                    yield self.serializer.deserialize_entity(ctxt, reply)
+            finally:
+                # NOTE: closing the stream before its end cancels it
+                close = getattr(replies, 'close', None)
+                if close is not None:
+                    close()
+        return deserialize()
+
     @abc.abstractmethod
     def prepare(self, exchange=_marker, topic=_marker, namespace=_marker,
                 version=_marker, server=_marker, fanout=_marker,
-                timeout=_marker, version_cap=_marker, retry=_marker):
+                timeout=_marker, version_cap=_marker, retry=_marker,
+                hedge=_marker, coalesce=_marker, rate_limit=_marker,
+                rate_limit_action=_marker, priority=_marker):
         """Prepare a method invocation context. See RPCClient.prepare()."""
 
 
@@ -187,8 +736,11 @@ class _CallContext(_BaseCallContext):
     def _prepare(cls, call_context,
                  exchange=_marker, topic=_marker, namespace=_marker,
                  version=_marker, server=_marker, fanout=_marker,
-                 timeout=_marker, version_cap=_marker, retry=_marker):
+                 timeout=_marker, version_cap=_marker, retry=_marker,
+                 hedge=_marker, coalesce=_marker, rate_limit=_marker,
+                 rate_limit_action=_marker, priority=_marker):
         cls._check_version(version)
+        cls._check_priority(priority)
         kwargs = dict(
             exchange=exchange,
             topic=topic,
@@ -206,18 +758,42 @@ class _CallContext(_BaseCallContext):
             version_cap = call_context.version_cap
         if retry is cls._marker:
             retry = call_context.retry
+        if hedge is cls._marker:
+            hedge = call_context.hedge
+        if coalesce is cls._marker:
+            coalesce = call_context.coalesce
+        if rate_limit is cls._marker:
+            rate_limit = call_context.rate_limit
+        if priority is cls._marker:
+            priority = call_context.priority
+        if rate_limit_action is cls._marker:
+            rate_limit_action = call_context.rate_limit_action
+        elif (rate_limit_action is not None and
+              rate_limit_action not in utils.RateLimiter.ACTIONS):
+            raise exceptions.MessagingException(
+                "rate_limit_action must be one of %s. Got %s" %
+                (', '.join(utils.RateLimiter.ACTIONS), rate_limit_action))
 
         return _CallContext(call_context.transport, target,
                             call_context.serializer,
-                            timeout, version_cap, retry)
+                            timeout, version_cap, retry,
+                            call_context.circuit_breakers,
+                            hedge, call_context.latencies,
+                            coalesce, call_context.call_coalescer,
+                            rate_limit, rate_limit_action,
+                            call_context.rate_limiter, priority)
 
     def prepare(self, exchange=_marker, topic=_marker, namespace=_marker,
                 version=_marker, server=_marker, fanout=_marker,
-                timeout=_marker, version_cap=_marker, retry=_marker):
+                timeout=_marker, version_cap=_marker, retry=_marker,
+                hedge=_marker, coalesce=_marker, rate_limit=_marker,
+                rate_limit_action=_marker, priority=_marker):
         return _CallContext._prepare(self,
                                      exchange, topic, namespace,
                                      version, server, fanout,
-                                     timeout, version_cap, retry)
+                                     timeout, version_cap, retry, hedge,
+                                     coalesce, rate_limit, rate_limit_action,
+                                     priority)
 
 
 class RPCClient(_BaseCallContext):
@@ -304,6 +880,76 @@ class RPCClient(_BaseCallContext):
             client.prepare(retry=0).cast(ctxt, 'ping')
         except messaging.MessageDeliveryFailure:
             LOG.error("Failed to send ping message")
+
+    When no server consumes a target anymore every call() to it waits for
+    the whole timeout. Setting the rpc_circuit_breaker_threshold option makes
+    the client fail calls to a target immediately with a RPCCircuitOpenError,
+    a MessagingTimeout, once that many consecutive calls to it timed out.
+    After rpc_circuit_breaker_cooldown seconds a single probe call is let
+    through, and the target is considered healthy again when it succeeds.
+    The state of the breakers is returned by get_circuit_breaker_stats().
+
+    A few slow replies can dominate the latency of a service fanning out many
+    calls. Calls prepared with hedge=True send a duplicate request when no
+    reply arrived within the rpc_hedge_percentile of the latency observed for
+    the method, and return whichever reply comes first; the other reply is
+    discarded. As the method may then be invoked twice this must only be used
+    for idempotent methods::
+
+        cctxt = self._client.prepare(hedge=True)
+        return cctxt.call(ctxt, 'get_status', instance=instance)
+
+    Drivers unable to discard the late reply send a single request, and so
+    are calls to a given server, whose duplicate would wait behind the
+    original request.
+
+    A single rpc_response_timeout is either too long to detect a hung call
+    to a fast method quickly or too short for a slow method. Setting the
+    rpc_adaptive_timeout_multiplier option derives the timeout of each call
+    from the 99.9th percentile of the latency observed for its method times
+    this multiplier, never less than rpc_adaptive_timeout_minimum and never
+    more than the timeout otherwise applied to the call.
+
+    Many workers often issue the very same call at the same time, for example
+    to look up a list of services. Calls prepared with coalesce=True are
+    coalesced: while a call is in flight, identical calls (same target,
+    method, arguments, version and request context) wait for its reply, for
+    at most their own timeout, rather than sending their own request, and
+    each of them returns a copy of the same result::
+
+        def service_get_all(self, ctxt):
+            cctxt = self._client.prepare(coalesce=True)
+            return cctxt.call(ctxt, 'service_get_all')
+
+    As the serialized request contexts must be equal, calls whose context
+    carries a per request identifier are never coalesced. coalesce may then
+    be a function of the serialized context returning what the calls sharing
+    a result must have in common instead, for instance::
+
+        cctxt = self._client.prepare(
+            coalesce=lambda ctxt: (ctxt['user'], ctxt['tenant']))
+
+    Setting the rpc_coalesce_cache_ttl option also reuses the result of a
+    coalesced call for that many seconds.
+
+    The rate of the calls and casts sent by a client can be limited per
+    exchange and topic with the rpc_rate_limit option or the rate_limit
+    parameter of prepare(), and per method with rpc_method_rate_limits. A
+    message exceeding a limit blocks until it may be sent, is dropped or
+    raises RateLimitExceeded depending on the rpc_rate_limit_action option or
+    the rate_limit_action parameter of prepare()::
+
+        cctxt = self._client.prepare(rate_limit=10, rate_limit_action='drop')
+        cctxt.cast(ctxt, 'report_state', state=state)
+
+    Urgent requests should not wait behind a backlog of bulk ones. Messages
+    prepared with a priority are handled before the lower priority messages
+    waiting on the server, and drivers supporting it also let them overtake
+    the messages queued on the broker (see the rabbit_max_priority option of
+    the rabbit driver)::
+
+        cctxt = self._client.prepare(priority=5)
+        cctxt.cast(ctxt, 'terminate_instance', instance=instance)
     """
 
     _marker = _BaseCallContext._marker
@@ -331,15 +977,20 @@ class RPCClient(_BaseCallContext):
         if serializer is None:
             serializer = msg_serializer.NoOpSerializer()
 
+        transport.conf.register_opts(_client_opts)
+
         super(RPCClient, self).__init__(
-            transport, target, serializer, timeout, version_cap, retry
+            transport, target, serializer, timeout, version_cap, retry,
+            _CircuitBreakers(transport.conf), latencies=_LatencyTracker(),
+            call_coalescer=_CallCoalescer(transport.conf),
+            rate_limiter=utils.RateLimiter()
         )
 
-        self.conf.register_opts(_client_opts)
-
     def prepare(self, exchange=_marker, topic=_marker, namespace=_marker,
                 version=_marker, server=_marker, fanout=_marker,
-                timeout=_marker, version_cap=_marker, retry=_marker):
+                timeout=_marker, version_cap=_marker, retry=_marker,
+                hedge=_marker, coalesce=_marker, rate_limit=_marker,
+                rate_limit_action=_marker, priority=_marker):
         """Prepare a method invocation context.
 
         Use this method to override client properties for an individual method
@@ -370,11 +1021,39 @@ class RPCClient(_BaseCallContext):
                       0 means no retry is attempted.
                       N means attempt at most N retries.
         :type retry: int
+        :param hedge: send a duplicate of a call() request when no reply
+                      arrived within the rpc_hedge_percentile of the latency
+                      of the method, and return the first reply. The
+                      methods called must be idempotent. Calls to a given
+                      server are never hedged.
+        :type hedge: bool
+        :param coalesce: share a single request between the identical call()s
+                         issued while it is in flight, and cache its result
+                         for rpc_coalesce_cache_ttl seconds. The methods
+                         called must be idempotent. The calls must have equal
+                         serialized request contexts, or, when coalesce is a
+                         function of the serialized context, equal values of
+                         that function.
+        :type coalesce: bool or callable
+        :param rate_limit: maximum number of calls and casts per second to the
+                           exchange and topic, overriding rpc_rate_limit.
+                           0 means unlimited.
+        :type rate_limit: float
+        :param rate_limit_action: what to do with a message exceeding a rate
+                                  limit, overriding rpc_rate_limit_action
+        :type rate_limit_action: 'block', 'drop' or 'raise'
+        :param priority: priority of the messages, from 0 to 255, higher
+                         priority messages are handled before the lower
+                         priority ones waiting on the server. None sends
+                         messages without priority, handled as priority 0.
+        :type priority: int
         """
         return _CallContext._prepare(self,
                                      exchange, topic, namespace,
                                      version, server, fanout,
-                                     timeout, version_cap, retry)
+                                     timeout, version_cap, retry, hedge,
+                                     coalesce, rate_limit, rate_limit_action,
+                                     priority)
 
     def cast(self, ctxt, method, **kwargs):
         """Invoke a method without blocking for a return value.
@@ -464,6 +1143,67 @@ class RPCClient(_BaseCallContext):
         """
         return self.prepare().call(ctxt, method, **kwargs)
 
+    def call_stream(self, ctxt, method, **kwargs):
+        """Invoke a method and iterate over its reply as it arrives.
+
+        call_stream() is the streaming counterpart of call(). It is intended
+        for methods returning large result sets: the remote endpoint method
+        may be a generator, in which case every item it yields is sent back
+        in its own reply message. The returned iterator produces the items
+        as they arrive::
+
+            class TestEndpoint(object):
+                def list_rows(self, ctxt):
+                    for row in db.query_rows():
+                        yield row
+
+            for row in client.call_stream(ctxt, 'list_rows'):
+                process(row)
+
+        If the endpoint method returns a list rather than a generator, or the
+        transport driver does not support streamed replies, the complete
+        reply is received first and its items are then produced by the
+        iterator. Any other result than a list or None, a string or a dict
+        for instance, is produced as a single item.
+
+        Drivers with flow control, such as rabbit (see its
+        amqp_stream_window option), hold the server back once it is a window
+        of items ahead of the caller, so neither of them has to hold the
+        complete result in memory. Other drivers may receive the whole
+        result before the caller consumes it. Closing the iterator before
+        its end cancels the stream: the server stops generating the items.
+
+        The timeout applies to each item rather than to the call as a whole:
+        MessagingTimeout is raised by the iterator if no item arrives within
+        the timeout. Exceptions raised by the remote endpoint method, even
+        after some items have been produced, are re-raised by the iterator
+        following the same rules as call().
+
+        :param ctxt: a request context dict
+        :type ctxt: dict
+        :param method: the method name
+        :type method: str
+        :param kwargs: a dict of method arguments
+        :type kwargs: dict
+        :raises: MessagingTimeout, RemoteError, MessageDeliveryFailure
+        """
+        return self.prepare().call_stream(ctxt, method, **kwargs)
+
     def can_send_version(self, version=_marker):
         """Check to see if a version is compatible with the version cap."""
         return self.prepare(version=version).can_send_version()
+
+    def get_circuit_breaker_stats(self):
+        """Return the state of the circuit breakers of this client.
+
+        A circuit breaker is tracked for each (exchange, topic, server) tuple
+        this client sent calls to once the breaker is enabled with the
+        rpc_circuit_breaker_threshold option. For each of them a dict is
+        returned with the current 'state' ('closed', 'open' or 'half-open'),
+        the number of consecutive 'failures', the number of calls 'rejected'
+        while the breaker was open and the number of 'transitions' to each
+        state.
+
+        :returns: a dict of stats dicts keyed by (exchange, topic, server)
+        """
+        return self.circuit_breakers.stats()
@@ -30,6 +30,7 @@ __all__ = [
 
 from abc import ABCMeta
 from abc import abstractmethod
+import inspect
 import sys
 
 import six
@@ -190,6 +191,11 @@ class RPCDispatcher(dispatcher.DispatcherBase):
             new_args[argname] = self.serializer.deserialize_entity(ctxt, arg)
         func = getattr(endpoint, method)
         result = func(ctxt, **new_args)
+        if inspect.isgenerator(result):
+            # NOTE: streamed replies are serialized item by item as the
+            # server consumes the generator
+            return (self.serializer.serialize_entity(ctxt, item)
+                    for item in result)
         return self.serializer.serialize_entity(ctxt, result)
 
     def dispatch(self, incoming):
@@ -124,6 +124,7 @@ __all__ = [
     'expose'
 ]
 
+import inspect
 import logging
 import sys
 
@@ -142,6 +143,9 @@ class RPCServer(msg_server.MessageHandlingServer):
     def _create_listener(self):
         return self.transport._listen(self._target, 1, None)
 
+    def _get_priority(self, incoming):
+        return incoming[0].message.get('priority') or 0
+
     def _process_incoming(self, incoming):
         message = incoming[0]
         try:
@@ -153,6 +157,12 @@ class RPCServer(msg_server.MessageHandlingServer):
         failure = None
         try:
             res = self.dispatcher.dispatch(message)
+            if inspect.isgenerator(res):
+                # NOTE: the endpoint produces its result incrementally, let
+                # the driver send the items back as they are generated.
+                # Any failure raised by the generator is reported below.
+                message.reply_stream(res)
+                return
         except rpc_dispatcher.ExpectedException as e:
             failure = e.exc_info
             LOG.debug(u'Expected exception during message handling (%s)', e)
@@ -211,11 +221,23 @@ def expected_exceptions(*exceptions):
     Note that this will cause listed exceptions to be wrapped in an
     ExpectedException, which is used internally by the RPC sever. The RPC
     client will see the original exception type.
+
+    The exceptions raised by an endpoint method which is a generator, while
+    its items are being generated, are handled alike.
     """
+    def expected_in_stream(replies):
+        try:
+            for reply in replies:
+                yield reply
+        except exceptions:
+            raise rpc_dispatcher.ExpectedException()
+        finally:
+            replies.close()
+
     def outer(func):
         def inner(*args, **kwargs):
             try:
-                return func(*args, **kwargs)
+                result = func(*args, **kwargs)
             # Take advantage of the fact that we can catch
             # multiple exception types using a tuple of
             # exception classes, with subclass detection
@@ -224,6 +246,9 @@ def expected_exceptions(*exceptions):
             # ignored and thrown as normal.
             except exceptions:
                 raise rpc_dispatcher.ExpectedException()
+            if inspect.isgenerator(result):
+                return expected_in_stream(result)
+            return result
         return inner
     return outer
 
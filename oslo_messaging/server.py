@@ -25,7 +25,9 @@ __all__ = [
 
 import abc
 import functools
+import heapq
 import inspect
+import itertools
 import logging
 import threading
 import traceback
@@ -35,7 +37,6 @@ from oslo_service import service
 from oslo_utils import eventletutils
 from oslo_utils import timeutils
 import six
-from stevedore import driver
 
 from oslo_messaging._drivers import base as driver_base
 from oslo_messaging._i18n import _LW, _LI
@@ -70,6 +71,29 @@ class ExecutorLoadFailure(MessagingServerError):
         self.ex = ex
 
 
+# Executor classes resolved from their entry point, by executor name
+_executor_classes = {}
+_executor_classes_lock = threading.Lock()
+
+
+def _get_executor_cls(executor_type):
+    with _executor_classes_lock:
+        executor_cls = _executor_classes.get(executor_type)
+        if executor_cls is None:
+            # NOTE: stevedore is imported on first use, it brings
+            # pkg_resources which dominates the import time of
+            # oslo_messaging otherwise
+            from stevedore import driver
+
+            try:
+                mgr = driver.DriverManager('oslo.messaging.executors',
+                                           executor_type)
+            except RuntimeError as ex:
+                raise ExecutorLoadFailure(executor_type, ex)
+            executor_cls = _executor_classes[executor_type] = mgr.driver
+        return executor_cls
+
+
 class ServerListenError(MessagingServerError):
     """Raised if we failed to listen on a target."""
 
@@ -296,6 +320,34 @@ def ordered(after=None, reset_after=None):
     return _ordered
 
 
+class _PriorityWorkQueue(object):
+    """Incoming requests waiting for a worker, highest priority first.
+
+    A task is submitted to the executor for each request put in the queue,
+    and a task handles whichever request has the highest priority when it
+    runs. Requests thus overtake the lower priority ones still waiting in the
+    executor, whatever the executor. Requests of the same priority are
+    handled in the order they arrived.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._heap = []
+        self._counter = itertools.count()
+
+    def put(self, priority, incoming):
+        with self._lock:
+            heapq.heappush(self._heap,
+                           (-priority, next(self._counter), incoming))
+
+    def get(self):
+        with self._lock:
+            return heapq.heappop(self._heap)[2]
+
+    def __len__(self):
+        return len(self._heap)
+
+
 @six.add_metaclass(abc.ABCMeta)
 class MessageHandlingServer(service.ServiceBase, _OrderedTaskRunner):
     """Server for handling messages.
@@ -342,15 +394,10 @@ class MessageHandlingServer(service.ServiceBase, _OrderedTaskRunner):
 
         self.listener = None
 
-        try:
-            mgr = driver.DriverManager('oslo.messaging.executors',
-                                       self.executor_type)
-        except RuntimeError as ex:
-            raise ExecutorLoadFailure(self.executor_type, ex)
-
-        self._executor_cls = mgr.driver
+        self._executor_cls = _get_executor_cls(self.executor_type)
 
         self._work_executor = None
+        self._work_queue = _PriorityWorkQueue()
 
         self._started = False
 
@@ -361,7 +408,18 @@ class MessageHandlingServer(service.ServiceBase, _OrderedTaskRunner):
 
         :param incoming: incoming request.
         """
-        self._work_executor.submit(self._process_incoming, incoming)
+        self._work_queue.put(self._get_priority(incoming), incoming)
+        self._work_executor.submit(self._process_next)
+
+    def _process_next(self):
+        self._process_incoming(self._work_queue.get())
+
+    def _get_priority(self, incoming):
+        """Return the priority of an incoming request, higher goes first.
+
+        :param incoming: incoming request.
+        """
+        return 0
 
     @abc.abstractmethod
     def _process_incoming(self, incoming):
@@ -12,6 +12,7 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 
+import datetime
 import logging
 import os
 import select
@@ -23,6 +24,7 @@ import threading
 import time
 import uuid
 
+import mock
 from oslo_utils import importutils
 from six import moves
 from string import Template
@@ -42,6 +44,7 @@ if pyngus:
         import LegacyAddresser
     from oslo_messaging._drivers.amqp1_driver.addressing \
         import RoutableAddresser
+    from oslo_messaging._drivers.amqp1_driver import eventloop
     import oslo_messaging._drivers.impl_amqp1 as amqp_driver
 
 # The Cyrus-based SASL tests can only be run if the installed version of proton
@@ -120,6 +123,96 @@ class TestProtonDriverLoad(test_utils.BaseTestCase):
                               amqp_driver.ProtonDriver)
 
 
+@testtools.skipUnless(pyngus, "proton modules not present")
+class TestScheduler(test_utils.BaseTestCase):
+
+    def setUp(self):
+        super(TestScheduler, self).setUp()
+        self.now = 1000.5
+        patcher = mock.patch.object(eventloop, 'now',
+                                    side_effect=lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.scheduler = eventloop.Scheduler()
+        self.fired = []
+
+    def _alarm(self, deadline):
+        return self.scheduler.alarm(lambda: self.fired.append(deadline),
+                                    deadline)
+
+    def _advance(self, seconds):
+        self.now += seconds
+        self.scheduler._process()
+
+    def test_empty(self):
+        self.assertIsNone(self.scheduler._next_deadline)
+        self.assertEqual(5, self.scheduler._get_delay(max_delay=5))
+        self._advance(100000)
+        self.assertEqual([], self.fired)
+
+    def test_alarm_order(self):
+        deadlines = [1001, 1003, 1002, 1063, 1064, 1065, 1200, 6000,
+                     300000, 20000000]
+        for deadline in deadlines:
+            self._alarm(deadline)
+        self.assertEqual(1001, self.scheduler._next_deadline)
+        # each alarm fires once its deadline is reached, never before
+        while self.now < 20000001:
+            due = [d for d in sorted(deadlines) if d <= self.now]
+            self.assertEqual(due, self.fired)
+            self._advance(0.75 if self.now < 1300 else
+                          997 if self.now < 400000 else 99991)
+        self.assertEqual(sorted(deadlines), self.fired)
+        self.assertIsNone(self.scheduler._next_deadline)
+
+    def test_next_deadline(self):
+        self._alarm(1010)
+        self.assertEqual(1010, self.scheduler._next_deadline)
+        self.assertEqual(9.5, self.scheduler._get_delay())
+        self.assertEqual(2, self.scheduler._get_delay(max_delay=2))
+        self._advance(10)
+        self.assertEqual([1010], self.fired)
+        # a far alarm wakes the loop up to cascade it
+        self._alarm(1500)
+        self.assertEqual(1472, self.scheduler._next_deadline)
+
+    def test_cancel(self):
+        events = [self._alarm(1000 + i % 300) for i in range(3000)]
+        for event in events[::2]:
+            event.cancel()
+            event.cancel()
+        self._advance(400)
+        self.assertEqual(1500, len(self.fired))
+        self.assertEqual(0, self.scheduler._count)
+        self.assertIsNone(self.scheduler._next_deadline)
+        # canceling a fired alarm is harmless
+        events[1].cancel()
+        self.assertEqual(0, self.scheduler._count)
+
+    def test_expired(self):
+        self._advance(10)
+        self._alarm(1005)
+        self.assertEqual(0, self.scheduler._get_delay())
+        self.scheduler._process()
+        self.assertEqual([1005], self.fired)
+
+    def test_callbacks_schedule_and_cancel(self):
+        def callback():
+            self.fired.append('callback')
+            later.cancel()
+            self._alarm(1001)
+            self.scheduler.defer(lambda: self.fired.append('deferred'), 3)
+
+        self.scheduler.alarm(callback, 1002)
+        later = self._alarm(1002)
+        self._advance(2)
+        self.assertEqual(['callback', 1001], self.fired)
+        self._advance(3)
+        self.assertEqual(['callback', 1001], self.fired)
+        self._advance(1)
+        self.assertEqual(['callback', 1001, 'deferred'], self.fired)
+
+
 class _AmqpBrokerTestCase(test_utils.BaseTestCase):
     """Creates a single FakeBroker for use by the tests"""
     @testtools.skipUnless(pyngus, "proton modules not present")
@@ -179,6 +272,31 @@ class TestAmqpSend(_AmqpBrokerTestCaseAuto):
 
         driver.cleanup()
 
+    def test_multiple_connections(self):
+        self.config(connection_count=3, group="oslo_messaging_amqp")
+        driver = amqp_driver.ProtonDriver(self.conf, self._broker_url)
+        targets = [oslo_messaging.Target(topic="topic-%d" % i)
+                   for i in range(12)]
+        listeners = [driver.listen(target, None, None)._poll_style_listener
+                     for target in targets]
+        # the subscriptions are spread over the connections
+        self.assertEqual(3, len(driver._ctrls))
+        _wait_until(lambda: self._broker.connection_count == 3, 30)
+        self.assertEqual(3, self._broker.connection_count)
+        self.assertTrue(
+            len(set(listener.ctrl for listener in listeners)) > 1)
+
+        threads = [_ListenerThread(listener, 1) for listener in listeners]
+        for i, target in enumerate(targets):
+            rc = driver.send(target, {"context": "whatever"},
+                             {"method": "echo", "id": "e%d" % i},
+                             wait_for_reply=True, timeout=30)
+            self.assertEqual({"correlation-id": "e%d" % i}, rc)
+        for thread in threads:
+            thread.join(timeout=30)
+            self.assertEqual(0, thread.msg_count)
+        driver.cleanup()
+
     def test_send_exchange_with_reply(self):
         driver = amqp_driver.ProtonDriver(self.conf, self._broker_url)
         target1 = oslo_messaging.Target(topic="test-topic", exchange="e1")
@@ -549,6 +667,87 @@ class TestAmqpSend(_AmqpBrokerTestCaseAuto):
         driver.cleanup()
 
 
+@testtools.skipUnless(pyngus, "proton modules not present")
+class TestMessageEncoding(test_utils.BaseTestCase):
+    """Test the JSON and native AMQP encodings of the message bodies."""
+
+    request = {"method": "echo",
+               "args": {"n": 1, "l": [1.5, None, True], "t": ("a", "b"),
+                        2: u"\u00e9", "when": datetime.datetime(2016, 1, 1)}}
+    expected = {"method": "echo",
+                "args": {"n": 1, "l": [1.5, None, True], "t": ["a", "b"],
+                         "2": u"\u00e9",
+                         "when": "2016-01-01T00:00:00.000000"}}
+
+    def _transfer(self, message):
+        received = amqp_driver.proton.Message()
+        received.decode(message.encode())
+        return received
+
+    def test_request(self):
+        for native in (False, True):
+            for envelope in (False, True):
+                message = self._transfer(amqp_driver.marshal_request(
+                    self.request, {"user": "u"}, envelope, native=native))
+                self.assertEqual(native, isinstance(message.body, dict))
+                request, ctxt = amqp_driver.unmarshal_request(message)
+                self.assertEqual(self.expected, request)
+                self.assertEqual({"user": "u"}, ctxt)
+
+    def test_response(self):
+        for native in (False, True):
+            message = self._transfer(amqp_driver.marshal_response(
+                self.request, None, native=native))
+            self.assertEqual(native, isinstance(message.body, dict))
+            self.assertEqual(self.expected,
+                             amqp_driver.unmarshal_response(message, []))
+
+            failure = (ValueError, ValueError("bad"), None)
+            message = self._transfer(amqp_driver.marshal_response(
+                None, failure, native=native))
+            self.assertRaises(ValueError, amqp_driver.unmarshal_response,
+                              message, [])
+
+    def test_not_encodable(self):
+        self.assertRaises(TypeError, amqp_driver.marshal_request,
+                          {"args": {"o": object()}}, {}, False, native=True)
+
+
+class TestAmqpEncodingNegotiation(_AmqpBrokerTestCaseAuto):
+    """Test RPC calls between drivers using different encodings."""
+
+    def _call(self, client_encoding, server_encoding):
+        self.config(message_encoding=server_encoding,
+                    group="oslo_messaging_amqp")
+        server = amqp_driver.ProtonDriver(self.conf, self._broker_url)
+        self.config(message_encoding=client_encoding,
+                    group="oslo_messaging_amqp")
+        client = amqp_driver.ProtonDriver(self.conf, self._broker_url)
+        target = oslo_messaging.Target(topic="test-topic")
+        listener = _ListenerThread(
+            server.listen(target, None, None)._poll_style_listener, 1)
+        rc = client.send(target, {"context": "whatever"},
+                         {"method": "echo", "id": "e1"},
+                         wait_for_reply=True, timeout=30)
+        self.assertEqual({"correlation-id": "e1"}, rc)
+        listener.join(timeout=30)
+        request = listener.messages.get()
+        self.assertEqual({"method": "echo", "id": "e1"}, request.message)
+        # the reply is encoded like the request
+        self.assertEqual(client_encoding == "native", request._native)
+        client.cleanup()
+        server.cleanup()
+
+    def test_native_client_json_server(self):
+        self._call("native", "json")
+
+    def test_json_client_native_server(self):
+        self._call("json", "native")
+
+    def test_native(self):
+        self._call("native", "native")
+
+
 class TestAmqpNotification(_AmqpBrokerTestCaseAuto):
     """Test sending and receiving notifications."""
 
@@ -1371,7 +1570,7 @@ class TestAddressing(test_utils.BaseTestCase):
                     wait_for_reply=False)
         listener.join(timeout=30)
 
-        addresser = driver._ctrl.addresser
+        addresser = driver._ctrls[0].addresser
         driver.cleanup()
         broker.stop()  # clears the driver's addresser
         return addresser
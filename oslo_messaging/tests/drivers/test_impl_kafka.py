@@ -11,11 +11,16 @@
 # WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
 # License for the specific language governing permissions and limitations
 # under the License.
+import collections
+
+import fixtures
 import kafka
 from kafka.common import KafkaError
 import mock
 from oslo_serialization import jsonutils
+from oslo_utils import encodeutils
 import testscenarios
+import threading
 import time
 
 import oslo_messaging
@@ -26,6 +31,23 @@ from oslo_messaging.tests import utils as test_utils
 load_tests = testscenarios.load_tests_apply_scenarios
 
 
+def fake_fetch(consumer, *offsets):
+    """Make consumer fetch messages of (partition, offset) once."""
+    value = jsonutils.dumps({'message': {}, 'context': {}})
+    batches = [[kafka.common.KafkaMessage(topic='topic', partition=partition,
+                                          offset=offset, key=None,
+                                          value=value)
+                for partition, offset in offsets]]
+
+    def fetch_messages():
+        if batches:
+            return iter(batches.pop())
+        # NOTE: a real fetch waits for messages
+        time.sleep(0.01)
+        return iter([])
+    consumer.fetch_messages.side_effect = fetch_messages
+
+
 class TestKafkaDriverLoad(test_utils.BaseTestCase):
 
     def setUp(self):
@@ -77,10 +99,27 @@ class TestKafkaDriver(test_utils.BaseTestCase):
         transport = oslo_messaging.get_transport(self.conf)
         self.driver = transport._driver
 
-    def test_send(self):
-        target = oslo_messaging.Target(topic="topic_test")
-        self.assertRaises(NotImplementedError,
-                          self.driver.send, target, {}, {})
+    @mock.patch.object(kafka_driver.Connection, '_ensure_connection')
+    @mock.patch.object(kafka_driver.Connection, '_send')
+    def test_send(self, fake_send, fake_ensure_connection):
+        self.driver.send(oslo_messaging.Target(topic='topic_test'), {}, {})
+        self.driver.send(oslo_messaging.Target(topic='topic_test',
+                                               exchange='test',
+                                               server='server1'), {}, {})
+        self.driver.send(oslo_messaging.Target(topic='topic_test',
+                                               server='server1',
+                                               fanout=True), {}, {})
+
+        calls = [(c[1][1], c[1][2], jsonutils.loads(c[1][0]))
+                 for c in fake_send.mock_calls]
+        self.assertEqual(
+            [('openstack_topic_test_shared', None,
+              {'message': {}, 'context': {}}),
+             ('test_topic_test', 'server1',
+              {'message': {}, 'context': {}, 'server': 'server1'}),
+             ('openstack_topic_test_fanout', None,
+              {'message': {}, 'context': {}})],
+            calls)
 
     def test_send_notification(self):
         target = oslo_messaging.Target(topic="topic_test")
@@ -90,10 +129,24 @@ class TestKafkaDriver(test_utils.BaseTestCase):
             self.driver.send_notification(target, {}, {}, None)
             self.assertEqual(1, len(fake_send.mock_calls))
 
-    def test_listen(self):
-        target = oslo_messaging.Target(topic="topic_test")
-        self.assertRaises(NotImplementedError, self.driver.listen, target,
-                          None, None)
+    @mock.patch.object(kafka_driver.Connection, '_ensure_connection')
+    @mock.patch.object(kafka_driver.Connection, 'declare_topic_consumer')
+    @mock.patch.object(kafka_driver.Connection, 'partition_for',
+                       return_value=2)
+    @mock.patch.object(kafka_driver, 'KafkaRPCListener')
+    def test_listen(self, fake_listener, fake_partition, fake_consumer,
+                    fake_ensure_connection):
+        fake_listener.return_value.prefetch_size = -1
+        target = oslo_messaging.Target(topic="topic_test", server='server1')
+        self.driver.listen(target, None, None)
+        fake_partition.assert_called_once_with('openstack_topic_test',
+                                               'server1')
+        fake_consumer.assert_called_once_with(
+            [('openstack_topic_test', 2), 'openstack_topic_test_fanout',
+             'openstack_topic_test_members'],
+            'openstack_topic_test_server1')
+        fake_listener.assert_called_once_with(
+            mock.ANY, mock.ANY, self.driver, 'openstack', target, 10)
 
 
 class TestKafkaConnection(test_utils.BaseTestCase):
@@ -177,6 +230,204 @@ class TestKafkaConnection(test_utils.BaseTestCase):
         self.assertRaises(driver_common.Timeout, conn.consume, timeout=3)
         self.assertEqual(0, int(deadline - time.time()))
 
+    @mock.patch.object(kafka_driver.Connection, '_ensure_connection')
+    @mock.patch.object(kafka_driver.Connection, '_parse_url')
+    def test_poll(self, fake_parse_url, fake_ensure_connection):
+        conn = kafka_driver.Connection(
+            self.conf, '', kafka_driver.PURPOSE_LISTEN)
+        conn.consumer = mock.MagicMock(_config={})
+        fake_fetch(conn.consumer, (0, 0), (0, 1), (0, 2))
+
+        # the rest of a fetch is kept for the next poll
+        poll = conn.poll(max_records=2)
+        self.assertEqual(0, next(poll).offset)
+        self.assertEqual(1, conn.consumer.fetch_messages.call_count)
+        self.assertEqual([1], [m.offset for m in poll])
+        self.assertEqual([2], [m.offset for m in conn.poll(max_records=2)])
+        self.assertEqual(1, conn.consumer.fetch_messages.call_count)
+        self.assertEqual(1000, conn.consumer._config['fetch_wait_max_ms'])
+
+        self.assertEqual([], list(conn.poll(timeout=0.2)))
+        self.assertEqual(200, conn.consumer._config['fetch_wait_max_ms'])
+
+    @mock.patch.object(kafka_driver.Connection, '_ensure_connection')
+    @mock.patch.object(kafka_driver.Connection, '_parse_url')
+    def test_poll_fetch_wait_set_once(self, fake_parse_url,
+                                      fake_ensure_connection):
+        conn = kafka_driver.Connection(
+            self.conf, '', kafka_driver.PURPOSE_LISTEN)
+        conn.consumer = mock.MagicMock()
+        conn.consumer.fetch_messages = mock.MagicMock(return_value=iter([]))
+
+        for i in range(3):
+            self.assertEqual([], list(conn.poll(timeout=0.05)))
+        self.assertTrue(conn.consumer.fetch_messages.call_count > 3)
+        conn.consumer._config.__setitem__.assert_called_once_with(
+            'fetch_wait_max_ms', 50)
+
+
+class TestOffsetTracker(test_utils.BaseTestCase):
+
+    def setUp(self):
+        super(TestOffsetTracker, self).setUp()
+        self.tracker = kafka_driver.OffsetTracker()
+        for offset in range(10, 14):
+            self.tracker.delivered('topic', 0, offset)
+        self.tracker.delivered('topic', 1, 7)
+
+    def test_contiguous(self):
+        self.tracker.acked('topic', 0, 12)
+        self.tracker.acked('topic', 0, 11)
+        self.assertEqual({}, self.tracker.pop_done())
+        self.assertEqual(0, self.tracker.acks)
+
+        self.tracker.acked('topic', 0, 10)
+        self.tracker.acked('topic', 1, 7)
+        self.assertEqual(2, self.tracker.acks)
+        self.assertEqual({('topic', 0): 12, ('topic', 1): 7},
+                         self.tracker.pop_done())
+        self.assertEqual({}, self.tracker.pop_done())
+
+        self.tracker.acked('topic', 0, 13)
+        self.assertEqual({('topic', 0): 13}, self.tracker.pop_done())
+
+    def test_restore(self):
+        self.tracker.acked('topic', 0, 10)
+        done = self.tracker.pop_done()
+        self.tracker.acked('topic', 0, 11)
+        self.tracker.restore(done)
+        self.tracker.acked('topic', 1, 7)
+        self.tracker.restore({('topic', 1): 6})
+        self.assertEqual({('topic', 0): 11, ('topic', 1): 7},
+                         self.tracker.pop_done())
+
+    def test_unknown_partition(self):
+        self.tracker.acked('topic', 2, 0)
+        self.assertEqual(0, self.tracker.acks)
+        self.assertEqual({}, self.tracker.pop_done())
+
+
+class TestKafkaAsyncProducer(test_utils.BaseTestCase):
+
+    def setUp(self):
+        super(TestKafkaAsyncProducer, self).setUp()
+        self.producer = mock.Mock()
+
+    def _async_producer(self, batch_size=10, linger=0.1, buffer_size=100,
+                        stop_timeout=30):
+        async_producer = kafka_driver.AsyncProducer(
+            self.producer, batch_size, linger, buffer_size,
+            retry_backoff=0, stop_timeout=stop_timeout)
+        self.addCleanup(async_producer.stop)
+        return async_producer
+
+    def _wait_for(self, predicate):
+        for i in range(100):
+            if predicate():
+                return
+            time.sleep(0.05)
+
+    def _wait_calls(self, count):
+        self._wait_for(
+            lambda: self.producer.send_messages.call_count >= count)
+
+    def test_batches(self):
+        async_producer = self._async_producer(batch_size=3)
+        for i in range(4):
+            async_producer.send('topic1', 'm%d' % i)
+        async_producer.send('topic2', 'm4')
+        async_producer.stop()
+
+        self.assertEqual([mock.call('topic1', 'm0', 'm1', 'm2'),
+                          mock.call('topic1', 'm3'),
+                          mock.call('topic2', 'm4')],
+                         self.producer.send_messages.mock_calls)
+
+    def test_retry(self):
+        def send_messages(topic, message):
+            if (message == 'twice' or
+                    self.producer.send_messages.call_count <= 3):
+                raise KafkaError('fake_exception')
+        self.producer.send_messages.side_effect = send_messages
+        async_producer = self._async_producer(batch_size=1, linger=0)
+        async_producer.send('topic', 'forever', retry=None)
+        async_producer.send('topic', 'twice', retry=2)
+        self._wait_calls(5)
+        async_producer.stop()
+
+        # forever is sent at the 3rd attempt, twice is given up after 2,
+        # the failed messages are sent again in turn
+        self.assertEqual([mock.call('topic', 'forever'),
+                          mock.call('topic', 'twice')] * 2 +
+                         [mock.call('topic', 'forever')],
+                         self.producer.send_messages.mock_calls)
+
+    def test_failing_topic_does_not_stall(self):
+        def send_messages(topic, message):
+            if topic == 'broken':
+                raise KafkaError('fake_exception')
+        self.producer.send_messages.side_effect = send_messages
+        async_producer = self._async_producer(batch_size=1, linger=0)
+        async_producer.send('broken', 'm0')
+        self._wait_calls(2)
+        async_producer.send('topic', 'm1')
+        sent = mock.call('topic', 'm1')
+        self._wait_for(lambda: sent in self.producer.send_messages.mock_calls)
+        self.assertIn(sent, self.producer.send_messages.mock_calls)
+
+    def test_stop_while_failing(self):
+        self.producer.send_messages.side_effect = KafkaError('down')
+        async_producer = self._async_producer(batch_size=1, linger=0,
+                                              buffer_size=2, stop_timeout=2)
+        for i in range(4):
+            async_producer.send('topic', 'm%d' % i)
+        start = time.time()
+        async_producer.stop()
+        self.assertTrue(time.time() - start < 2.5)
+        self.assertFalse(async_producer._thread.is_alive())
+
+    def test_backpressure(self):
+        sending = threading.Event()
+        release = threading.Event()
+
+        def send_messages(topic, *messages):
+            sending.set()
+            release.wait()
+        self.producer.send_messages.side_effect = send_messages
+        async_producer = self._async_producer(batch_size=1, linger=0,
+                                              buffer_size=1)
+        async_producer.send('topic', 'm0')
+        sending.wait()
+        async_producer.send('topic', 'm1')
+
+        sent = threading.Event()
+
+        def send():
+            async_producer.send('topic', 'm2')
+            sent.set()
+        threading.Thread(target=send).start()
+        self.assertFalse(sent.wait(0.2))
+        release.set()
+        self.assertTrue(sent.wait(5))
+
+    @mock.patch('kafka.SimpleProducer')
+    @mock.patch('kafka.KafkaClient')
+    def test_connection(self, fake_client, fake_producer):
+        self.messaging_conf.transport_driver = 'kafka'
+        transport = oslo_messaging.get_transport(self.conf)
+        self.addCleanup(transport.cleanup)
+        self.config(producer_async=True, producer_acks='all',
+                    compression_codec='gzip', group='oslo_messaging_kafka')
+        conn = transport._driver._get_connection(kafka_driver.PURPOSE_SEND)
+
+        conn.notify_send('topic', {}, {'payload': 1}, None)
+        conn.connection.async_producer.stop()
+        fake_producer.assert_called_once_with(
+            fake_client.return_value, req_acks=-1, codec=1)
+        fake_producer.return_value.send_messages.assert_called_once_with(
+            'topic', jsonutils.dumps({'message': {'payload': 1},
+                                      'context': {}}))
+
 
 class TestKafkaListener(test_utils.BaseTestCase):
 
@@ -223,16 +474,490 @@ class TestKafkaListener(test_utils.BaseTestCase):
         fake_targets_and_priorities = [(fake_target, 'info')]
         listener = self.driver.listen_for_notifications(
             fake_targets_and_priorities, None, None, None)._poll_style_listener
-        listener.conn.consume = mock.MagicMock()
-        listener.conn.consume.return_value = (
+        listener.conn.poll = mock.MagicMock()
+        listener.conn.poll.return_value = (
             iter([kafka.common.KafkaMessage(
                 topic='fake_topic', partition=0, offset=0,
                 key=None, value='{"message": {"fake": "fake_message_1"},'
                                 '"context": {"fake": "fake_context_1"}}')]))
         listener.poll()
-        self.assertEqual(1, len(listener.conn.consume.mock_calls))
+        self.assertEqual(1, len(listener.conn.poll.mock_calls))
         listener.conn.stop_consuming = mock.MagicMock()
         listener.stop()
         fake_response = listener.poll()
-        self.assertEqual(1, len(listener.conn.consume.mock_calls))
+        self.assertEqual(1, len(listener.conn.poll.mock_calls))
         self.assertEqual([], fake_response)
+
+
+class TestKafkaManualCommit(test_utils.BaseTestCase):
+
+    def setUp(self):
+        super(TestKafkaManualCommit, self).setUp()
+        self.messaging_conf.transport_driver = 'kafka'
+        transport = oslo_messaging.get_transport(self.conf)
+        self.addCleanup(transport.cleanup)
+        self.driver = transport._driver
+        self.config(consumer_commit_batch_size=3,
+                    consumer_commit_interval_ms=60000,
+                    group='oslo_messaging_kafka')
+
+    @mock.patch('kafka.KafkaConsumer')
+    @mock.patch('kafka.KafkaClient')
+    def _listener(self, fake_client, fake_consumer, pool='group'):
+        listener = self.driver.listen_for_notifications(
+            [(oslo_messaging.Target(topic='topic'), 'info')], pool,
+            None, None)._poll_style_listener
+        self.assertFalse(fake_consumer.call_args[1]['auto_commit_enable'])
+        self.consumer = fake_consumer.return_value
+        self.consumer._offsets = mock.Mock(task_done={})
+        return listener
+
+    def _poll(self, listener, count):
+        return [listener.poll()[0] for i in range(count)]
+
+    def test_commit_after_ack(self):
+        listener = self._listener()
+        fake_fetch(self.consumer, (0, 5), (0, 6), (1, 3), (0, 7))
+        messages = self._poll(listener, 4)
+
+        # out of order, (0, 5) still being processed
+        for message in messages[1:]:
+            message.acknowledge()
+        self.assertFalse(self.consumer.commit.called)
+        self.assertRaises(driver_common.Timeout, listener.conn.consume,
+                          timeout=0.01)
+        self.consumer.commit.assert_called_once_with()
+        self.assertEqual({('topic', 1): 3}, self.consumer._offsets.task_done)
+
+        messages[0].acknowledge()
+        listener.cleanup()
+        self.assertEqual(2, self.consumer.commit.call_count)
+        self.assertEqual({('topic', 0): 7, ('topic', 1): 3},
+                         self.consumer._offsets.task_done)
+
+    def test_requeue(self):
+        self.assertIsNone(self.driver.require_features(requeue=True))
+        listener = self._listener()
+        fake_fetch(self.consumer, (0, 5))
+        message = listener.poll()[0]
+        message.requeue()
+        self.assertIs(message, listener.poll()[0])
+        message.acknowledge()
+        listener.cleanup()
+        self.assertEqual({('topic', 0): 5}, self.consumer._offsets.task_done)
+
+    def test_no_group(self):
+        listener = self._listener(pool=None)
+        fake_fetch(self.consumer, (0, 5))
+        listener.poll()[0].acknowledge()
+        listener.cleanup()
+        self.assertFalse(self.consumer.commit.called)
+
+    def test_auto_commit(self):
+        self.config(enable_auto_commit=True, group='oslo_messaging_kafka')
+        self.assertRaises(NotImplementedError,
+                          self.driver.require_features, requeue=True)
+
+
+class TestKafkaPartitionLanes(test_utils.BaseTestCase):
+
+    def setUp(self):
+        super(TestKafkaPartitionLanes, self).setUp()
+        self.messaging_conf.transport_driver = 'kafka'
+        transport = oslo_messaging.get_transport(self.conf)
+        self.addCleanup(transport.cleanup)
+        self.driver = transport._driver
+        self.config(consumer_max_lanes=2, consumer_commit_interval_ms=60000,
+                    group='oslo_messaging_kafka')
+        self.processed = []
+        self.lock = threading.Lock()
+
+    def _listener(self, *offsets):
+        with mock.patch('kafka.KafkaClient'), \
+                mock.patch('kafka.KafkaConsumer') as fake_consumer:
+            listener = self.driver.listen_for_notifications(
+                [(oslo_messaging.Target(topic='topic'), 'info')], 'group',
+                1, None)
+        self.assertIsInstance(listener,
+                              kafka_driver.PartitionedKafkaListener)
+        self.consumer = fake_consumer.return_value
+        self.consumer._offsets = mock.Mock(task_done={})
+        fake_fetch(self.consumer, *offsets)
+        return listener
+
+    def _process(self, message, requeue=False):
+        # NOTE: partition 0 is slower, the others complete before it
+        if message.kafka_message.partition == 0:
+            time.sleep(0.01)
+        with self.lock:
+            self.processed.append((message.kafka_message.partition,
+                                   message.kafka_message.offset))
+        if requeue:
+            message.requeue()
+        else:
+            message.acknowledge()
+
+    def _on_incoming(self, batch):
+        for message in batch:
+            threading.Thread(target=self._process, args=(message,)).start()
+
+    def _wait_processed(self, count):
+        for i in range(500):
+            if len(self.processed) >= count:
+                return
+            time.sleep(0.01)
+        self.fail('%d messages processed' % len(self.processed))
+
+    def test_order(self):
+        offsets = [(partition, offset) for offset in range(5)
+                   for partition in range(3)]
+        listener = self._listener(*offsets)
+        listener.start(self._on_incoming)
+        self._wait_processed(15)
+        listener.stop()
+        listener.cleanup()
+
+        for partition in range(3):
+            self.assertEqual(list(range(5)),
+                             [offset for p, offset in self.processed
+                              if p == partition])
+        self.assertNotEqual(sorted(self.processed, key=lambda m: m[1]),
+                            self.processed)
+        self.assertEqual(2, len(listener._lanes))
+        self.assertEqual({('topic', p): 4 for p in range(3)},
+                         self.consumer._offsets.task_done)
+
+    def test_requeue(self):
+        listener = self._listener((0, 0), (0, 1))
+        requeued = []
+
+        def on_incoming(batch):
+            message = batch[0]
+            requeue = not requeued
+            requeued.append(message.kafka_message.offset)
+            threading.Thread(target=self._process,
+                             args=(message, requeue)).start()
+        listener.start(on_incoming)
+        self._wait_processed(3)
+        listener.stop()
+        listener.cleanup()
+
+        self.assertEqual([(0, 0), (0, 0), (0, 1)], self.processed)
+        self.assertEqual({('topic', 0): 1}, self.consumer._offsets.task_done)
+
+    def test_revoke(self):
+        listener = self._listener((0, 0), (1, 0), (1, 1))
+        held = []
+        release = threading.Event()
+
+        def on_incoming(batch):
+            if batch[0].kafka_message.partition == 0:
+                held.extend(batch)
+            else:
+                self._on_incoming(batch)
+        listener.start(on_incoming)
+        self._wait_processed(2)
+        self.assertEqual(1, len(held))
+
+        def revoke():
+            listener.revoke([('topic', 0)])
+            release.set()
+        # NOTE: revoke is called from the consuming thread in real life
+        listener._stopped.set()
+        listener.conn.stop_consuming()
+        listener._consume_thread.join()
+        threading.Thread(target=revoke).start()
+        self.assertFalse(release.wait(0.1))
+        held[0].requeue()
+        self.assertTrue(release.wait(5))
+        self.assertNotIn(('topic', 0), listener._assignment)
+        self.assertEqual({('topic', 1): 1}, self.consumer._offsets.task_done)
+
+        listener.stop()
+        listener.cleanup()
+        self.assertEqual([(1, 0), (1, 1)], self.processed)
+
+
+class TestKafkaReplyWaiter(test_utils.BaseTestCase):
+
+    def test_replies_of_other_clients_skipped(self):
+        polling = threading.Event()
+        replies = [{'msg_id': 'm1', 'reply_key': key, 'result': key,
+                    'failure': None} for key in ('other', 'mine')]
+        messages = [kafka.common.KafkaMessage(
+            topic=kafka_driver.REPLY_TOPIC, partition=0, offset=offset,
+            key=None, value=jsonutils.dumps(reply))
+            for offset, reply in enumerate(replies)]
+
+        def poll():
+            polling.wait()
+            if messages:
+                return iter([messages.pop(0), messages.pop(0)])
+            time.sleep(0.01)
+            return iter([])
+
+        conn = mock.Mock()
+        conn.poll.side_effect = poll
+        waiter = kafka_driver.ReplyWaiter(conn, 'mine', [])
+        self.addCleanup(waiter.stop)
+        waiter.listen('m1')
+        polling.set()
+        self.assertEqual('mine', waiter.wait('m1', 5))
+
+
+class FakeKafka(object):
+    """In memory topics standing for the brokers.
+
+    Keyed messages are partitioned as the driver sends them, the others go
+    to the partitions in turn. A consumer group commits the offsets it
+    fetched up to when its consumer is reset.
+    """
+
+    partitions = 5
+
+    def __init__(self):
+        self.topics = collections.defaultdict(list)
+        self.fetched = collections.defaultdict(list)
+        self.committed = collections.defaultdict(dict)
+        self.assigned = {}
+        self.next_partition = collections.defaultdict(int)
+        self.cond = threading.Condition()
+
+    def partition_ids(self, conn, topic):
+        return list(range(self.partitions))
+
+    def partition_for(self, conn, topic, key):
+        partitioner = kafka.Murmur2Partitioner(list(range(self.partitions)))
+        return partitioner.partition(encodeutils.safe_encode(key))
+
+    def send(self, conn, message, topic, key=None):
+        with self.cond:
+            if key is None:
+                partition = self.next_partition[topic] % self.partitions
+                self.next_partition[topic] += 1
+            else:
+                partition = self.partition_for(conn, topic, key)
+            self.topics[(topic, partition)].append(message)
+            self.cond.notify_all()
+
+    def declare_topic_consumer(self, conn, topics, group=None):
+        # NOTE: like a new consumer group, start at the end of the topics
+        partitions = []
+        for topic in topics:
+            if isinstance(topic, tuple):
+                partitions.append(topic)
+            else:
+                partitions.extend((topic, partition)
+                                  for partition in range(self.partitions))
+        with self.cond:
+            committed = self.committed[group]
+            conn.fetch_offsets = dict(
+                (partition, committed.get(partition,
+                                          len(self.topics[partition])))
+                for partition in partitions)
+            conn.group = group
+            self.assigned[conn] = (group, [partition for topic, partition
+                                           in partitions])
+
+    def reset(self, conn):
+        with self.cond:
+            if getattr(conn, 'fetch_offsets', None):
+                self.committed[conn.group].update(conn.fetch_offsets)
+            conn.fetch_offsets = {}
+            self.assigned.pop(conn, None)
+
+    def owners(self, group):
+        """Return the partitions of each consumer of a group."""
+        with self.cond:
+            return [partitions for conn_group, partitions
+                    in self.assigned.values()
+                    if conn_group == group and partitions]
+
+    def poll(self, conn, max_records=None, timeout=None):
+        deadline = time.time() + (timeout or 0.1)
+        messages = []
+        with self.cond:
+            while not messages and not conn._consume_loop_stopped:
+                for (topic, partition), offset in conn.fetch_offsets.items():
+                    for value in self.topics[(topic, partition)][offset:]:
+                        if max_records and len(messages) >= max_records:
+                            break
+                        messages.append(kafka.common.KafkaMessage(
+                            topic=topic, partition=partition, offset=offset,
+                            key=None, value=value))
+                        self.fetched[conn.group].append(value)
+                        offset += 1
+                    conn.fetch_offsets[(topic, partition)] = offset
+                left = deadline - time.time()
+                if messages or left <= 0:
+                    break
+                self.cond.wait(left)
+        return iter(messages)
+
+
+class TestKafkaRPC(test_utils.BaseTestCase):
+
+    def setUp(self):
+        super(TestKafkaRPC, self).setUp()
+        self.messaging_conf.transport_driver = 'kafka'
+        self.kafka = FakeKafka()
+        for name, fake in (('_send', self.kafka.send),
+                           ('partition_ids', self.kafka.partition_ids),
+                           ('partition_for', self.kafka.partition_for),
+                           ('reset', self.kafka.reset),
+                           ('close', self.kafka.reset),
+                           ('declare_topic_consumer',
+                            self.kafka.declare_topic_consumer),
+                           ('poll', self.kafka.poll)):
+            self.useFixture(fixtures.MockPatchObject(
+                kafka_driver.Connection, name, autospec=True,
+                side_effect=fake))
+        self.useFixture(fixtures.MockPatchObject(
+            kafka_driver.Connection, '_ensure_connection'))
+        self.transport = oslo_messaging.get_transport(self.conf)
+        self.addCleanup(self.transport.cleanup)
+
+    def _server(self, server, endpoint):
+        target = oslo_messaging.Target(topic='topic', server=server)
+        rpc_server = oslo_messaging.get_rpc_server(
+            self.transport, target, [endpoint], executor='threading')
+        rpc_server.start()
+
+        def stop():
+            rpc_server.stop()
+            rpc_server.wait()
+        self.addCleanup(stop)
+        return stop
+
+    def _fetched_requests(self, group):
+        # NOTE: the servers also fetch the announcements of one another
+        return [value for value in self.kafka.fetched[group]
+                if 'member' not in jsonutils.loads(value)]
+
+    def _wait_for_owners(self, count):
+        """Wait until count servers share the requests sent to the topic."""
+        for i in range(100):
+            owners = self.kafka.owners('openstack_topic')
+            if (len(owners) == count and
+                    sorted(sum(owners, [])) == list(range(5))):
+                return
+            time.sleep(0.05)
+        self.fail('Partitions not shared out: %s' % owners)
+
+    def test_rpc(self):
+
+        class Endpoint(object):
+            def __init__(self, name):
+                self.name = name
+                self.pings = 0
+
+            def whoami(self, ctxt):
+                return self.name
+
+            def ping(self, ctxt):
+                self.pings += 1
+
+            def fail(self, ctxt):
+                raise ValueError(self.name)
+
+        endpoints = [Endpoint('s1'), Endpoint('s2')]
+        for endpoint in endpoints:
+            self._server(endpoint.name, endpoint)
+        client = oslo_messaging.RPCClient(
+            self.transport, oslo_messaging.Target(topic='topic'), timeout=5)
+
+        for name in ('s1', 's2'):
+            self.assertEqual(name,
+                             client.prepare(server=name).call({}, 'whoami'))
+        self.assertRaises(ValueError,
+                          client.prepare(server='s2').call, {}, 'fail')
+
+        client.prepare(fanout=True).cast({}, 'ping')
+        client.prepare(server='s1').cast({}, 'ping')
+        for i in range(100):
+            if [endpoint.pings for endpoint in endpoints] == [2, 1]:
+                break
+            time.sleep(0.05)
+        self.assertEqual([2, 1], [endpoint.pings for endpoint in endpoints])
+
+    def test_server_fetches_its_own_partition(self):
+
+        class Endpoint(object):
+            def __init__(self):
+                self.calls = 0
+
+            def ping(self, ctxt):
+                self.calls += 1
+                return self.calls
+
+        # NOTE: s2 and s3 share a partition, s1 has one of its own
+        endpoints = dict((name, Endpoint()) for name in ('s1', 's2', 's3'))
+        for name, endpoint in endpoints.items():
+            self._server(name, endpoint)
+        client = oslo_messaging.RPCClient(
+            self.transport, oslo_messaging.Target(topic='topic'), timeout=5)
+
+        for i in range(3):
+            self.assertEqual(i + 1,
+                             client.prepare(server='s2').call({}, 'ping'))
+        self.assertEqual({'s1': 0, 's2': 3, 's3': 0},
+                         dict((name, endpoint.calls)
+                              for name, endpoint in endpoints.items()))
+        self.assertEqual([], self._fetched_requests('openstack_topic_s1'))
+        self.assertEqual(3, len(self._fetched_requests('openstack_topic_s3')))
+
+    def test_shared_requests(self):
+
+        class Endpoint(object):
+            def __init__(self, name):
+                self.name = name
+                self.calls = 0
+
+            def whoami(self, ctxt):
+                self.calls += 1
+                return self.name
+
+        endpoints = [Endpoint('s1'), Endpoint('s2'), Endpoint('s3')]
+        stops = [self._server(endpoint.name, endpoint)
+                 for endpoint in endpoints]
+        self._wait_for_owners(3)
+        client = oslo_messaging.RPCClient(
+            self.transport, oslo_messaging.Target(topic='topic'), timeout=5)
+
+        names = set(client.call({}, 'whoami') for i in range(10))
+        self.assertEqual(set(['s1', 's2', 's3']), names)
+        self.assertEqual(10, sum(endpoint.calls for endpoint in endpoints))
+
+        # NOTE: the partitions of a server leaving are taken over
+        stops[0]()
+        self._wait_for_owners(2)
+        calls = endpoints[0].calls
+        names = set(client.call({}, 'whoami') for i in range(10))
+        self.assertEqual(set(['s2', 's3']), names)
+        self.assertEqual(calls, endpoints[0].calls)
+
+    def test_shared_reply_topic(self):
+
+        class Endpoint(object):
+            def echo(self, ctxt, value):
+                return value
+
+        self._server('s1', Endpoint())
+        transport = oslo_messaging.get_transport(self.conf)
+        self.addCleanup(transport.cleanup)
+        for value, client_transport in enumerate((self.transport, transport)):
+            client = oslo_messaging.RPCClient(
+                client_transport,
+                oslo_messaging.Target(topic='topic', server='s1'), timeout=5)
+            self.assertEqual(value, client.call({}, 'echo', value=value))
+
+        reply_topics = set(topic for topic, partition in self.kafka.topics
+                           if 'reply' in topic)
+        self.assertEqual(set([kafka_driver.REPLY_TOPIC]), reply_topics)
+
+    def test_timeout(self):
+        client = oslo_messaging.RPCClient(
+            self.transport, oslo_messaging.Target(topic='topic', server='s1'),
+            timeout=0.2)
+        self.assertRaises(oslo_messaging.MessagingTimeout,
+                          client.call, {}, 'whoami')
@@ -13,6 +13,7 @@
 #    under the License.
 
 import datetime
+import socket
 import ssl
 import sys
 import threading
@@ -24,6 +25,7 @@ import kombu
 import kombu.transport.memory
 from oslo_config import cfg
 from oslo_serialization import jsonutils
+from oslo_utils import timeutils
 from oslo_utils import versionutils
 from oslotest import mockpatch
 import pkg_resources
@@ -111,6 +113,147 @@ class TestHeartbeat(test_utils.BaseTestCase):
             'trying to reconnect: %s')
 
 
+class TestHeartbeatScheduler(test_utils.BaseTestCase):
+
+    def setUp(self):
+        super(TestHeartbeatScheduler, self).setUp()
+        self.scheduler = rabbit_driver.HeartbeatScheduler()
+        self.ticks = []
+        self.ticked = threading.Event()
+
+    def _connection(self, name, interval):
+        connection = mock.Mock(_heartbeat_wait_timeout=interval)
+
+        def tick(reconnect=True, wait=True):
+            self.assertFalse(reconnect)
+            self.assertFalse(wait)
+            self.ticks.append(name)
+            self.ticked.set()
+        connection._heartbeat_tick.side_effect = tick
+        return connection
+
+    def _wait_ticks(self, count, name=None):
+        for i in range(500):
+            if len(self.ticks) >= count and (name is None or
+                                             name in self.ticks):
+                return
+            time.sleep(0.01)
+        self.fail('only %d heartbeats' % len(self.ticks))
+
+    def test_single_thread_serves_connections_when_due(self):
+        fast = self._connection('fast', 0.01)
+        slow = self._connection('slow', 1)
+        self.scheduler.register(fast, 0.01)
+        self.scheduler.register(slow, 1)
+        self.addCleanup(self.scheduler.unregister, fast)
+        self.addCleanup(self.scheduler.unregister, slow)
+        thread = self.scheduler._thread
+
+        self._wait_ticks(10)
+        self.assertIs(thread, self.scheduler._thread)
+        # the slow connection is not due before the fast one ticked a lot
+        self.assertEqual(['fast'] * 10, self.ticks[:10])
+        self._wait_ticks(10, 'slow')
+
+    def test_unregister(self):
+        connection = self._connection('conn', 0.01)
+        self.scheduler.register(connection, 0)
+        self.ticked.wait(5)
+        thread = self.scheduler._thread
+        self.scheduler.unregister(connection)
+        count = len(self.ticks)
+        thread.join(5)
+        self.assertFalse(thread.is_alive())
+        self.assertIsNone(self.scheduler._thread)
+        self.assertEqual(count, len(self.ticks))
+        self.assertEqual(0, len(self.scheduler))
+
+    @mock.patch('oslo_messaging._drivers.impl_rabbit.Connection.'
+                '_heartbeat_supported_and_enabled', return_value=True)
+    def test_send_connections_registered(self, fake_heartbeat_support):
+        self.config(heartbeat_shared_thread=True,
+                    group='oslo_messaging_rabbit')
+        self.useFixture(fixtures.MockPatchObject(
+            rabbit_driver, '_heartbeat_scheduler', self.scheduler))
+        transport = oslo_messaging.get_transport(self.conf,
+                                                 'kombu+memory:////')
+        self.addCleanup(transport.cleanup)
+        pool = transport._driver._connection_pool
+        conns = [pool.get() for i in range(3)]
+        for conn in conns:
+            self.assertIsNone(conn._heartbeat_thread)
+        self.assertEqual(3, len(self.scheduler))
+
+        listen_conn = transport._driver._get_connection(
+            driver_common.PURPOSE_LISTEN)
+        self.assertEqual(3, len(self.scheduler))
+        listen_conn.connection.close()
+
+        for conn in conns:
+            conn.close()
+        self.assertEqual(0, len(self.scheduler))
+
+    def _wait_for(self, predicate):
+        for i in range(500):
+            if predicate():
+                return
+            time.sleep(0.01)
+        self.fail('condition not met in time')
+
+    @mock.patch('oslo_messaging._drivers.impl_rabbit.Connection.'
+                '_heartbeat_supported_and_enabled', return_value=True)
+    def test_busy_connection_does_not_hold_up_others(self,
+                                                     fake_heartbeat_support):
+        self.config(heartbeat_shared_thread=True,
+                    heartbeat_timeout_threshold=1,
+                    group='oslo_messaging_rabbit')
+        self.useFixture(fixtures.MockPatchObject(
+            rabbit_driver, '_heartbeat_scheduler', self.scheduler))
+        transport = oslo_messaging.get_transport(self.conf,
+                                                 'kombu+memory:////')
+        self.addCleanup(transport.cleanup)
+        pool = transport._driver._connection_pool
+        busy, idle = pool.get(), pool.get()
+        self.addCleanup(busy.close)
+        self.addCleanup(idle.close)
+        busy_check = self.useFixture(fixtures.MockPatchObject(
+            busy, '_heartbeat_check')).mock
+        idle_check = self.useFixture(fixtures.MockPatchObject(
+            idle, '_heartbeat_check')).mock
+
+        held = threading.Event()
+        done = threading.Event()
+
+        def hold_lock():
+            with busy._connection_lock:
+                held.set()
+                done.wait(10)
+        holder = threading.Thread(target=hold_lock)
+        holder.daemon = True
+        holder.start()
+        self.assertTrue(held.wait(5))
+
+        self._wait_for(lambda: idle_check.call_count >= 3)
+        self.assertEqual(0, busy_check.call_count)
+
+        done.set()
+        holder.join(5)
+        self._wait_for(lambda: busy_check.called)
+
+    def test_tick_without_reconnect(self):
+        transport = oslo_messaging.get_transport(self.conf,
+                                                 'kombu+memory:////')
+        self.addCleanup(transport.cleanup)
+        conn = transport._driver._get_connection().connection
+        with mock.patch.object(conn, '_heartbeat_check',
+                               side_effect=kombu.exceptions.ConnectionError):
+            with mock.patch.object(conn, 'ensure_connection') as ensure:
+                conn._heartbeat_tick(reconnect=False)
+                self.assertFalse(ensure.called)
+                conn._heartbeat_tick()
+                self.assertTrue(ensure.called)
+
+
 class TestRabbitQos(test_utils.BaseTestCase):
 
     def connection_with(self, prefetch, purpose):
@@ -118,7 +261,8 @@ class TestRabbitQos(test_utils.BaseTestCase):
                     group="oslo_messaging_rabbit")
         transport = oslo_messaging.get_transport(self.conf,
                                                  'kombu+memory:////')
-        transport._driver._get_connection(purpose)
+        self.addCleanup(transport.cleanup)
+        return transport._driver._get_connection(purpose)
 
     @mock.patch('kombu.transport.memory.Channel.basic_qos')
     def test_qos_sent_on_listen_connection(self, fake_basic_qos):
@@ -135,6 +279,477 @@ class TestRabbitQos(test_utils.BaseTestCase):
         self.connection_with(prefetch=1, purpose=driver_common.PURPOSE_SEND)
         fake_basic_qos.assert_not_called()
 
+    @mock.patch('kombu.transport.memory.Channel.basic_qos')
+    def test_adaptive_qos(self, fake_basic_qos):
+        self.config(rabbit_qos_prefetch_adaptive=True,
+                    rabbit_qos_prefetch_max=64,
+                    group="oslo_messaging_rabbit")
+        conn = self.connection_with(prefetch=0,
+                                    purpose=driver_common.PURPOSE_LISTEN)
+        fake_basic_qos.assert_called_once_with(0, 1, True)
+
+        controller = conn.connection.prefetch_controller
+        with mock.patch.object(controller, 'adjust', return_value=8):
+            conn.connection._maybe_adjust_prefetch()
+        fake_basic_qos.assert_called_with(0, 8, True)
+
+    @mock.patch('kombu.transport.memory.Channel.basic_qos')
+    def test_adaptive_qos_not_on_notification_listener(self, fake_basic_qos):
+        self.config(rabbit_qos_prefetch_adaptive=True,
+                    group="oslo_messaging_rabbit")
+        transport = oslo_messaging.get_transport(self.conf,
+                                                 'kombu+memory:////')
+        self.addCleanup(transport.cleanup)
+        listener = transport._driver.listen_for_notifications(
+            [(oslo_messaging.Target(topic='topic'), 'info')], None, 50, None)
+        self.addCleanup(listener.cleanup)
+        conn = listener._poll_style_listener.conn.connection
+        self.assertIsNone(conn.prefetch_controller)
+        self.assertEqual([mock.call(0, 1, True), mock.call(0, 0, True),
+                          mock.call(0, 50, False)],
+                         fake_basic_qos.call_args_list)
+
+    @mock.patch('kombu.transport.memory.Channel.basic_qos')
+    def test_adaptive_qos_not_on_send_connection(self, fake_basic_qos):
+        self.config(rabbit_qos_prefetch_adaptive=True,
+                    group="oslo_messaging_rabbit")
+        conn = self.connection_with(prefetch=1,
+                                    purpose=driver_common.PURPOSE_SEND)
+        self.assertIsNone(conn.connection.prefetch_controller)
+        fake_basic_qos.assert_not_called()
+
+
+class TestPrefetchController(test_utils.BaseTestCase):
+
+    def setUp(self):
+        super(TestPrefetchController, self).setUp()
+        self.now = timeutils.now()
+        self.useFixture(fixtures.MockPatch('oslo_utils.timeutils.now',
+                                           side_effect=lambda: self.now))
+        self.controller = rabbit_driver.PrefetchController(4, 2, 16, 5)
+
+    def _period(self, delivered, processed):
+        for i in range(delivered):
+            self.controller.delivered()
+        for i in range(processed):
+            self.controller.processed()
+        self.now += 5
+        return self.controller.adjust()
+
+    def test_interval(self):
+        for i in range(4):
+            self.controller.delivered()
+        for i in range(4):
+            self.controller.processed()
+        self.assertIsNone(self.controller.adjust())
+        self.now += 5
+        self.assertEqual(8, self.controller.adjust())
+
+    def test_grows_when_window_processed(self):
+        self.assertEqual(8, self._period(4, 4))
+        self.assertEqual(16, self._period(8, 8))
+        self.assertIsNone(self._period(16, 16))
+        self.assertEqual(16, self.controller.window)
+
+    def test_shrinks_when_messages_hoarded(self):
+        self.assertEqual(2, self._period(4, 1))
+        self.assertIsNone(self._period(0, 0))
+        self.assertEqual(2, self.controller.window)
+
+    def test_unchanged_when_window_not_full(self):
+        self.assertIsNone(self._period(3, 3))
+        self.assertIsNone(self._period(0, 0))
+        self.assertEqual(4, self.controller.window)
+
+    def test_message_counted_once(self):
+        raw_message = mock.Mock(payload={'method': 'foo'})
+        message = rabbit_driver.RabbitMessage(raw_message, self.controller)
+        self.assertEqual(1, self.controller._in_flight)
+        message.acknowledge()
+        message.requeue()
+        self.assertEqual(0, self.controller._in_flight)
+        self.assertEqual(1, self.controller._processed)
+
+
+class TestRabbitConnectionPool(test_utils.BaseTestCase):
+
+    def _driver(self, **kwargs):
+        self.config(heartbeat_timeout_threshold=0,
+                    group="oslo_messaging_rabbit", **kwargs)
+        transport = oslo_messaging.get_transport(self.conf,
+                                                 'kombu+memory:////')
+        self.addCleanup(transport.cleanup)
+        return transport._driver
+
+    def test_warmup(self):
+        driver = self._driver(conn_pool_min_size=3, conn_pool_warmup=True)
+
+        for i in range(100):
+            if driver._connection_pool.stats()['free'] == 3:
+                break
+            time.sleep(0.01)
+        self.assertEqual(3, driver._connection_pool.stats()['created'])
+
+    def test_no_warmup(self):
+        driver = self._driver()
+        self.assertEqual(0, driver._connection_pool.stats()['created'])
+
+    def test_validate_stale_connection(self):
+        driver = self._driver(conn_pool_validate_after=1)
+        pool = driver._connection_pool
+        self.assertEqual(1, pool._validate_after)
+
+        conn = pool.get()
+        self.assertTrue(conn.is_healthy())
+        pool.put(conn)
+
+        later = timeutils.now() + 10
+        with mock.patch('oslo_utils.timeutils.now', return_value=later):
+            with mock.patch.object(conn, 'is_healthy', return_value=False):
+                self.assertIsNot(conn, pool.get())
+        self.assertEqual(1, pool.stats()['invalidated'])
+
+
+class TestRabbitChannelMultiplexing(test_utils.BaseTestCase):
+
+    def setUp(self):
+        super(TestRabbitChannelMultiplexing, self).setUp()
+        self.config(rabbit_send_channel_multiplexing=True,
+                    group="oslo_messaging_rabbit")
+        transport = oslo_messaging.get_transport(self.conf,
+                                                 'kombu+memory:////')
+        self.addCleanup(transport.cleanup)
+        self.driver = transport._driver
+
+    def test_send_connections_share_one_connection(self):
+        pool = self.driver._connection_pool
+        self.assertIsInstance(pool, rabbit_driver.ChannelConnectionPool)
+
+        conns = [pool.get() for i in range(3)]
+        shared = pool._shared
+        for conn in conns:
+            self.assertIs(shared.connection, conn.connection)
+            self.assertIs(shared._connection_lock, conn._connection_lock)
+            self.assertIsNone(conn._heartbeat_thread)
+        channels = set(id(conn.channel) for conn in conns)
+        self.assertEqual(3, len(channels))
+        self.assertNotIn(id(shared.channel), channels)
+
+        for conn in conns:
+            pool.put(conn)
+
+    def test_listener_gets_its_own_connection(self):
+        pool = self.driver._connection_pool
+        send_conn = pool.get()
+        self.addCleanup(pool.put, send_conn)
+        listen_conn = pool.create(purpose=driver_common.PURPOSE_LISTEN)
+        self.addCleanup(listen_conn.close)
+        self.assertIsNot(send_conn.connection, listen_conn.connection)
+
+    def test_close_keeps_shared_connection(self):
+        pool = self.driver._connection_pool
+        conn = pool.get()
+        kombu_conn = conn.connection
+        conn.close()
+        self.assertIsNone(conn.connection)
+        self.assertIs(kombu_conn, pool._shared.connection)
+
+        pool.empty()
+        self.assertIsNone(pool._shared)
+
+    def test_reopen_channel_on_reconnection(self):
+        pool = self.driver._connection_pool
+        conn = pool.get()
+        self.addCleanup(pool.put, conn)
+        channel = conn.channel
+
+        with conn._connection_lock:
+            self.assertIs(channel, conn._shared_channel())
+            conn._channel_connection = object()
+            self.assertIsNot(channel, conn._shared_channel())
+
+    def test_send_receive(self):
+        target = oslo_messaging.Target(topic='testtopic')
+        listener = self.driver.listen(target, None,
+                                      None)._poll_style_listener
+
+        for i in range(3):
+            self.driver.send(target, {}, {'tx_id': i})
+        received = []
+        while len(received) < 3:
+            received.extend(m.message['tx_id'] for m in listener.poll())
+        self.assertEqual([0, 1, 2], received)
+
+
+class TestRabbitTopicSharding(test_utils.BaseTestCase):
+
+    def setUp(self):
+        super(TestRabbitTopicSharding, self).setUp()
+        self.config(rabbit_sharded_topics=['testtopic'],
+                    rabbit_topic_shards=3,
+                    group='oslo_messaging_rabbit')
+        transport = oslo_messaging.get_transport(self.conf,
+                                                 'kombu+memory:////')
+        self.addCleanup(transport.cleanup)
+        self.driver = transport._driver
+
+    def _queues(self, listener):
+        return sorted(consumer.queue_name
+                      for consumer in listener.conn.connection._consumers)
+
+    def test_listen_on_every_shard(self):
+        target = oslo_messaging.Target(topic='testtopic', server='s1')
+        listener = self.driver.listen(target, None,
+                                      None)._poll_style_listener
+        queues = self._queues(listener)
+        self.assertEqual(['testtopic', 'testtopic.s1',
+                          'testtopic_shard_0', 'testtopic_shard_1',
+                          'testtopic_shard_2'],
+                         [q for q in queues if '_fanout_' not in q])
+
+    def test_shards_master_locator(self):
+        target = oslo_messaging.Target(topic='testtopic', server='s1')
+        listener = self.driver.listen(target, None,
+                                      None)._poll_style_listener
+        arguments = dict((consumer.queue_name, consumer.queue_arguments)
+                         for consumer in listener.conn.connection._consumers)
+        for shard in range(3):
+            self.assertEqual(
+                {'x-queue-master-locator': 'min-masters'},
+                arguments['testtopic_shard_%d' % shard])
+        self.assertEqual({}, arguments['testtopic'])
+        self.assertEqual({}, arguments['testtopic.s1'])
+
+    def test_other_topics_not_sharded(self):
+        target = oslo_messaging.Target(topic='othertopic')
+        listener = self.driver.listen(target, None,
+                                      None)._poll_style_listener
+        self.assertEqual(['othertopic', 'othertopic.None'],
+                         [q for q in self._queues(listener)
+                          if '_fanout_' not in q])
+
+    def test_send_receive(self):
+        target = oslo_messaging.Target(topic='testtopic')
+        listener = self.driver.listen(target, None,
+                                      None)._poll_style_listener
+
+        with mock.patch('random.randrange', side_effect=[2, 0, 1]):
+            with mock.patch.object(rabbit_driver.Connection,
+                                   '_publish') as publish:
+                for i in range(3):
+                    self.driver.send(target, {}, {'tx_id': i})
+        self.assertEqual(
+            ['testtopic_shard_2', 'testtopic_shard_0', 'testtopic_shard_1'],
+            [c[0][2] for c in publish.call_args_list])
+
+        for i in range(6):
+            self.driver.send(target, {}, {'tx_id': i})
+        received = []
+        while len(received) < 6:
+            received.extend(m.message['tx_id'] for m in listener.poll())
+        self.assertEqual(list(range(6)), sorted(received))
+
+
+class TestRabbitPriority(test_utils.BaseTestCase):
+
+    def setUp(self):
+        super(TestRabbitPriority, self).setUp()
+        self.config(rabbit_max_priority=10, group='oslo_messaging_rabbit')
+        transport = oslo_messaging.get_transport(self.conf,
+                                                 'kombu+memory:////')
+        self.addCleanup(transport.cleanup)
+        self.driver = transport._driver
+
+    def test_queue_arguments(self):
+        self.assertEqual({'x-max-priority': 10},
+                         rabbit_driver._get_queue_arguments(False, 0, 10))
+        self.assertEqual({}, rabbit_driver._get_queue_arguments(False, 0))
+
+    def test_rpc_queues_prioritized(self):
+        target = oslo_messaging.Target(topic='testtopic', server='s1')
+        listener = self.driver.listen(target, None,
+                                      None)._poll_style_listener
+        arguments = dict((consumer.queue_name, consumer.queue_arguments)
+                         for consumer in listener.conn.connection._consumers)
+        self.assertEqual({'x-max-priority': 10}, arguments.pop('testtopic'))
+        self.assertEqual({'x-max-priority': 10},
+                         arguments.pop('testtopic.s1'))
+        # the fanout queue
+        self.assertNotIn('x-max-priority', arguments.popitem()[1])
+
+    def test_notification_queues_not_prioritized(self):
+        target = oslo_messaging.Target(topic='notifications')
+        listener = self.driver.listen_for_notifications(
+            [(target, 'info')], None, 1, None)._poll_style_listener
+        for consumer in listener.conn.connection._consumers:
+            self.assertEqual({}, consumer.queue_arguments)
+
+    @mock.patch('kombu.messaging.Producer.publish')
+    def test_send_priority(self, fake_publish):
+        target = oslo_messaging.Target(topic='testtopic')
+        self.driver.send(target, {}, {'method': 'foo', 'priority': 3})
+        self.assertEqual(3, fake_publish.call_args[1]['priority'])
+
+        self.driver.send(target, {}, {'method': 'foo'})
+        self.assertNotIn('priority', fake_publish.call_args[1])
+
+    def test_send_receive(self):
+        target = oslo_messaging.Target(topic='testtopic')
+        listener = self.driver.listen(target, None,
+                                      None)._poll_style_listener
+
+        self.driver.send(target, {}, {'tx_id': 0, 'priority': 5})
+        received = listener.poll()
+        self.assertEqual(5, received[0].message['priority'])
+
+
+class TestHostLatencyTracker(test_utils.BaseTestCase):
+
+    url1 = 'amqp://u:p@host1:5672/'
+    url2 = 'amqp://u:p@host2:5673/'
+    url3 = 'amqp://u:p@host3/'
+
+    def setUp(self):
+        super(TestHostLatencyTracker, self).setUp()
+        self.tracker = rabbit_driver.HostLatencyTracker(alpha=0.5)
+
+    def test_rank(self):
+        self.tracker.record(self.url1, 0.2)
+        self.tracker.record(self.url2, 0.1)
+        self.assertEqual([self.url2, self.url1, self.url3],
+                         self.tracker.rank([self.url3, self.url1, self.url2]))
+
+        self.tracker.record(self.url2, 0.5)
+        self.assertAlmostEqual(0.3, self.tracker.rtt(self.url2))
+        self.assertEqual([self.url1, self.url2],
+                         self.tracker.rank([self.url2, self.url1]))
+
+    def test_unhealthy_ranked_last(self):
+        self.tracker.record(self.url1, 0.1)
+        self.tracker.record_failure(self.url1)
+        self.assertFalse(self.tracker.healthy(self.url1))
+        self.assertEqual([self.url3, self.url1],
+                         self.tracker.rank([self.url1, self.url3]))
+
+        later = timeutils.now() + self.tracker.failure_ttl + 1
+        with mock.patch('oslo_utils.timeutils.now', return_value=later):
+            self.assertTrue(self.tracker.healthy(self.url1))
+
+    @mock.patch('socket.create_connection')
+    def test_probe(self, create_connection):
+        self.tracker.probe(self.url2)
+        create_connection.assert_called_once_with(('host2', 5673), 1.0)
+        create_connection.return_value.close.assert_called_once_with()
+        self.assertIsNotNone(self.tracker.rtt(self.url2))
+
+        # recently measured
+        self.tracker.probe(self.url2)
+        self.assertEqual(1, create_connection.call_count)
+
+        create_connection.side_effect = socket.error
+        self.tracker.probe(self.url2, force=True)
+        self.assertFalse(self.tracker.healthy(self.url2))
+
+    @mock.patch('socket.create_connection')
+    def test_probe_in_background(self, create_connection):
+        self.tracker.record(self.url1, 0.1)
+        self.tracker.probe_in_background([self.url1, self.url2])
+        self.tracker.probe_in_background([self.url2])
+        for i in range(500):
+            if self.tracker._prober is None:
+                break
+            time.sleep(0.01)
+        self.assertIsNone(self.tracker._prober)
+        self.assertEqual([mock.call(('host1', 5672), 1.0),
+                          mock.call(('host2', 5673), 1.0)],
+                         create_connection.call_args_list)
+        self.assertIsNotNone(self.tracker.rtt(self.url2))
+
+
+class TestLatencyFailover(test_utils.BaseTestCase):
+
+    urls = ['amqp://u:p@host%d:5672/' % i for i in range(3)]
+
+    def setUp(self):
+        super(TestLatencyFailover, self).setUp()
+        self.config(kombu_failover_strategy='latency',
+                    kombu_latency_rebalance_interval=10,
+                    heartbeat_timeout_threshold=0,
+                    group='oslo_messaging_rabbit')
+        self.tracker = rabbit_driver.HostLatencyTracker()
+        self.useFixture(fixtures.MockPatchObject(self.tracker, 'probe'))
+        self.useFixture(fixtures.MockPatchObject(self.tracker,
+                                                 'probe_in_background'))
+        self.useFixture(fixtures.MockPatchObject(
+            rabbit_driver, '_host_latencies', self.tracker))
+        self.useFixture(fixtures.MockPatchObject(
+            rabbit_driver.Connection, 'ensure_connection'))
+        for i, rtt in enumerate((0.05, 0.02, 0.03)):
+            self.tracker.record(self.urls[i], rtt)
+
+    def _connection(self, purpose=driver_common.PURPOSE_LISTEN):
+        url = oslo_messaging.TransportURL.parse(
+            self.conf, 'rabbit://u:p@host0,u:p@host1,u:p@host2/')
+        connection = rabbit_driver.Connection(self.conf, url, purpose)
+        self.addCleanup(connection.close)
+        return connection
+
+    def test_initial_host(self):
+        connection = self._connection()
+        self.assertEqual(self.urls[1], connection._host_urls[0])
+        self.assertEqual('host1', connection.connection.hostname)
+        # NOTE: the hosts are measured again without delaying the connection
+        self.assertFalse(self.tracker.probe.called)
+        self.assertEqual(1, self.tracker.probe_in_background.call_count)
+        self.assertEqual(
+            self.urls,
+            sorted(self.tracker.probe_in_background.call_args[0][0]))
+
+    def test_failover_to_fastest_other_host(self):
+        connection = self._connection()
+        cycle = connection._latency_failover_cycle(self.urls)
+        self.assertEqual(self.urls[0], next(cycle))
+        # connected to host1, the fastest other host is host2
+        self.assertEqual(self.urls[2], next(cycle))
+
+        self.tracker.record_failure(self.urls[2])
+        self.assertEqual(self.urls[0], next(cycle))
+
+    def _rebalance(self, connection):
+        later = timeutils.now() + 11
+        with mock.patch('oslo_utils.timeutils.now', return_value=later):
+            with mock.patch.object(connection.connection,
+                                   'switch') as switch:
+                connection._maybe_rebalance()
+        return switch
+
+    def test_rebalance_to_faster_host(self):
+        connection = self._connection()
+        connection.connection.switch(self.urls[0])
+
+        self.tracker.probe.reset_mock()
+        self.tracker.probe_in_background.reset_mock()
+        switch = self._rebalance(connection)
+        switch.assert_called_once_with(self.urls[1])
+        # NOTE: no probe under the connection lock
+        self.assertFalse(self.tracker.probe.called)
+        self.tracker.probe_in_background.assert_called_once_with(
+            connection._host_urls)
+
+    def test_no_rebalance_to_slightly_faster_host(self):
+        connection = self._connection()
+        connection.connection.switch(self.urls[2])
+
+        switch = self._rebalance(connection)
+        self.assertFalse(switch.called)
+
+    def test_no_rebalance_for_send_connections(self):
+        connection = self._connection(driver_common.PURPOSE_SEND)
+        connection.connection.switch(self.urls[0])
+
+        switch = self._rebalance(connection)
+        self.assertFalse(switch.called)
+
 
 class TestRabbitDriverLoad(test_utils.BaseTestCase):
 
@@ -673,6 +1288,222 @@ class TestRacyWaitForReply(test_utils.BaseTestCase):
         self.assertEqual({'rx_id': 0}, replies[2])
 
 
+class TestSendReceiveStream(test_utils.BaseTestCase):
+
+    def setUp(self):
+        super(TestSendReceiveStream, self).setUp()
+        self.config(heartbeat_timeout_threshold=0,
+                    group="oslo_messaging_rabbit")
+        transport = oslo_messaging.get_transport(self.conf,
+                                                 'kombu+memory:////')
+        self.addCleanup(transport.cleanup)
+
+        self.driver = transport._driver
+        self.target = oslo_messaging.Target(topic='testtopic')
+        self.listener = self.driver.listen(
+            self.target, None, None)._poll_style_listener
+
+    def _send_stream(self):
+        replies = self.driver.send_stream(self.target, {}, {'tx_id': 1},
+                                          timeout=5)
+        received = self.listener.poll()[0]
+        self.assertEqual({'tx_id': 1}, received.message)
+        self.assertTrue(received.stream)
+        return replies, received
+
+    def test_stream(self):
+        replies, received = self._send_stream()
+
+        received.reply_stream(({'rx_id': i} for i in range(3)))
+
+        self.assertEqual([{'rx_id': 0}, {'rx_id': 1}, {'rx_id': 2}],
+                         list(replies))
+        self.assertEqual({}, self.driver._waiter.waiters._queues)
+
+    def test_stream_not_streamed_reply(self):
+        replies, received = self._send_stream()
+
+        received.reply([{'rx_id': 0}, {'rx_id': 1}])
+
+        self.assertEqual([{'rx_id': 0}, {'rx_id': 1}], list(replies))
+        self.assertEqual({}, self.driver._waiter.waiters._queues)
+
+    def test_stream_single_reply(self):
+        replies, received = self._send_stream()
+
+        received.reply(42)
+
+        self.assertEqual([42], list(replies))
+        self.assertEqual({}, self.driver._waiter.waiters._queues)
+
+    def test_stream_failure(self):
+        replies, received = self._send_stream()
+
+        def generate():
+            yield {'rx_id': 0}
+            raise ZeroDivisionError
+
+        try:
+            received.reply_stream(generate())
+        except ZeroDivisionError:
+            received.reply(failure=sys.exc_info())
+
+        self.assertEqual({'rx_id': 0}, next(replies))
+        self.assertRaises(ZeroDivisionError, next, replies)
+        self.assertEqual({}, self.driver._waiter.waiters._queues)
+
+    def _reply_stream_in_thread(self, received, count):
+        produced = []
+
+        def generate():
+            try:
+                for i in range(count):
+                    produced.append(i)
+                    yield {'rx_id': i}
+            finally:
+                produced.append('closed')
+
+        thread = threading.Thread(target=received.reply_stream,
+                                  args=(generate(),))
+        thread.daemon = True
+        thread.start()
+        return thread, produced
+
+    def _wait_for(self, predicate):
+        for i in range(200):
+            if predicate():
+                return
+            time.sleep(0.01)
+        self.fail('Condition not met')
+
+    def test_stream_flow_control(self):
+        self.driver.stream_window = 4
+        replies, received = self._send_stream()
+        thread, produced = self._reply_stream_in_thread(received, 20)
+
+        self.assertEqual({'rx_id': 0}, next(replies))
+        self._wait_for(lambda: len(produced) >= 5)
+        time.sleep(0.1)
+        # NOTE: the server waits for credit once 4 items are sent, it only
+        # produced the next one
+        self.assertEqual(list(range(5)), produced)
+
+        self.assertEqual([{'rx_id': i} for i in range(1, 20)],
+                         list(replies))
+        thread.join(5)
+        self.assertFalse(thread.is_alive())
+        self.assertEqual(list(range(20)) + ['closed'], produced)
+        self.assertEqual({}, self.driver._waiter.waiters._queues)
+
+    def test_stream_abandoned(self):
+        self.driver.stream_window = 4
+        replies, received = self._send_stream()
+        thread, produced = self._reply_stream_in_thread(received, 1000)
+
+        self.assertEqual({'rx_id': 0}, next(replies))
+        with mock.patch.object(amqpdriver.LOG, 'info') as info:
+            replies.close()
+            thread.join(5)
+            self.assertFalse(thread.is_alive())
+            time.sleep(0.1)
+        self.assertFalse(info.called)
+        self.assertEqual('closed', produced[-1])
+        self.assertTrue(len(produced) < 10)
+        self.assertEqual({}, self.driver._waiter.waiters._queues)
+
+    def test_stream_without_flow_control(self):
+        self.driver.stream_window = 0
+        replies, received = self._send_stream()
+
+        received.reply_stream(({'rx_id': i} for i in range(100)))
+
+        self.assertEqual([{'rx_id': i} for i in range(100)], list(replies))
+        self.assertEqual({}, self.driver._waiter.waiters._queues)
+
+    def test_stream_not_requested(self):
+        self.driver.send(self.target, {}, {'tx_id': 1})
+        received = self.listener.poll()[0]
+        self.assertFalse(received.stream)
+
+        with mock.patch.object(received, 'reply') as reply:
+            received.reply_stream(({'rx_id': i} for i in range(2)))
+        reply.assert_called_once_with([{'rx_id': 0}, {'rx_id': 1}])
+
+
+class TestSendReceiveHedged(test_utils.BaseTestCase):
+
+    def setUp(self):
+        super(TestSendReceiveHedged, self).setUp()
+        self.config(heartbeat_timeout_threshold=0,
+                    group="oslo_messaging_rabbit")
+        transport = oslo_messaging.get_transport(self.conf,
+                                                 'kombu+memory:////')
+        self.addCleanup(transport.cleanup)
+
+        self.driver = transport._driver
+        self.target = oslo_messaging.Target(topic='testtopic')
+        self.listener = self.driver.listen(
+            self.target, None, None)._poll_style_listener
+
+    def _send_hedged(self, hedge_delay):
+        replies = []
+
+        def send():
+            replies.append(self.driver.send_hedged(self.target, {},
+                                                   {'tx_id': 1},
+                                                   hedge_delay, timeout=5))
+
+        sender = threading.Thread(target=send)
+        sender.daemon = True
+        sender.start()
+        return sender, replies
+
+    def test_first_reply_before_delay(self):
+        sender, replies = self._send_hedged(5)
+
+        received = self.listener.poll()[0]
+        received.reply({'rx_id': 1})
+        sender.join()
+
+        self.assertEqual([{'rx_id': 1}], replies)
+        self.assertEqual([], self.listener.poll(timeout=0.1))
+        self.assertEqual({}, self.driver._waiter.waiters._queues)
+
+    def test_hedge_reply_first(self):
+        sender, replies = self._send_hedged(0.05)
+
+        first = self.listener.poll()[0]
+        hedge = self.listener.poll()[0]
+        self.assertEqual({'tx_id': 1}, first.message)
+        self.assertEqual({'tx_id': 1}, hedge.message)
+        self.assertNotEqual(first.msg_id, hedge.msg_id)
+
+        hedge.reply({'rx_id': 2})
+        sender.join()
+        self.assertEqual([{'rx_id': 2}], replies)
+        self.assertEqual({}, self.driver._waiter.waiters._queues)
+
+        # NOTE: the late reply is dropped
+        with mock.patch.object(amqpdriver.LOG, 'info') as info:
+            first.reply({'rx_id': 1})
+            for i in range(50):
+                if info.called:
+                    break
+                time.sleep(0.01)
+        self.assertIn(first.msg_id, info.call_args[0])
+
+    def test_first_reply_after_delay(self):
+        sender, replies = self._send_hedged(0.05)
+
+        first = self.listener.poll()[0]
+        self.listener.poll()
+        first.reply({'rx_id': 1})
+        sender.join()
+
+        self.assertEqual([{'rx_id': 1}], replies)
+        self.assertEqual({}, self.driver._waiter.waiters._queues)
+
+
 def _declare_queue(target):
     connection = kombu.connection.BrokerConnection(transport='memory')
 
@@ -14,12 +14,15 @@
 #    under the License.
 
 import threading
+import time
 import uuid
 
+from oslotest import mockpatch
 import testscenarios
 
 from oslo_messaging._drivers import pool
 from oslo_messaging.tests import utils as test_utils
+from six.moves import mock
 
 load_tests = testscenarios.load_tests_apply_scenarios
 
@@ -122,3 +125,150 @@ class PoolTestCase(test_utils.BaseTestCase):
 
 
 PoolTestCase.generate_scenarios()
+
+
+class PoolManagementTestCase(test_utils.BaseTestCase):
+
+    class TestPool(pool.Pool):
+
+        def __init__(self, *args, **kwargs):
+            super(PoolManagementTestCase.TestPool, self).__init__(*args,
+                                                                  **kwargs)
+            self.expired = []
+            self._on_expire = self.expired.append
+            self.healthy = True
+
+        def create(self):
+            return uuid.uuid4()
+
+        def validate(self, item):
+            return self.healthy
+
+    def setUp(self):
+        super(PoolManagementTestCase, self).setUp()
+        self.now = 0
+        self.useFixture(mockpatch.Patch('oslo_utils.timeutils.now',
+                                        side_effect=lambda: self.now))
+
+    def _pool(self, **kwargs):
+        p = self.TestPool(**kwargs)
+        self.addCleanup(p.stop)
+        return p
+
+    def test_expire(self):
+        p = self._pool(max_size=4, min_size=1, ttl=10)
+        items = [p.get() for i in range(3)]
+        for item in items:
+            p.put(item)
+            self.now += 5
+
+        # NOTE: the first item returned has been idle for 15s, the second
+        # for 10s and the last one for 5s
+        p.expire()
+        self.assertEqual(items[:1], p.expired)
+
+        self.now += 100
+        p.expire()
+        self.assertEqual(items[:2], p.expired)
+        self.assertEqual(items[2], p.get())
+
+        stats = p.stats()
+        self.assertEqual(3, stats['created'])
+        self.assertEqual(2, stats['expired'])
+        self.assertEqual(1, stats['size'])
+
+    def test_get_does_not_expire(self):
+        p = self._pool(max_size=4, min_size=0, ttl=10)
+        item = p.get()
+        p.put(item)
+        self.now += 100
+
+        with mock.patch.object(p, 'expire') as expire:
+            self.assertEqual(item, p.get())
+        self.assertFalse(expire.called)
+
+    def test_reaper(self):
+        p = self._pool(max_size=4, min_size=0, ttl=0)
+        p.put(p.get())
+        self.now += 1
+
+        for i in range(100):
+            if p.expired:
+                break
+            time.sleep(0.02)
+        self.assertEqual(1, len(p.expired))
+
+        p.stop()
+        self.assertIsNone(p._reaper)
+
+    def test_validate_stale(self):
+        p = self._pool(max_size=4, min_size=0, ttl=None, validate_after=10)
+        item = p.get()
+        p.put(item)
+
+        p.healthy = False
+        self.now += 5
+        self.assertEqual(item, p.get())
+        p.put(item)
+
+        self.now += 10
+        new_item = p.get()
+        self.assertNotEqual(item, new_item)
+        self.assertEqual([item], p.expired)
+
+        stats = p.stats()
+        self.assertEqual(1, stats['invalidated'])
+        self.assertEqual(2, stats['created'])
+        self.assertEqual(1, stats['size'])
+
+    def test_wait_stats(self):
+        p = self._pool(max_size=1, min_size=0, ttl=None)
+        item = p.get()
+
+        def put():
+            self.now += 2
+            p.put(item)
+
+        waiter = self.ThreadedWaiter(p._cond, put, self.stubs)
+        self.assertEqual(item, p.get())
+        waiter.join()
+
+        stats = p.stats()
+        self.assertEqual(1, stats['exhausted'])
+        self.assertEqual(2, stats['wait_time'])
+        self.assertEqual(2, stats['max_wait_time'])
+
+    class ThreadedWaiter(object):
+        """Run a function once the condition is waited for."""
+
+        def __init__(self, cond, func, stubs):
+            orig_wait = cond.wait
+            self.thread = None
+
+            def wait(**kwargs):
+                if self.thread is None:
+                    self.thread = threading.Thread(target=func)
+                    self.thread.start()
+                orig_wait(**kwargs)
+            stubs.Set(cond, 'wait', wait)
+
+        def join(self):
+            self.thread.join()
+
+    def test_warmup(self):
+        p = self._pool(max_size=4, min_size=2)
+        p.warmup().join()
+
+        stats = p.stats()
+        self.assertEqual(2, stats['created'])
+        self.assertEqual(2, stats['free'])
+        self.assertEqual(0, stats['exhausted'])
+
+    def test_iter_free(self):
+        p = self._pool(max_size=4, min_size=2)
+        items = [p.get() for i in range(2)]
+        for item in items:
+            p.put(item)
+
+        self.assertEqual(set(items), set(p.iter_free()))
+        self.assertEqual([], list(p.iter_free()))
@@ -0,0 +1,170 @@
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import time
+
+import mock
+
+import oslo_messaging
+from oslo_messaging._drivers import sharding
+from oslo_messaging.tests import utils as test_utils
+
+
+class TestHashRing(test_utils.BaseTestCase):
+
+    keys = ['openstack/topic-%d/' % i for i in range(2000)]
+
+    def test_balanced(self):
+        ring = sharding.HashRing(['a', 'b', 'c', 'd'])
+        counts = [0] * 4
+        for key in self.keys:
+            counts[ring.get(key)] += 1
+        for count in counts:
+            self.assertTrue(300 < count < 700, counts)
+
+    def test_stable(self):
+        ring1 = sharding.HashRing(['a', 'b', 'c'])
+        ring2 = sharding.HashRing(['a', 'b', 'c'])
+        self.assertEqual([ring1.get(key) for key in self.keys],
+                         [ring2.get(key) for key in self.keys])
+
+    def test_add_shard_moves_few_keys(self):
+        before = sharding.HashRing(['a', 'b', 'c'])
+        after = sharding.HashRing(['a', 'b', 'c', 'd'])
+        moved = [key for key in self.keys
+                 if before.get(key) != after.get(key)]
+        # only the keys taken over by the new shard move
+        self.assertEqual(set([3]), set(after.get(key) for key in moved))
+        self.assertTrue(len(moved) < len(self.keys) * 0.4, len(moved))
+
+    def test_no_shard(self):
+        self.assertRaises(ValueError, sharding.HashRing, [])
+
+
+class TestShardedDriver(test_utils.BaseTestCase):
+
+    def setUp(self):
+        super(TestShardedDriver, self).setUp()
+        self.transports = [mock.Mock() for i in range(8)]
+        for transport in self.transports:
+            transport._driver.listen.return_value = mock.Mock(
+                batch_size=1, batch_timeout=None, prefetch_size=-1)
+        self.driver = sharding.ShardedDriver(
+            self.conf, self.transports, ['shard%d' % i for i in range(8)],
+            default_exchange='openstack')
+
+    def _sent_to(self, method):
+        return [i for i, t in enumerate(self.transports)
+                if getattr(t._driver, method).called]
+
+    def test_topic_and_fanout_go_to_topic_shard(self):
+        shard = self.driver._shard('openstack', 'topic')
+        for target in (oslo_messaging.Target(topic='topic'),
+                       oslo_messaging.Target(topic='topic', fanout=True,
+                                             server='ignored'),
+                       oslo_messaging.Target(topic='topic',
+                                             exchange='openstack')):
+            self.driver.send(target, {}, {})
+        self.assertEqual([shard], self._sent_to('send'))
+
+    def test_server_shard(self):
+        for i in range(20):
+            target = oslo_messaging.Target(topic='topic', server='s%d' % i)
+            shard = self.driver._shard(None, 'topic', 's%d' % i)
+            self.driver.send(target, {}, {}, wait_for_reply=True)
+            self.transports[shard]._driver.send.assert_called_with(
+                target, {}, {}, wait_for_reply=True, timeout=None,
+                retry=None)
+
+    def test_listen_on_topic_and_server_shards(self):
+        for i in range(20):
+            target = oslo_messaging.Target(topic='topic', server='s%d' % i)
+            listener = self.driver.listen(target, 1, None)
+            shards = set([self.driver._shard(None, 'topic'),
+                          self.driver._shard(None, 'topic', 's%d' % i)])
+            if len(shards) == 1:
+                self.assertIs(
+                    self.transports[shards.pop()]._driver.listen.return_value,
+                    listener)
+            else:
+                self.assertIsInstance(listener, sharding.MultiListener)
+                self.assertEqual(2, len(listener._listeners))
+
+    def test_notifications(self):
+        target = oslo_messaging.Target(topic='notifications.info')
+        self.driver.send_notification(target, {}, {}, 2.0)
+        shard = self.driver._shard(None, 'notifications.info')
+        self.assertEqual([shard], self._sent_to('send_notification'))
+
+        self.driver.listen_for_notifications(
+            [(oslo_messaging.Target(topic='notifications'), 'info')],
+            None, 1, None)
+        self.assertEqual([shard], self._sent_to('listen_for_notifications'))
+
+    def test_cleanup(self):
+        self.driver.cleanup()
+        for transport in self.transports:
+            transport.cleanup.assert_called_once_with()
+
+
+class TestShardedTransport(test_utils.BaseTestCase):
+
+    def test_rpc(self):
+        transport = oslo_messaging.get_sharded_transport(
+            self.conf, ['fake://host%d/' % i for i in range(4)])
+        self.addCleanup(transport.cleanup)
+
+        class Endpoint(object):
+            def __init__(self, name):
+                self.name = name
+                self.pings = 0
+
+            def whoami(self, ctxt):
+                return self.name
+
+            def ping(self, ctxt):
+                self.pings += 1
+
+        servers = []
+        endpoints = []
+        for i in range(4):
+            target = oslo_messaging.Target(topic='topic', server='s%d' % i)
+            endpoint = Endpoint('s%d' % i)
+            server = oslo_messaging.get_rpc_server(
+                transport, target, [endpoint], executor='threading')
+            server.start()
+            servers.append(server)
+            endpoints.append(endpoint)
+
+        client = oslo_messaging.RPCClient(
+            transport, oslo_messaging.Target(topic='topic'), timeout=5)
+        for i in range(4):
+            self.assertEqual('s%d' % i,
+                             client.prepare(server='s%d' % i).call({},
+                                                                   'whoami'))
+        self.assertIn(client.call({}, 'whoami'),
+                      ['s%d' % i for i in range(4)])
+
+        client.prepare(fanout=True).cast({}, 'ping')
+        for i in range(100):
+            if all(endpoint.pings for endpoint in endpoints):
+                break
+            time.sleep(0.05)
+        for server in servers:
+            server.stop()
+            server.wait()
+        self.assertEqual([1] * 4,
+                         [endpoint.pings for endpoint in endpoints])
+
+    def test_no_shard(self):
+        self.assertRaises(oslo_messaging.InvalidTransportURL,
+                          oslo_messaging.get_sharded_transport, self.conf, [])
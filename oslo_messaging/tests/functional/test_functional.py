@@ -28,8 +28,6 @@ class CallTestCase(utils.SkipIfNoTransportURL):
 
     def setUp(self):
         super(CallTestCase, self).setUp(conf=cfg.ConfigOpts())
-        if self.url.startswith("kafka://"):
-            self.skipTest("kafka does not support RPC API")
 
         self.conf.prog = "test_prog"
         self.conf.project = "test_project"
@@ -160,8 +158,6 @@ class CastTestCase(utils.SkipIfNoTransportURL):
 
     def setUp(self):
         super(CastTestCase, self).setUp()
-        if self.url.startswith("kafka://"):
-            self.skipTest("kafka does not support RPC API")
 
     def test_specific_server(self):
         group = self.useFixture(
@@ -303,6 +303,56 @@ class TestNotifierTopics(test_utils.BaseTestCase):
         self.assertEqual(['topic1', 'topic2'], notifier._topics)
 
 
+class TestNotifierRateLimit(test_utils.BaseTestCase):
+
+    def setUp(self):
+        super(TestNotifierRateLimit, self).setUp()
+        self.config(driver=['test'], topics=['topic1', 'topic2'],
+                    group='oslo_messaging_notifications')
+        _impl_test.reset()
+        self.addCleanup(_impl_test.reset)
+        self.notifier = oslo_messaging.Notifier(_FakeTransport(self.conf),
+                                                'test.localhost')
+
+    def test_unlimited(self):
+        for i in range(5):
+            self.notifier.info({}, 'test.event', 'bar')
+        self.assertEqual(5, len(_impl_test.NOTIFICATIONS))
+
+    def test_drop(self):
+        self.config(rate_limit=1, rate_limit_action='drop',
+                    group='oslo_messaging_notifications')
+
+        self.notifier.info({}, 'test.event', 'bar')
+        self.notifier.info({}, 'test.event', 'bar')
+        self.assertEqual(1, len(_impl_test.NOTIFICATIONS))
+
+    def test_raise(self):
+        self.config(rate_limit_action='raise',
+                    event_type_rate_limits={'test.event': '1'},
+                    group='oslo_messaging_notifications')
+
+        self.notifier.info({}, 'test.event', 'bar')
+        self.assertRaises(oslo_messaging.RateLimitExceeded,
+                          self.notifier.info, {}, 'test.event', 'bar')
+        self.notifier.info({}, 'other.event', 'bar')
+        self.assertEqual(2, len(_impl_test.NOTIFICATIONS))
+
+    def test_prepare(self):
+        notifier = self.notifier.prepare(rate_limit=1,
+                                         rate_limit_action='raise')
+
+        notifier.info({}, 'test.event', 'bar')
+        self.assertRaises(oslo_messaging.RateLimitExceeded,
+                          notifier.info, {}, 'test.event', 'bar')
+        self.notifier.info({}, 'test.event', 'bar')
+        self.assertEqual(2, len(_impl_test.NOTIFICATIONS))
+
+    def test_prepare_invalid_action(self):
+        self.assertRaises(oslo_messaging.MessagingException,
+                          self.notifier.prepare, rate_limit_action='wait')
+
+
 class TestLogNotifier(test_utils.BaseTestCase):
 
     @mock.patch('oslo_utils.timeutils.utcnow')
@@ -13,6 +13,9 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import threading
+import time
+
 import mock
 
 from oslo_config import cfg
@@ -20,6 +23,7 @@ import testscenarios
 
 import oslo_messaging
 from oslo_messaging import exceptions
+from oslo_messaging.rpc import client as client_module
 from oslo_messaging import serializer as msg_serializer
 from oslo_messaging.tests import utils as test_utils
 
@@ -379,6 +383,607 @@ class TestSerializer(test_utils.BaseTestCase):
         serializer.serialize_context.assert_called_once_with(self.ctxt)
 
 
+class TestCallStream(test_utils.BaseTestCase):
+
+    def test_call_stream(self):
+        self.config(rpc_response_timeout=None)
+
+        transport = _FakeTransport(self.conf)
+        serializer = msg_serializer.NoOpSerializer()
+
+        client = oslo_messaging.RPCClient(transport, oslo_messaging.Target(),
+                                          serializer=serializer, timeout=5)
+
+        transport._send_stream = mock.Mock()
+        transport._send_stream.return_value = iter(['a', 'b', 'c'])
+
+        serializer.deserialize_entity = mock.Mock()
+        serializer.deserialize_entity.side_effect = lambda c, e: 'd' + e
+
+        replies = client.call_stream({}, 'foo', bar='blaa')
+
+        transport._send_stream.assert_called_once_with(
+            oslo_messaging.Target(), {},
+            dict(method='foo', args=dict(bar='blaa')),
+            timeout=5, retry=None)
+        self.assertEqual(['da', 'db', 'dc'], list(replies))
+
+    def test_call_stream_closed(self):
+        transport = _FakeTransport(self.conf)
+        client = oslo_messaging.RPCClient(transport, oslo_messaging.Target())
+
+        stream = mock.MagicMock()
+        stream.__iter__.return_value = iter(['a', 'b', 'c'])
+        transport._send_stream = mock.Mock(return_value=stream)
+
+        replies = client.call_stream({}, 'foo')
+        self.assertEqual('a', next(replies))
+        self.assertFalse(stream.close.called)
+        replies.close()
+        stream.close.assert_called_once_with()
+
+    def test_call_stream_fanout(self):
+        transport = _FakeTransport(self.conf)
+        client = oslo_messaging.RPCClient(transport,
+                                          oslo_messaging.Target(fanout=True))
+
+        self.assertRaises(exceptions.InvalidTarget,
+                          client.call_stream, {}, 'foo')
+
+
+class TestCircuitBreaker(test_utils.BaseTestCase):
+
+    def setUp(self):
+        super(TestCircuitBreaker, self).setUp()
+        self.config(rpc_response_timeout=None)
+
+        self.transport = _FakeTransport(self.conf)
+        self.transport._send = mock.Mock()
+        self.target = oslo_messaging.Target(topic='testtopic')
+
+    def _client(self, threshold, cooldown=60):
+        self.config(rpc_circuit_breaker_threshold=threshold,
+                    rpc_circuit_breaker_cooldown=cooldown)
+        return oslo_messaging.RPCClient(self.transport, self.target)
+
+    def _timeout(self, client, **kwargs):
+        self.transport._send.side_effect = oslo_messaging.MessagingTimeout
+        self.assertRaises(oslo_messaging.MessagingTimeout,
+                          client.prepare(**kwargs).call, {}, 'foo')
+
+    def test_disabled(self):
+        client = self._client(threshold=0)
+
+        for i in range(5):
+            self._timeout(client)
+
+        self.assertEqual(5, self.transport._send.call_count)
+        self.assertEqual({}, client.get_circuit_breaker_stats())
+
+    def test_open(self):
+        client = self._client(threshold=2)
+
+        self._timeout(client)
+        self._timeout(client)
+        self.assertRaises(oslo_messaging.RPCCircuitOpenError,
+                          client.call, {}, 'foo')
+        self.assertEqual(2, self.transport._send.call_count)
+
+        # NOTE: other targets are not affected
+        self._timeout(client, server='other')
+        self.assertEqual(3, self.transport._send.call_count)
+
+        stats = client.get_circuit_breaker_stats()
+        self.assertEqual({'state': 'open', 'failures': 2, 'rejected': 1,
+                          'transitions': {'open': 1}},
+                         stats[(None, 'testtopic', None)])
+        self.assertEqual('closed',
+                         stats[(None, 'testtopic', 'other')]['state'])
+
+    def test_remote_error_resets(self):
+        client = self._client(threshold=2)
+
+        self._timeout(client)
+        self.transport._send.side_effect = ValueError
+        self.assertRaises(ValueError, client.call, {}, 'foo')
+        self._timeout(client)
+
+        stats = client.get_circuit_breaker_stats()
+        self.assertEqual('closed', stats[(None, 'testtopic', None)]['state'])
+        self.assertEqual(1, stats[(None, 'testtopic', None)]['failures'])
+
+    def test_half_open(self):
+        client = self._client(threshold=1, cooldown=0)
+
+        # NOTE: with no cooldown the call following a timeout is a probe
+        self._timeout(client)
+        self._timeout(client)
+        stats = client.get_circuit_breaker_stats()
+        self.assertEqual({'open': 2, 'half-open': 1},
+                         stats[(None, 'testtopic', None)]['transitions'])
+
+        self.transport._send.side_effect = None
+        self.transport._send.return_value = 'bar'
+        self.assertEqual('bar', client.call({}, 'foo'))
+        self.assertEqual(3, self.transport._send.call_count)
+
+        stats = client.get_circuit_breaker_stats()
+        self.assertEqual('closed', stats[(None, 'testtopic', None)]['state'])
+        self.assertEqual({'open': 2, 'half-open': 2, 'closed': 1},
+                         stats[(None, 'testtopic', None)]['transitions'])
+
+    def test_shared_by_prepared_contexts(self):
+        client = self._client(threshold=1)
+
+        self._timeout(client, timeout=1)
+        self.assertRaises(oslo_messaging.RPCCircuitOpenError,
+                          client.prepare(timeout=2).call, {}, 'foo')
+
+
+class TestHedgedCall(test_utils.BaseTestCase):
+
+    def setUp(self):
+        super(TestHedgedCall, self).setUp()
+        self.config(rpc_response_timeout=None)
+
+        self.transport = _FakeTransport(self.conf)
+        self.transport._send = mock.Mock(return_value='bar')
+        self.transport._send_hedged = mock.Mock(return_value='bar')
+        target = oslo_messaging.Target(topic='testtopic')
+        self.client = oslo_messaging.RPCClient(self.transport, target)
+
+    def _record(self, latency, count=100):
+        for i in range(count):
+            self.client.latencies.record((None, 'testtopic', 'foo'), latency)
+
+    def test_not_hedged_by_default(self):
+        self._record(0.1)
+
+        self.assertEqual('bar', self.client.call({}, 'foo'))
+        self.assertTrue(self.transport._send.called)
+        self.assertFalse(self.transport._send_hedged.called)
+
+    def test_not_enough_samples(self):
+        self._record(0.1, count=self.client.latencies.min_samples - 2)
+        cctxt = self.client.prepare(hedge=True)
+
+        self.assertEqual('bar', cctxt.call({}, 'foo'))
+        self.assertFalse(self.transport._send_hedged.called)
+
+        # NOTE: the latency of the call itself is the last sample needed
+        cctxt.call({}, 'foo')
+        self.assertFalse(self.transport._send_hedged.called)
+        cctxt.call({}, 'foo')
+        self.assertTrue(self.transport._send_hedged.called)
+
+    def test_hedged(self):
+        self.config(rpc_hedge_percentile=90)
+        self._record(0.1, count=90)
+        self._record(2.0, count=10)
+
+        cctxt = self.client.prepare(hedge=True, timeout=5)
+        self.assertEqual('bar', cctxt.call({}, 'foo', a=1))
+
+        self.assertFalse(self.transport._send.called)
+        args, kwargs = self.transport._send_hedged.call_args
+        target, ctxt, msg, delay = args
+        self.assertEqual('testtopic', target.topic)
+        self.assertEqual(dict(method='foo', args=dict(a=1)), msg)
+        self.assertTrue(0.1 <= delay < 0.11, delay)
+        self.assertEqual(dict(timeout=5, retry=None), kwargs)
+
+    def test_not_hedged_to_server(self):
+        self._record(0.1)
+
+        cctxt = self.client.prepare(hedge=True, server='srv', timeout=5)
+        self.assertEqual('bar', cctxt.call({}, 'foo'))
+        self.assertTrue(self.transport._send.called)
+        self.assertFalse(self.transport._send_hedged.called)
+
+    def test_delay_exceeds_timeout(self):
+        self._record(2.0)
+
+        self.client.prepare(hedge=True, timeout=1).call({}, 'foo')
+        self.assertTrue(self.transport._send.called)
+        self.assertFalse(self.transport._send_hedged.called)
+
+    def test_latency_per_method(self):
+        self._record(0.1)
+
+        self.client.prepare(hedge=True).call({}, 'other')
+        self.assertFalse(self.transport._send_hedged.called)
+
+
+class TestAdaptiveTimeout(test_utils.BaseTestCase):
+
+    def setUp(self):
+        super(TestAdaptiveTimeout, self).setUp()
+        self.config(rpc_response_timeout=60,
+                    rpc_adaptive_timeout_multiplier=3)
+
+        self.transport = _FakeTransport(self.conf)
+        self.transport._send = mock.Mock(return_value='bar')
+        target = oslo_messaging.Target(topic='testtopic')
+        self.client = oslo_messaging.RPCClient(self.transport, target)
+
+    def _record(self, latency, count=1000):
+        for i in range(count):
+            self.client.latencies.record((None, 'testtopic', 'foo'), latency)
+
+    def _timeout(self, cctxt=None):
+        (cctxt or self.client).call({}, 'foo')
+        return self.transport._send.call_args[1]['timeout']
+
+    def test_disabled(self):
+        self.config(rpc_adaptive_timeout_multiplier=0)
+        self._record(0.5)
+
+        self.assertEqual(60, self._timeout())
+
+    def test_not_enough_samples(self):
+        self._record(0.5, count=self.client.latencies.min_tail_samples - 1)
+
+        self.assertEqual(60, self._timeout())
+        self.assertTrue(self._timeout() < 60)
+
+    def test_adaptive(self):
+        self._record(0.5)
+
+        timeout = self._timeout()
+        self.assertTrue(1.5 <= timeout < 1.65, timeout)
+
+    def test_tail(self):
+        self._record(0.5, count=990)
+        self._record(4.0, count=10)
+
+        timeout = self._timeout()
+        self.assertTrue(12 <= timeout < 13.2, timeout)
+
+    def test_minimum(self):
+        self.config(rpc_adaptive_timeout_minimum=2)
+        self._record(0.01)
+
+        self.assertEqual(2, self._timeout())
+
+    def test_bounded_by_timeout(self):
+        self._record(30)
+
+        self.assertEqual(60, self._timeout())
+        self.assertEqual(5, self._timeout(self.client.prepare(timeout=5)))
+
+    def test_timeouts_recorded(self):
+        self.transport._send.side_effect = oslo_messaging.MessagingTimeout
+
+        self.assertRaises(oslo_messaging.MessagingTimeout,
+                          self.client.call, {}, 'foo')
+        self.assertEqual(1, self.client.latencies._histograms[
+            (None, 'testtopic', 'foo')].count)
+
+
+class TestCallCoalescing(test_utils.BaseTestCase):
+
+    def setUp(self):
+        super(TestCallCoalescing, self).setUp()
+        self.config(rpc_response_timeout=None)
+
+        self.transport = _FakeTransport(self.conf)
+        self.transport._send = mock.Mock(return_value='bar')
+        self.target = oslo_messaging.Target(topic='testtopic')
+
+    def _client(self, **kwargs):
+        self.config(**kwargs)
+        client = oslo_messaging.RPCClient(self.transport, self.target)
+        return client.prepare(coalesce=True)
+
+    def _call_in_thread(self, cctxt, results):
+        def call():
+            try:
+                results.append(cctxt.call({}, 'foo', a=1))
+            except Exception as ex:
+                results.append(ex)
+
+        thread = threading.Thread(target=call)
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def _blocking_send(self, result):
+        sent = threading.Event()
+        release = threading.Event()
+
+        def send(*args, **kwargs):
+            sent.set()
+            release.wait()
+            if isinstance(result, Exception):
+                raise result
+            return result
+
+        self.transport._send.side_effect = send
+        return sent, release
+
+    def test_not_coalesced_by_default(self):
+        client = oslo_messaging.RPCClient(self.transport, self.target)
+        client.call({}, 'foo', a=1)
+        client.call({}, 'foo', a=1)
+        self.assertEqual(2, self.transport._send.call_count)
+
+    def test_concurrent_calls(self):
+        cctxt = self._client()
+        sent, release = self._blocking_send('bar')
+
+        results = []
+        threads = [self._call_in_thread(cctxt, results)]
+        self.assertTrue(sent.wait(5))
+        threads += [self._call_in_thread(cctxt, results) for i in range(3)]
+        time.sleep(0.1)
+        release.set()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(['bar'] * 4, results)
+        self.assertEqual(1, self.transport._send.call_count)
+        self.assertEqual({}, cctxt.call_coalescer._in_flight)
+
+        # NOTE: without cache the next call sends a new request
+        self.transport._send.side_effect = None
+        cctxt.call({}, 'foo', a=1)
+        self.assertEqual(2, self.transport._send.call_count)
+
+    def test_concurrent_calls_failure(self):
+        cctxt = self._client()
+        sent, release = self._blocking_send(
+            oslo_messaging.MessagingTimeout('timeout'))
+
+        results = []
+        threads = [self._call_in_thread(cctxt, results)]
+        self.assertTrue(sent.wait(5))
+        threads.append(self._call_in_thread(cctxt, results))
+        time.sleep(0.1)
+        release.set()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(2, len(results))
+        for result in results:
+            self.assertIsInstance(result, oslo_messaging.MessagingTimeout)
+        self.assertEqual(1, self.transport._send.call_count)
+
+    def test_follower_timeout(self):
+        cctxt = self._client()
+        sent, release = self._blocking_send('bar')
+        self.addCleanup(release.set)
+
+        results = []
+        leader = self._call_in_thread(cctxt, results)
+        self.assertTrue(sent.wait(5))
+        self.assertRaises(oslo_messaging.MessagingTimeout,
+                          cctxt.prepare(timeout=0.05).call, {}, 'foo', a=1)
+        self.assertEqual([], results)
+
+        release.set()
+        leader.join()
+        self.assertEqual(['bar'], results)
+        self.assertEqual(1, self.transport._send.call_count)
+
+    def test_concurrent_calls_get_copies(self):
+        cctxt = self._client()
+        sent, release = self._blocking_send({'items': [1, 2]})
+
+        results = []
+        threads = [self._call_in_thread(cctxt, results)]
+        self.assertTrue(sent.wait(5))
+        threads += [self._call_in_thread(cctxt, results) for i in range(2)]
+        time.sleep(0.1)
+        release.set()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual([{'items': [1, 2]}] * 3, results)
+        results[0]['items'].append(3)
+        self.assertEqual([{'items': [1, 2]}] * 2, results[1:])
+        self.assertEqual(3, len(set(id(result) for result in results)))
+
+    def test_cached_result_copied(self):
+        cctxt = self._client(rpc_coalesce_cache_ttl=60)
+        self.transport._send.return_value = {'items': [1, 2]}
+
+        cctxt.call({}, 'foo', a=1)['items'].append(3)
+        result = cctxt.call({}, 'foo', a=1)
+        self.assertEqual({'items': [1, 2]}, result)
+        result['items'].append(4)
+        self.assertEqual({'items': [1, 2]}, cctxt.call({}, 'foo', a=1))
+        self.assertEqual(1, self.transport._send.call_count)
+
+    def test_not_coalesced_across_contexts(self):
+        cctxt = self._client(rpc_coalesce_cache_ttl=60)
+
+        cctxt.call({'user': 'u1', 'tenant': 't1'}, 'foo', a=1)
+        cctxt.call({'user': 'u2', 'tenant': 't1'}, 'foo', a=1)
+        self.assertEqual(2, self.transport._send.call_count)
+
+        cctxt.call({'tenant': 't1', 'user': 'u1'}, 'foo', a=1)
+        self.assertEqual(2, self.transport._send.call_count)
+
+    def test_context_key(self):
+        self.config(rpc_coalesce_cache_ttl=60)
+        client = oslo_messaging.RPCClient(self.transport, self.target)
+        cctxt = client.prepare(
+            coalesce=lambda ctxt: (ctxt['user'], ctxt['tenant']))
+
+        cctxt.call({'user': 'u1', 'tenant': 't1', 'request_id': 'r1'},
+                   'foo', a=1)
+        cctxt.call({'user': 'u1', 'tenant': 't1', 'request_id': 'r2'},
+                   'foo', a=1)
+        self.assertEqual(1, self.transport._send.call_count)
+
+        cctxt.call({'user': 'u2', 'tenant': 't1', 'request_id': 'r3'},
+                   'foo', a=1)
+        self.assertEqual(2, self.transport._send.call_count)
+
+    def test_cache(self):
+        cctxt = self._client(rpc_coalesce_cache_ttl=60)
+
+        self.assertEqual('bar', cctxt.call({}, 'foo', a=1))
+        self.assertEqual('bar', cctxt.call({}, 'foo', a=1))
+        self.assertEqual(1, self.transport._send.call_count)
+
+        cctxt.call({}, 'foo', a=2)
+        cctxt.call({}, 'other', a=1)
+        cctxt.prepare(server='srv').call({}, 'foo', a=1)
+        self.assertEqual(4, self.transport._send.call_count)
+
+    def test_cache_expiry(self):
+        cctxt = self._client(rpc_coalesce_cache_ttl=0.01)
+
+        cctxt.call({}, 'foo', a=1)
+        time.sleep(0.02)
+        cctxt.call({}, 'foo', a=1)
+        self.assertEqual(2, self.transport._send.call_count)
+        self.assertEqual(1, len(cctxt.call_coalescer._cache))
+
+    def test_cache_size(self):
+        cctxt = self._client(rpc_coalesce_cache_ttl=60,
+                             rpc_coalesce_cache_size=2)
+
+        for a in (1, 2, 3, 1):
+            cctxt.call({}, 'foo', a=a)
+        self.assertEqual(4, self.transport._send.call_count)
+        self.assertEqual(2, len(cctxt.call_coalescer._cache))
+
+    def test_failure_not_cached(self):
+        cctxt = self._client(rpc_coalesce_cache_ttl=60)
+        self.transport._send.side_effect = ValueError
+
+        self.assertRaises(ValueError, cctxt.call, {}, 'foo', a=1)
+        self.assertRaises(ValueError, cctxt.call, {}, 'foo', a=1)
+        self.assertEqual(2, self.transport._send.call_count)
+
+
+class TestRateLimit(test_utils.BaseTestCase):
+
+    def setUp(self):
+        super(TestRateLimit, self).setUp()
+        self.config(rpc_response_timeout=None)
+
+        self.transport = _FakeTransport(self.conf)
+        self.transport._send = mock.Mock()
+        target = oslo_messaging.Target(topic='testtopic')
+        self.client = oslo_messaging.RPCClient(self.transport, target)
+
+    def test_unlimited(self):
+        for i in range(5):
+            self.client.cast({}, 'foo')
+        self.assertEqual(5, self.transport._send.call_count)
+
+    def test_drop_cast(self):
+        self.config(rpc_rate_limit=1, rpc_rate_limit_action='drop')
+
+        self.client.cast({}, 'foo')
+        self.client.cast({}, 'foo')
+        self.assertEqual(1, self.transport._send.call_count)
+
+        # NOTE: other topics are not affected
+        self.client.prepare(topic='other').cast({}, 'foo')
+        self.assertEqual(2, self.transport._send.call_count)
+
+    def test_call_not_dropped(self):
+        self.config(rpc_rate_limit=1, rpc_rate_limit_action='drop')
+
+        self.client.call({}, 'foo')
+        self.assertRaises(oslo_messaging.RateLimitExceeded,
+                          self.client.call, {}, 'foo')
+        self.assertEqual(1, self.transport._send.call_count)
+
+    def test_method_limit(self):
+        self.config(rpc_method_rate_limits={'foo': '1'},
+                    rpc_rate_limit_action='raise')
+
+        self.client.cast({}, 'foo')
+        ex = self.assertRaises(oslo_messaging.RateLimitExceeded,
+                               self.client.cast, {}, 'foo')
+        self.assertIn('method foo', ex.limit)
+        self.client.cast({}, 'bar')
+        self.assertEqual(2, self.transport._send.call_count)
+
+    def test_prepare(self):
+        self.config(rpc_rate_limit=1, rpc_rate_limit_action='drop')
+
+        cctxt = self.client.prepare(rate_limit=2, rate_limit_action='raise')
+        cctxt.cast({}, 'foo')
+        cctxt.cast({}, 'foo')
+        self.assertRaises(oslo_messaging.RateLimitExceeded,
+                          cctxt.cast, {}, 'foo')
+
+        unlimited = self.client.prepare(rate_limit=0)
+        for i in range(3):
+            unlimited.cast({}, 'foo')
+        self.assertEqual(5, self.transport._send.call_count)
+
+    def test_prepare_invalid_action(self):
+        self.assertRaises(exceptions.MessagingException,
+                          self.client.prepare, rate_limit_action='wait')
+
+
+class TestPriority(test_utils.BaseTestCase):
+
+    def setUp(self):
+        super(TestPriority, self).setUp()
+        self.transport = _FakeTransport(self.conf)
+        self.transport._send = mock.Mock()
+        target = oslo_messaging.Target(topic='testtopic')
+        self.client = oslo_messaging.RPCClient(self.transport, target)
+
+    def _sent_message(self):
+        return self.transport._send.call_args[0][2]
+
+    def test_no_priority(self):
+        self.client.cast({}, 'foo')
+        self.assertNotIn('priority', self._sent_message())
+
+    def test_prepare(self):
+        cctxt = self.client.prepare(priority=5)
+        cctxt.cast({}, 'foo')
+        self.assertEqual(5, self._sent_message()['priority'])
+
+        cctxt.prepare(server='s1').call({}, 'foo')
+        self.assertEqual(5, self._sent_message()['priority'])
+
+        cctxt.prepare(priority=None).cast({}, 'foo')
+        self.assertNotIn('priority', self._sent_message())
+
+    def test_invalid_priority(self):
+        for priority in (-1, 256, 1.5, '1', True):
+            self.assertRaises(exceptions.MessagingException,
+                              self.client.prepare, priority=priority)
+
+
+class TestLatencyHistogram(test_utils.BaseTestCase):
+
+    def test_empty(self):
+        histogram = client_module._LatencyHistogram()
+        self.assertIsNone(histogram.percentile(50))
+
+    def test_percentile(self):
+        histogram = client_module._LatencyHistogram()
+        for latency in range(1, 101):
+            histogram.record(latency / 100.0)
+
+        for percent in (1, 50, 95, 100):
+            latency = histogram.percentile(percent)
+            self.assertTrue(percent / 100.0 <= latency < percent * 1.1 / 100,
+                            latency)
+
+    def test_decay(self):
+        histogram = client_module._LatencyHistogram(decay=10)
+        for i in range(9):
+            histogram.record(5.0)
+        self.assertTrue(histogram.percentile(50) >= 5.0)
+
+        for i in range(11):
+            histogram.record(0.01)
+        self.assertTrue(histogram.percentile(50) < 0.011)
+
+
 class TestVersionCap(test_utils.BaseTestCase):
 
     _call_vs_cast = [
@@ -14,6 +14,7 @@
 #    under the License.
 
 import eventlet
+import functools
 import threading
 
 from oslo_config import cfg
@@ -244,6 +245,20 @@ class TestRPCServer(test_utils.BaseTestCase, ServerSetupMixin):
         else:
             self.assertTrue(False)
 
+    def test_executor_class_cached(self):
+        transport = oslo_messaging.get_transport(self.conf, url='fake:')
+        self.addCleanup(server_module._executor_classes.clear)
+        server_module._executor_classes.clear()
+
+        with mock.patch('stevedore.driver.DriverManager') as manager:
+            for i in range(2):
+                server = oslo_messaging.get_rpc_server(transport, None, [],
+                                                       executor='threading')
+                self.assertIs(manager.return_value.driver,
+                              server._executor_cls)
+        manager.assert_called_once_with('oslo.messaging.executors',
+                                        'threading')
+
     def test_cast(self):
         transport = oslo_messaging.get_transport(self.conf, url='fake:')
 
@@ -304,6 +319,78 @@ class TestRPCServer(test_utils.BaseTestCase, ServerSetupMixin):
 
         self._stop_server(client, server_thread)
 
+    def test_call_stream(self):
+        transport = oslo_messaging.get_transport(self.conf, url='fake:')
+
+        class TestEndpoint(object):
+            def repeat(self, ctxt, arg):
+                for i in range(3):
+                    yield arg
+
+        server_thread = self._setup_server(transport, TestEndpoint())
+        client = self._setup_client(transport)
+
+        self.assertEqual(['dsdsfoo'] * 3,
+                         list(client.call_stream({}, 'repeat', arg='foo')))
+
+        self._stop_server(client, server_thread)
+
+    def test_call_stream_failure(self):
+        transport = oslo_messaging.get_transport(self.conf, url='fake:')
+
+        class TestEndpoint(object):
+            def repeat(self, ctxt, arg):
+                yield arg
+                raise ValueError(arg)
+
+        server_thread = self._setup_server(transport, TestEndpoint())
+        client = self._setup_client(transport)
+
+        ex = self.assertRaises(
+            ValueError,
+            lambda: list(client.call_stream({}, 'repeat', arg='foo')))
+        self.assertEqual('dsfoo', str(ex))
+
+        self._stop_server(client, server_thread)
+
+    def test_call_stream_expected_failure(self):
+        transport = oslo_messaging.get_transport(self.conf, url='fake:')
+        errors = []
+        self.stubs.Set(rpc_server_module.LOG, 'error',
+                       lambda msg, *a, **kw: errors.append(msg))
+
+        class TestEndpoint(object):
+            @oslo_messaging.expected_exceptions(ValueError)
+            def repeat(self, ctxt, arg):
+                yield arg
+                raise ValueError(arg)
+
+        server_thread = self._setup_server(transport, TestEndpoint())
+        client = self._setup_client(transport)
+
+        ex = self.assertRaises(
+            ValueError,
+            lambda: list(client.call_stream({}, 'repeat', arg='foo')))
+        self.assertEqual('dsfoo', str(ex))
+        self.assertEqual([], errors)
+
+        self._stop_server(client, server_thread)
+
+    def test_call_stream_single_result(self):
+        transport = oslo_messaging.get_transport(self.conf, url='fake:')
+
+        class TestEndpoint(object):
+            def echo(self, ctxt, arg):
+                return arg
+
+        server_thread = self._setup_server(transport, TestEndpoint())
+        client = self._setup_client(transport)
+
+        self.assertEqual(['dsdsfoo'],
+                         list(client.call_stream({}, 'echo', arg='foo')))
+
+        self._stop_server(client, server_thread)
+
     def test_context(self):
         transport = oslo_messaging.get_transport(self.conf, url='fake:')
 
@@ -864,6 +951,48 @@ class TestServerLocking(test_utils.BaseTestCase):
         self.assertFalse(mock_log.warning.called)
 
 
+class TestPriorityWorkQueue(test_utils.BaseTestCase):
+
+    def test_order(self):
+        queue = server_module._PriorityWorkQueue()
+        for priority, incoming in ((0, 'a'), (5, 'b'), (0, 'c'), (9, 'd'),
+                                   (5, 'e')):
+            queue.put(priority, incoming)
+        self.assertEqual(['d', 'b', 'e', 'a', 'c'],
+                         [queue.get() for i in range(5)])
+        self.assertEqual(0, len(queue))
+
+    def test_server_handles_higher_priority_first(self):
+        tasks = []
+
+        class QueueingExecutor(object):
+            def __init__(self, *args, **kwargs):
+                pass
+
+            def submit(self, fn, *args, **kwargs):
+                tasks.append(functools.partial(fn, *args, **kwargs))
+
+        handled = []
+        server = oslo_messaging.get_rpc_server(
+            mock.Mock(), oslo_messaging.Target(topic='testtopic',
+                                               server='testserver'), [])
+        server._executor_cls = QueueingExecutor
+        server.transport._listen.return_value = mock.Mock()
+        server._process_incoming = lambda incoming: handled.append(
+            incoming[0].message['method'])
+        server.start()
+
+        for method, priority in (('bulk1', None), ('bulk2', 0),
+                                 ('urgent', 5), ('bulk3', None)):
+            message = {'method': method}
+            if priority is not None:
+                message['priority'] = priority
+            server._on_incoming([mock.Mock(message=message)])
+        for task in tasks:
+            task()
+        self.assertEqual(['urgent', 'bulk1', 'bulk2', 'bulk3'], handled)
+
+
 class TestRPCExposeDecorator(test_utils.BaseTestCase):
 
     def foo(self):
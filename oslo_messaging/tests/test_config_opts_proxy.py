@@ -12,6 +12,9 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import weakref
+
+import mock
 from oslo_config import cfg
 from oslo_config import types
 
@@ -69,3 +72,52 @@ class TestConfigOptsProxy(test_utils.BaseTestCase):
                          conf.oslo_messaging_rabbit.dict)
         self.assertEqual(True, conf.oslo_messaging_rabbit.bool)
         self.assertEqual('default', conf.oslo_messaging_rabbit.str)
+
+    def test_values_cached(self):
+        group = 'oslo_messaging_rabbit'
+        self.config(rabbit_retry_interval=1, group=group)
+        url = transport.TransportURL.parse(
+            self.conf, "rabbit:///?rabbit_qos_prefetch_count=2")
+        conf = drv_cmn.ConfigOptsProxy(self.conf, url)
+        self.assertIs(conf.oslo_messaging_rabbit, getattr(conf, group))
+
+        group_proxy = conf.oslo_messaging_rabbit
+        with mock.patch.object(group_proxy, '_resolve',
+                               wraps=group_proxy._resolve) as resolve:
+            for i in range(3):
+                self.assertEqual(
+                    2, conf.oslo_messaging_rabbit.rabbit_qos_prefetch_count)
+        resolve.assert_called_once_with('rabbit_qos_prefetch_count')
+
+        self.assertEqual(1, conf.oslo_messaging_rabbit.rabbit_retry_interval)
+        self.config(rabbit_retry_interval=5, group=group)
+        self.assertEqual(5, conf.oslo_messaging_rabbit.rabbit_retry_interval)
+        self.conf.clear_override('rabbit_retry_interval', group=group)
+        self.assertEqual(1, conf.oslo_messaging_rabbit.rabbit_retry_interval)
+
+        # NOTE: the url still overrides the configuration
+        self.config(rabbit_qos_prefetch_count=5, group=group)
+        self.assertEqual(
+            2, conf.oslo_messaging_rabbit.rabbit_qos_prefetch_count)
+
+    def test_proxy_not_kept_alive(self):
+        url = transport.TransportURL.parse(
+            self.conf, "rabbit:///?rabbit_qos_prefetch_count=2")
+        conf = drv_cmn.ConfigOptsProxy(self.conf, url)
+        self.assertEqual(
+            2, conf.oslo_messaging_rabbit.rabbit_qos_prefetch_count)
+        conf_ref = weakref.ref(conf)
+        del conf
+        self.assertIsNone(conf_ref())
+
+    def test_mutate_drops_cached_values(self):
+        group = 'oslo_messaging_rabbit'
+        self.conf([])
+        self.config(rabbit_retry_interval=1, group=group)
+        url = transport.TransportURL.parse(self.conf, "rabbit:///")
+        conf = drv_cmn.ConfigOptsProxy(self.conf, url)
+        self.assertEqual(1, conf.oslo_messaging_rabbit.rabbit_retry_interval)
+
+        self.config(rabbit_retry_interval=5, group=group)
+        self.conf.mutate_config_files()
+        self.assertEqual(5, conf.oslo_messaging_rabbit.rabbit_retry_interval)
@@ -271,6 +271,63 @@ class TestSetDefaults(test_utils.BaseTestCase):
                                                      invoke_kwds=invoke_kwds)
 
 
+class TestDriverSharing(test_utils.BaseTestCase):
+
+    def setUp(self):
+        super(TestDriverSharing, self).setUp()
+        self.config(transport_driver_sharing=True)
+        self.drivers = []
+
+        def load(*args, **kwargs):
+            drvr = _FakeDriver(self.conf)
+            drvr.cleanup = mock.Mock()
+            self.drivers.append(drvr)
+            return _FakeManager(drvr)
+
+        self.useFixture(fixtures.MockPatchObject(driver, 'DriverManager',
+                                                 side_effect=load))
+
+    def test_same_url_shares_driver(self):
+        t1 = oslo_messaging.get_transport(self.conf, 'testtransport://a/')
+        t2 = oslo_messaging.get_transport(
+            self.conf, oslo_messaging.TransportURL.parse(
+                self.conf, 'testtransport://a/'))
+
+        self.assertIsNot(t1, t2)
+        self.assertIs(t1._driver, t2._driver)
+        self.assertEqual(1, len(self.drivers))
+
+        t1.cleanup()
+        t1.cleanup()
+        self.assertFalse(self.drivers[0].cleanup.called)
+        t2.cleanup()
+        self.drivers[0].cleanup.assert_called_once_with()
+
+        oslo_messaging.get_transport(self.conf, 'testtransport://a/')
+        self.assertEqual(2, len(self.drivers))
+
+    def test_different_transports_dont_share(self):
+        t1 = oslo_messaging.get_transport(self.conf, 'testtransport://a/')
+        t2 = oslo_messaging.get_transport(self.conf, 'testtransport://b/')
+        t3 = oslo_messaging.get_transport(self.conf, 'testtransport://a/',
+                                          allowed_remote_exmods=['foo'])
+        t4 = oslo_messaging.get_transport(cfg.ConfigOpts(),
+                                          'testtransport://a/')
+
+        self.assertEqual(4, len(set([t1._driver, t2._driver,
+                                     t3._driver, t4._driver])))
+        for t in (t1, t2, t3, t4):
+            t.cleanup()
+        for drvr in self.drivers:
+            drvr.cleanup.assert_called_once_with()
+
+    def test_sharing_disabled(self):
+        self.config(transport_driver_sharing=False)
+        t1 = oslo_messaging.get_transport(self.conf, 'testtransport://a/')
+        t2 = oslo_messaging.get_transport(self.conf, 'testtransport://a/')
+        self.assertIsNot(t1._driver, t2._driver)
+
+
 class TestTransportMethodArgs(test_utils.BaseTestCase):
 
     _target = oslo_messaging.Target(topic='topic', server='server')
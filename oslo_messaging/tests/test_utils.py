@@ -13,6 +13,9 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import time
+
+import oslo_messaging
 from oslo_messaging._drivers import common
 from oslo_messaging import _utils as utils
 from oslo_messaging.tests import utils as test_utils
@@ -97,3 +100,55 @@ class TimerTestCase(test_utils.BaseTestCase):
         remaining = t.check_return(callback, 1, a='b')
         self.assertEqual(0, remaining)
         callback.assert_called_once_with(1, a='b')
+
+
+class RateLimiterTestCase(test_utils.BaseTestCase):
+
+    def setUp(self):
+        super(RateLimiterTestCase, self).setUp()
+        self.limiter = utils.RateLimiter()
+
+    def test_burst(self):
+        limits = [('topic', 1)]
+        for i in range(3):
+            self.assertTrue(self.limiter.acquire(limits, 'drop', burst=3))
+        self.assertFalse(self.limiter.acquire(limits, 'drop', burst=3))
+
+    def test_default_burst(self):
+        limits = [('topic', 2.5)]
+        for i in range(3):
+            self.assertTrue(self.limiter.acquire(limits, 'drop'))
+        self.assertFalse(self.limiter.acquire(limits, 'drop'))
+
+    def test_raise(self):
+        limits = [('topic', 1)]
+        self.limiter.acquire(limits, 'raise')
+        ex = self.assertRaises(oslo_messaging.RateLimitExceeded,
+                               self.limiter.acquire, limits, 'raise')
+        self.assertEqual('topic', ex.limit)
+        self.assertTrue(0 < ex.retry_after <= 1)
+
+    @mock.patch('time.sleep')
+    def test_block(self, sleep):
+        limits = [('topic', 100)]
+        self.assertTrue(self.limiter.acquire(limits, 'block', burst=1))
+        self.assertTrue(self.limiter.acquire(limits, 'block', burst=1))
+        self.assertTrue(sleep.called)
+        self.assertTrue(0 < sleep.call_args_list[0][0][0] <= 0.01)
+
+    def test_refill(self):
+        limits = [('topic', 100)]
+        self.assertTrue(self.limiter.acquire(limits, 'drop', burst=1))
+        self.assertFalse(self.limiter.acquire(limits, 'drop', burst=1))
+        time.sleep(0.01)
+        self.assertTrue(self.limiter.acquire(limits, 'drop', burst=1))
+
+    def test_refund(self):
+        limits = [('topic', 10), ('method', 1)]
+        self.assertTrue(self.limiter.acquire(limits, 'drop'))
+        self.assertFalse(self.limiter.acquire(limits, 'drop'))
+
+        # NOTE: the token taken for the topic by the dropped message is back
+        for i in range(9):
+            self.assertTrue(self.limiter.acquire([('topic', 10)], 'drop'))
+        self.assertFalse(self.limiter.acquire([('topic', 10)], 'drop'))
@@ -23,17 +23,19 @@ __all__ = [
     'Transport',
     'TransportHost',
     'TransportURL',
+    'get_sharded_transport',
     'get_transport',
     'set_transport_defaults',
 ]
 
 import logging
+import threading
 
 from oslo_config import cfg
 import six
 from six.moves.urllib import parse
-from stevedore import driver
 
+from oslo_messaging._drivers import sharding
 from oslo_messaging._i18n import _LW
 from oslo_messaging import exceptions
 
@@ -56,6 +58,13 @@ _transport_opts = [
                help='The default exchange under which topics are scoped. May '
                     'be overridden by an exchange name specified in the '
                     'transport_url option.'),
+    cfg.BoolOpt('transport_driver_sharing',
+                default=False,
+                help='Share one driver, with its connection pool, reply '
+                     'queue and threads, between all the transports of the '
+                     'process created with the same configuration and '
+                     'transport URL. The driver is released when the last '
+                     'of these transports is cleaned up.'),
 ]
 
 
@@ -83,6 +92,8 @@ class Transport(object):
     def __init__(self, driver):
         self.conf = driver.conf
         self._driver = driver
+        self._registry_key = None
+        self._released = False
 
     def _require_driver_features(self, requeue=False):
         self._driver.require_features(requeue=requeue)
@@ -96,6 +107,21 @@ class Transport(object):
                                  wait_for_reply=wait_for_reply,
                                  timeout=timeout, retry=retry)
 
+    def _send_stream(self, target, ctxt, message, timeout=None, retry=None):
+        if not target.topic:
+            raise exceptions.InvalidTarget('A topic is required to send',
+                                           target)
+        return self._driver.send_stream(target, ctxt, message,
+                                        timeout=timeout, retry=retry)
+
+    def _send_hedged(self, target, ctxt, message, hedge_delay, timeout=None,
+                     retry=None):
+        if not target.topic:
+            raise exceptions.InvalidTarget('A topic is required to send',
+                                           target)
+        return self._driver.send_hedged(target, ctxt, message, hedge_delay,
+                                        timeout=timeout, retry=retry)
+
     def _send_notification(self, target, ctxt, message, version, retry=None):
         if not target.topic:
             raise exceptions.InvalidTarget('A topic is required to send',
@@ -124,7 +150,44 @@ class Transport(object):
 
     def cleanup(self):
         """Release all resources associated with this transport."""
-        self._driver.cleanup()
+        if self._registry_key is None:
+            self._driver.cleanup()
+        elif not self._released:
+            # NOTE: the driver is shared with other transports
+            self._released = True
+            _driver_registry.release(self._registry_key)
+
+
+class _DriverRegistry(object):
+    """Process wide registry of the drivers shared between transports.
+
+    Drivers are refcounted, a driver is cleaned up when the last transport
+    using it releases it.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._drivers = {}
+
+    def acquire(self, key, load_driver):
+        with self._lock:
+            entry = self._drivers.get(key)
+            if entry is None:
+                entry = self._drivers[key] = [load_driver(), 0]
+            entry[1] += 1
+            return entry[0]
+
+    def release(self, key):
+        with self._lock:
+            entry = self._drivers[key]
+            entry[1] -= 1
+            if entry[1] > 0:
+                return
+            del self._drivers[key]
+        entry[0].cleanup()
+
+
+_driver_registry = _DriverRegistry()
 
 
 class InvalidTransportURL(exceptions.MessagingException):
@@ -174,6 +237,11 @@ def get_transport(conf, url=None, allowed_remote_exmods=None, aliases=None):
     :type allowed_remote_exmods: list
     :param aliases: A map of transport alias to transport name
     :type aliases: dict
+
+    When the transport_driver_sharing option is set, transports created with
+    the same configuration object, transport URL, control exchange and
+    allowed_remote_exmods share their driver. Each of them must still be
+    cleaned up, the driver is cleaned up with the last one.
     """
     allowed_remote_exmods = allowed_remote_exmods or []
     conf.register_opts(_transport_opts)
@@ -184,16 +252,81 @@ def get_transport(conf, url=None, allowed_remote_exmods=None, aliases=None):
     kwargs = dict(default_exchange=conf.control_exchange,
                   allowed_remote_exmods=allowed_remote_exmods)
 
-    try:
-        mgr = driver.DriverManager('oslo.messaging.drivers',
-                                   url.transport.split('+')[0],
-                                   invoke_on_load=True,
-                                   invoke_args=[conf, url],
-                                   invoke_kwds=kwargs)
-    except RuntimeError as ex:
-        raise DriverLoadFailure(url.transport, ex)
+    def load_driver():
+        # NOTE: stevedore is imported on first use, it brings pkg_resources
+        # which dominates the import time of oslo_messaging otherwise
+        from stevedore import driver
+
+        try:
+            mgr = driver.DriverManager('oslo.messaging.drivers',
+                                       url.transport.split('+')[0],
+                                       invoke_on_load=True,
+                                       invoke_args=[conf, url],
+                                       invoke_kwds=kwargs)
+        except RuntimeError as ex:
+            raise DriverLoadFailure(url.transport, ex)
+        return mgr.driver
+
+    if not conf.transport_driver_sharing:
+        return Transport(load_driver())
+
+    # NOTE: drivers read their options from conf, so only transports built
+    # from the same ConfigOpts instance can share one
+    key = (id(conf), str(url), conf.control_exchange,
+           tuple(sorted(allowed_remote_exmods)))
+    transport = Transport(_driver_registry.acquire(key, load_driver))
+    transport._registry_key = key
+    return transport
+
+
+def get_sharded_transport(conf, urls, allowed_remote_exmods=None,
+                          aliases=None):
+    """A factory method for Transport objects spread over several brokers.
+
+    Unlike the multiple hosts of a single transport URL, which are used for
+    failover, each of the given URLs is an independent shard, addresses are
+    spread over them by consistent hashing:
+
+    * messages sent to a topic, including fanout ones, go to the shard owning
+      the exchange and the topic
+    * messages sent to a server go to the shard owning the exchange, the
+      topic and the server
+    * servers listen on both of them
+    * notifications go to the shard owning their exchange and topic
+
+    Adding a shard only moves about 1/N of the addresses to it. Every client,
+    server, notifier and notification listener must be given the same list
+    of shards.
+
+    :param conf: the user configuration
+    :type conf: cfg.ConfigOpts
+    :param urls: the transport URL of each shard
+    :type urls: list of str or TransportURL
+    :param allowed_remote_exmods: a list of modules which a client using this
+                                  transport will deserialize remote exceptions
+                                  from
+    :type allowed_remote_exmods: list
+    :param aliases: A map of transport alias to transport name
+    :type aliases: dict
+    """
+    if not urls:
+        raise InvalidTransportURL(urls, 'At least one shard is required')
+    conf.register_opts(_transport_opts)
 
-    return Transport(mgr.driver)
+    urls = [url if isinstance(url, TransportURL)
+            else TransportURL.parse(conf, url, aliases) for url in urls]
+    transports = [get_transport(conf, url, allowed_remote_exmods)
+                  for url in urls]
+    # NOTE: credentials are left out of the shard names so that rotating
+    # them doesn't move the addresses to other shards
+    names = ['%s://%s/%s' % (url.transport,
+                             ','.join('%s:%s' % (host.hostname, host.port)
+                                      for host in url.hosts),
+                             url.virtual_host or '')
+             for url in urls]
+    return Transport(sharding.ShardedDriver(
+        conf, transports, names, default_exchange=conf.control_exchange,
+        allowed_remote_exmods=allowed_remote_exmods))
 
 
 class TransportHost(object):
@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""CPU cost per message of the AMQP 1.0 driver message encodings.
+
+Marshals an RPC request and its reply with the 'json' and the 'native'
+message_encoding, and reports the CPU time spent by the sender to build and
+encode the AMQP message, by the receiver to decode and unmarshal it, and
+the size of the encoded message.
+"""
+
+import argparse
+import time
+import timeit
+
+from oslo_messaging._drivers import impl_amqp1
+
+try:
+    _timer = time.process_time
+except AttributeError:
+    # python 2, where time.clock() is the process time on Unix
+    _timer = time.clock
+
+
+def _request(args_count):
+    context = {
+        'user_id': 'e2a1f4b6c8d04f0e9a7b3c5d1e6f8a20',
+        'project_id': '6f1c2d3e4b5a69788796a5b4c3d2e1f0',
+        'roles': ['admin', 'member', 'reader'],
+        'is_admin': False,
+        'read_deleted': 'no',
+        'request_id': 'req-0b9a8c7d-6e5f-4a3b-2c1d-0e9f8a7b6c5d',
+        'service_catalog': [{'type': 'volumev2', 'name': 'cinderv2',
+                             'endpoints': [{'region': 'RegionOne',
+                                            'url': 'http://10.0.0.1:8776'}]}],
+        'timestamp': '2016-10-19T12:00:00.000000',
+    }
+    instance = dict(('field_%d' % i, 'value-%d' % i)
+                    for i in range(args_count))
+    instance.update(memory_mb=2048, vcpus=2, metadata={'group': 'web'},
+                    security_groups=['default', 'web'], locked=False)
+    request = {'method': 'build_and_run_instance', 'namespace': 'compute',
+               'version': '4.11', 'args': {'instance': instance,
+                                           'limits': {'memory_mb': 4096.0},
+                                           'node': None}}
+    return request, context
+
+
+def _cases(request, context, native):
+    def send_request():
+        impl_amqp1.marshal_request(request, context, True,
+                                   native=native).encode()
+
+    def receive_request():
+        message = impl_amqp1.proton.Message()
+        message.decode(encoded_request)
+        impl_amqp1.unmarshal_request(message)
+
+    def send_reply():
+        impl_amqp1.marshal_response(request['args'], None,
+                                    native=native).encode()
+
+    def receive_reply():
+        message = impl_amqp1.proton.Message()
+        message.decode(encoded_reply)
+        impl_amqp1.unmarshal_response(message, [])
+
+    encoded_request = impl_amqp1.marshal_request(request, context, True,
+                                                 native=native).encode()
+    encoded_reply = impl_amqp1.marshal_response(request['args'], None,
+                                                native=native).encode()
+    return [('send request', send_request, len(encoded_request)),
+            ('receive request', receive_request, len(encoded_request)),
+            ('send reply', send_reply, len(encoded_reply)),
+            ('receive reply', receive_reply, len(encoded_reply))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('-n', '--number', type=int, default=10000)
+    parser.add_argument('-r', '--repeat', type=int, default=5)
+    parser.add_argument('-a', '--args', type=int, default=20,
+                        help='number of fields of the request argument')
+    args = parser.parse_args()
+
+    request, context = _request(args.args)
+    for encoding in ('json', 'native'):
+        for name, run, size in _cases(request, context,
+                                      encoding == 'native'):
+            best = min(timeit.repeat(run, timer=_timer, number=args.number,
+                                     repeat=args.repeat))
+            print('%-7s %-16s %8.3f us/message %6d bytes' %
+                  (encoding, name, best / args.number * 1e6, size))
+
+
+if __name__ == '__main__':
+    main()
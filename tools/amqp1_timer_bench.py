@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Benchmark of the AMQP 1.0 eventloop Scheduler under many pending calls.
+
+Arms one alarm per concurrent call, as the controller does for each send
+task with a timeout, then cancels most of them as if their replies had
+arrived and runs the scheduler until all the remaining ones have expired.
+The timer wheel is compared to the heap the Scheduler used before.
+"""
+
+import argparse
+import heapq
+import random
+import time
+
+from oslo_messaging._drivers.amqp1_driver import eventloop
+
+
+class HeapScheduler(object):
+    """The heap based Scheduler, canceled alarms stay in the heap."""
+
+    class Event(object):
+        def __init__(self, callback):
+            self.callback = callback
+
+        def cancel(self):
+            self.callback = None
+
+    def __init__(self):
+        self._callbacks = {}
+        self._deadlines = []
+
+    def alarm(self, request, deadline):
+        try:
+            callbacks = self._callbacks[deadline]
+        except KeyError:
+            callbacks = list()
+            self._callbacks[deadline] = callbacks
+            heapq.heappush(self._deadlines, deadline)
+        entry = HeapScheduler.Event(request)
+        callbacks.append(entry)
+        return entry
+
+    def _pending(self):
+        return sum(len(callbacks) for callbacks in self._callbacks.values())
+
+    def _process(self):
+        _now = eventloop.now()
+        while self._deadlines and self._deadlines[0] <= _now:
+            deadline = heapq.heappop(self._deadlines)
+            for cb in self._callbacks.pop(deadline):
+                cb.callback and cb.callback()
+
+
+def _pending(scheduler):
+    if isinstance(scheduler, HeapScheduler):
+        return scheduler._pending()
+    return scheduler._count
+
+
+def _run(name, scheduler, args, clock):
+    rnd = random.Random(args.seed)
+    fired = []
+
+    def on_timeout():
+        fired.append(None)
+
+    timeouts = [rnd.uniform(args.min_timeout, args.timeout)
+                for i in range(args.calls)]
+
+    start = time.time()
+    events = [scheduler.alarm(on_timeout, eventloop.compute_timeout(t))
+              for t in timeouts]
+    scheduled = time.time() - start
+
+    rnd.shuffle(events)
+    canceled = events[:int(len(events) * args.cancel)]
+    start = time.time()
+    for event in canceled:
+        event.cancel()
+    cancel = time.time() - start
+    pending = _pending(scheduler)
+
+    start = time.time()
+    for i in range(int(args.timeout) + 2):
+        clock[0] += 1
+        scheduler._process()
+    process = time.time() - start
+
+    print('%-6s schedule %6.3f us/call, cancel %6.3f us/call, '
+          'expire %7.3f ms, %d entries left after cancel, %d expired' %
+          (name,
+           scheduled / args.calls * 1e6,
+           cancel / max(len(canceled), 1) * 1e6,
+           process * 1e3, pending, len(fired)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('-c', '--calls', type=int, default=100000,
+                        help='number of concurrent calls')
+    parser.add_argument('-t', '--timeout', type=float, default=60,
+                        help='longest call timeout, in seconds')
+    parser.add_argument('--min-timeout', type=float, default=1,
+                        help='shortest call timeout, in seconds')
+    parser.add_argument('--cancel', type=float, default=0.99,
+                        help='fraction of the calls replied to in time')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    # drive the schedulers with a simulated clock
+    clock = [time.time()]
+    eventloop.now = lambda: clock[0]
+    for name, scheduler in (('heap', HeapScheduler()),
+                            ('wheel', eventloop.Scheduler())):
+        _run(name, scheduler, args, clock)
+
+
+if __name__ == '__main__':
+    main()
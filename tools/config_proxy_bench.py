@@ -0,0 +1,63 @@
+#!/usr/bin/env python
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Micro-benchmark of option access through the driver ConfigOptsProxy.
+
+Reports the cost of reading an option straight from ConfigOpts and through
+the proxy, for an option taken from the configuration and for one
+overridden by the transport URL query.
+"""
+
+import argparse
+import timeit
+
+from oslo_config import cfg
+
+from oslo_messaging._drivers import common as drv_cmn
+from oslo_messaging import transport
+
+_GROUP = 'bench'
+_OPTS = [
+    cfg.IntOpt('from_conf', default=1),
+    cfg.IntOpt('from_url', default=1),
+]
+
+
+def _setup():
+    conf = cfg.ConfigOpts()
+    conf.register_opts(_OPTS, group=_GROUP)
+    conf([])
+    url = transport.TransportURL.parse(conf, 'fake:///?from_url=2')
+    return conf, drv_cmn.ConfigOptsProxy(conf, url)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('-n', '--number', type=int, default=100000)
+    parser.add_argument('-r', '--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    conf, proxy = _setup()
+    cases = [
+        ('ConfigOpts', lambda: conf.bench.from_conf),
+        ('proxy, conf value', lambda: proxy.bench.from_conf),
+        ('proxy, url value', lambda: proxy.bench.from_url),
+    ]
+    for name, access in cases:
+        best = min(timeit.repeat(access, number=args.number,
+                                 repeat=args.repeat))
+        print('%-20s %8.3f us/access' % (name, best / args.number * 1e6))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Measure the time needed to import a module in a fresh interpreter.
+
+Each run imports the module in a new python process, the best and median
+wall clock times of the runs are reported, along with the heavy
+dependencies the import pulled in. With --importtime, the slowest modules
+reported by ``python -X importtime`` (python >= 3.7) are listed too.
+"""
+
+import argparse
+import json
+import subprocess
+import sys
+
+_SNIPPET = """
+import json, sys, time
+start = time.time()
+import %(module)s
+elapsed = time.time() - start
+print(json.dumps({'elapsed': elapsed,
+                  'loaded': [m for m in %(watched)r if m in sys.modules]}))
+"""
+
+_WATCHED = ['stevedore', 'pkg_resources', 'futurist', 'kombu', 'eventlet',
+            'oslo_service']
+
+
+def _run(module):
+    snippet = _SNIPPET % {'module': module, 'watched': _WATCHED}
+    out = subprocess.check_output([sys.executable, '-c', snippet])
+    return json.loads(out.decode('utf-8').strip().splitlines()[-1])
+
+
+def _importtime(module, top):
+    proc = subprocess.Popen([sys.executable, '-X', 'importtime', '-c',
+                             'import %s' % module],
+                            stderr=subprocess.PIPE)
+    _, err = proc.communicate()
+    rows = []
+    for line in err.decode('utf-8').splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        rows.append((int(cumulative), name.strip()))
+    rows.sort(reverse=True)
+    for cumulative, name in rows[:top]:
+        print('  %8.1f ms  %s' % (cumulative / 1000.0, name))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('module', nargs='?', default='oslo_messaging')
+    parser.add_argument('-n', '--runs', type=int, default=10)
+    parser.add_argument('--importtime', action='store_true',
+                        help='List the slowest modules to import')
+    parser.add_argument('--top', type=int, default=15)
+    args = parser.parse_args()
+
+    results = [_run(args.module) for i in range(args.runs)]
+    times = sorted(r['elapsed'] for r in results)
+    print('import %s: best %.1f ms, median %.1f ms over %d runs'
+          % (args.module, times[0] * 1000, times[len(times) // 2] * 1000,
+             args.runs))
+    print('heavy modules loaded: %s'
+          % (', '.join(results[-1]['loaded']) or 'none'))
+    if args.importtime:
+        _importtime(args.module, args.top)
+
+
+if __name__ == '__main__':
+    main()